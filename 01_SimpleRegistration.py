@@ -22,6 +22,9 @@ if __name__ == "__main__":
     moving_image_name = "CT_2D_head_moving.mha"
     result_image_name = "result_image.mha"
 
+    # Run the registration a second time to verify that the deterministic mode gives the same result (doubles the time)
+    verify_rerun = False
+
     # Load the images
     fixed_image = sitk.ReadImage(os.path.join(path_to_input, fixed_image_name), sitk.sitkFloat32)
     moving_image = sitk.ReadImage(os.path.join(path_to_input, moving_image_name), sitk.sitkFloat32)
@@ -30,24 +33,32 @@ if __name__ == "__main__":
     if not os.path.exists(os.path.join(path_to_output, result_image_name)):
         print("Running elastix registration... ")
 
-        # Initialize the elastix registration
-        elastix_image_filter = sitk.ElastixImageFilter()
-        elastix_image_filter.SetFixedImage(fixed_image)
-        elastix_image_filter.SetMovingImage(moving_image)
-
         # Load the default parameter map
         parameter_map = sitk.GetDefaultParameterMap("bspline")
-        elastix_image_filter.SetParameterMap(parameter_map)
 
-        # Other settings
-        elastix_image_filter.SetOutputDirectory(path_to_output)
-        elastix_image_filter.LogToConsoleOff()
-
-        # Run Elastix!
-        elastix_image_filter.Execute()
+        # Report the progress every 50 iterations, while elastix writes its log
+        def progress(event):
+            if event['iteration'] % 50 == 0:
+                print("  resolution {0}, iteration {1}: metric {2:.4f}".format(event['resolution'], event['iteration'],
+                                                                               event['metric']))
+
+        # Run Elastix in deterministic mode: a fixed random seed for the sampler and a fixed number of threads, so a
+        # rerun gives the same transform parameters
+        with cf.RegistrationTelemetry(os.path.join(path_to_output, 'elastix.log'), callback=progress) as telemetry:
+            result_image, result_transform_parameters = cf.deterministicRegistration(fixed_image, moving_image,
+                                                                                     parameter_map, seed=0,
+                                                                                     output_directory=path_to_output)
+        print("Registration {0} after {1} iterations".format(telemetry.status, len(telemetry.events)))
+
+        # Optionally verify that a second run gives an equivalent result
+        if verify_rerun:
+            result_image_rerun, result_transform_parameters_rerun = cf.deterministicRegistration(
+                fixed_image, moving_image, parameter_map, seed=0)
+            verification = cf.verifyRegistrationResults(result_image, result_transform_parameters, result_image_rerun,
+                                                        result_transform_parameters_rerun)
+            print("Rerun gives the same result:", verification['equal'])
 
         # Save image with itk
-        result_image = elastix_image_filter.GetResultImage()
         sitk.WriteImage(result_image, os.path.join(path_to_output, result_image_name))
 
     else:
@@ -55,6 +66,13 @@ if __name__ == "__main__":
         result_image = sitk.ReadImage(os.path.join(path_to_output, result_image_name))
 
 
+    # Numeric similarity before and after registration (lower is better, as for the elastix metrics)
+    similarity_scorer = cf.SimilarityScorer(fixed_image)
+    for name, image in (("before", moving_image), ("after", result_image)):
+        metrics = similarity_scorer.score(image)
+        print("Similarity {0} registration: MI {1:.4f}, NCC {2:.4f}, MSE {3:.2f}".format(
+            name, metrics['mattes_mutual_information'], metrics['normalized_correlation'], metrics['mean_squares']))
+
     # Get arrays from images
     fixed_image_arr = sitk.GetArrayFromImage(fixed_image)
     moving_image_arr = sitk.GetArrayFromImage(moving_image)
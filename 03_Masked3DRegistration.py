@@ -1,5 +1,6 @@
 import os
 import SimpleITK as sitk
+import custom_functions as cf
 
 '''
 Often, some content in the images may not correspond. For example, there may be background content or noisy areas. 
@@ -44,20 +45,13 @@ if __name__ == "__main__":
     if not os.path.exists(os.path.join(path_to_output, result_image_name)):
         print("Running elastix registration... ")
 
-        # Import Custom Parameter Map
-        # Load the default parameter map
-        elastix_image_filter = sitk.ElastixImageFilter()
-        elastix_image_filter.SetFixedImage(fixed_image)
-        elastix_image_filter.SetMovingImage(moving_image)
-        elastix_image_filter.SetFixedMask(fixed_mask)
-        elastix_image_filter.SetMovingMask(moving_mask)
-        elastix_image_filter.SetOutputDirectory(path_to_output)
-        elastix_image_filter.LogToConsoleOff()
-        elastix_image_filter.LogToFileOn()
-        elastix_image_filter.SetParameterMap(
-        sitk.ReadParameterFile(os.path.join(path_to_input, 'parameters.3D.NC.affine.ASGD.001.txt')))
-
-        elastix_image_filter.Execute()
+        # The masks only cover the lungs, so the images are cropped to the bounding box of the masks (plus a margin of
+        # 10 mm) before the registration. The pyramids and samplers then do not process the empty air around the body.
+        # The resulting transform is moved back to the full fixed image grid afterwards.
+        parameter_map = sitk.ReadParameterFile(os.path.join(path_to_input, 'parameters.3D.NC.affine.ASGD.001.txt'))
+        result_transform_parameters = cf.maskCroppedRegistration(fixed_image, moving_image, fixed_mask, moving_mask,
+                                                                 parameter_map, margin=10.0,
+                                                                 output_directory=path_to_output)
 
         # # Call registration function
         # result_image, result_transform_parameters = itk.elastix_registration_method(
@@ -66,8 +60,16 @@ if __name__ == "__main__":
         #     fixed_mask=fixed_mask, moving_mask=moving_mask,
         #     log_to_console=False)
 
+        # Apply the transform to the full moving image
+        transformix_image_filter = sitk.TransformixImageFilter()
+        transformix_image_filter.SetMovingImage(moving_image)
+        cf._setTransformParameterMaps(transformix_image_filter, result_transform_parameters)
+        transformix_image_filter.SetOutputDirectory(path_to_output)
+        transformix_image_filter.LogToConsoleOff()
+        transformix_image_filter.Execute()
+
         # Save image with itk
-        result_image = elastix_image_filter.GetResultImage()
+        result_image = transformix_image_filter.GetResultImage()
         sitk.WriteImage(result_image, os.path.join(path_to_output, result_image_name))
 
     else:
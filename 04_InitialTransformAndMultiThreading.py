@@ -44,8 +44,13 @@ if __name__ == "__main__":
         elastix_image_filter.AddParameterMap(sitk.GetDefaultParameterMap('rigid'))
         elastix_image_filter.LogToConsoleOn()
         elastix_image_filter.SetInitialTransformParameterFileName(initial_parameter_file)
-        elastix_image_filter.SetNumberOfThreads(4)
-        elastix_image_filter.Execute()
+
+        # The number of threads is chosen from the cores available to this process (affinity mask and container
+        # quota) and the image size, instead of a fixed number
+        scheduler = cf.ThreadScheduler()
+        with scheduler.allocate(fixed_image, elastix_image_filter) as number_of_threads:
+            print("Using {0} of {1} available cores".format(number_of_threads, scheduler.cpus))
+            elastix_image_filter.Execute()
 
         # Save image with itk
         result_image = elastix_image_filter.GetResultImage()
@@ -57,6 +62,13 @@ if __name__ == "__main__":
         result_image = sitk.ReadImage(os.path.join(path_to_output, result_image_name))
 
 
+    # Numeric similarity before and after registration (lower is better, as for the elastix metrics)
+    similarity_scorer = cf.SimilarityScorer(fixed_image)
+    for name, image in (("before", moving_image), ("after", result_image)):
+        metrics = similarity_scorer.score(image)
+        print("Similarity {0} registration: MI {1:.4f}, NCC {2:.4f}, MSE {3:.2f}".format(
+            name, metrics['mattes_mutual_information'], metrics['normalized_correlation'], metrics['mean_squares']))
+
     # Get arrays from images
     fixed_image_arr = sitk.GetArrayFromImage(fixed_image)
     moving_image_arr = sitk.GetArrayFromImage(moving_image)
@@ -1,5 +1,6 @@
 import os
 import SimpleITK as sitk
+import custom_functions as cf
 
 '''
 Groupwise registration methods try to mitigate uncertainties associated with any one image by simultaneously registering
@@ -25,26 +26,17 @@ if __name__ == "__main__":
     folder_image_name = "00"
     result_image_name = "result_image.mha"
 
-    # Load all the images in the folder, convert them to 2D and add them to a list
-    images = os.listdir(os.path.join(path_to_input, folder_image_name))
-    images.sort()
-    vectorOfImages = sitk.VectorOfImage()
-    for image in images:
-
-        temp_image = sitk.ReadImage(os.path.join(path_to_input, folder_image_name, image))
-        temp_image = sitk.Extract(temp_image, (temp_image.GetWidth(), temp_image.GetHeight(), 0), (0, 0, 0))
-        vectorOfImages.push_back(temp_image)
-
-    # Change the origin of the images to avoid errors
-    image_origin = vectorOfImages[0].GetOrigin()
-    for n in range(vectorOfImages.size()):
-        vectorOfImages[n].SetOrigin(image_origin)
-
-
-
-
-    # Join all images
-    images = sitk.JoinSeries(vectorOfImages)
+    # Index the DICOM headers of the folder once. Later runs only read the headers of new or changed files, and the
+    # slices are read directly from the pixel data offsets in the index. The slices are stacked in the order of their
+    # file names and share the in-plane geometry of the first slice.
+    os.makedirs(path_to_output, exist_ok=True)
+    dicom_index = cf.DicomIndex(os.path.join(path_to_output, 'dicom_index.sqlite'))
+    index_report = dicom_index.update(os.path.join(path_to_input, folder_image_name))
+    for skipped in index_report['skipped']:
+        print("Skipped {0}: {1}".format(skipped['path'], skipped['reason']))
+    series_uid = next(iter(dicom_index.series()))
+    images = dicom_index.loadStack(series_uid)
+    dicom_index.close()
 
     # Run the registration if the output file does not yet exist
     if not os.path.exists(os.path.join(path_to_output, result_image_name)):
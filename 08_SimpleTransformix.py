@@ -2,6 +2,7 @@ import os
 import numpy as np
 from matplotlib import pyplot as plt
 import SimpleITK as sitk
+import custom_functions as cf
 
 '''
 After image registrations it is often useful to apply the transformation as found by the registration to another image. 
@@ -78,6 +79,13 @@ if __name__ == "__main__":
     # Get the resulting imagefrom transformix
     result_image_transformix = transformix_image_filter.GetResultImage()
 
+    # Several images on the moving grid (here the moving image and its mask) can be warped in one batch. The transform
+    # is evaluated once for every output voxel and all images are interpolated at the same coordinates, instead of
+    # running transformix once per image.
+    moving_mask = sitk.ReadImage(os.path.join(path_to_input, "CT_2D_head_moving_mask.mha"))
+    result_image_batch, result_mask_batch = cf.warpImages([moving_image, moving_mask], result_transform_parameters,
+                                                          fixed_image, label_channels=[1])
+
     # Get arrays from images
     fixed_image_arr = sitk.GetArrayFromImage(fixed_image)
     moving_image_arr = sitk.GetArrayFromImage(moving_image)
@@ -88,6 +96,9 @@ if __name__ == "__main__":
 
     difference_1 = result_image_arr - result_image_tr_arr
 
+    result_image_batch_arr = sitk.GetArrayFromImage(result_image_batch)
+    result_mask_batch_arr = sitk.GetArrayFromImage(result_mask_batch)
+
 
 
     # Plot the images
@@ -96,13 +107,16 @@ if __name__ == "__main__":
               "Result image (after registration)",
               "Moving image (transformix input)",
               "Result image (transformix output)",
-              "Diference between both results"]
+              "Diference between both results",
+              "Result image (batch warp)",
+              "Result mask (batch warp)"]
 
-    images = [fixed_image_arr, moving_image_arr, result_image_arr, moving_image_tr_arr, result_image_tr_arr, difference_1]
-    cmaps = ['gray', 'gray', 'gray', 'gray', 'gray', 'gray']
+    images = [fixed_image_arr, moving_image_arr, result_image_arr, moving_image_tr_arr, result_image_tr_arr,
+              difference_1, result_image_batch_arr, result_mask_batch_arr]
+    cmaps = ['gray', 'gray', 'gray', 'gray', 'gray', 'gray', 'gray', 'gray']
 
-    for i in range(6):
-        plt.subplot(2, 3, i + 1)
+    for i in range(8):
+        plt.subplot(2, 4, i + 1)
         plt.imshow(images[i], cmap=cmaps[i], interpolation='none')
         plt.title(titles[i])
         plt.xticks([]), plt.yticks([])
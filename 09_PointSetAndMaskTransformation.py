@@ -1,6 +1,7 @@
 import os
 import numpy as np
 import SimpleITK as sitk
+import custom_functions as cf
 
 '''
 Transformix can be used to transform point sets and mask images as well. Masks can be seen as images so the registration
@@ -14,16 +15,6 @@ transformed with the backwards mapping protocol, but can instead be transformed
 on ROI of the fixed image.
 '''
 
-# In case of boolaen segmentation, the dice loss is equal to 2 x dot product of the flattened arrays divided by the
-# total volume of both masks.
-def dice_loss(y_true, y_pred):
-    y_true = y_true.flatten()
-    y_pred = y_pred.flatten()
-    intersection = y_true.dot(y_pred)
-    union = sum(y_true) + sum(y_pred)
-    dice = 2 * intersection / union
-    return dice
-
 # MAIN FUNCTION
 if __name__ == "__main__":
 
@@ -51,29 +42,17 @@ if __name__ == "__main__":
     # RUN ELASTIX
     print("Running elastix registration... ")
 
-    elastix_image_filter = sitk.ElastixImageFilter()
-    elastix_image_filter.SetFixedImage(fixed_image)
-    elastix_image_filter.SetMovingImage(moving_image)
-
     parameter_map_rigid = sitk.GetDefaultParameterMap('rigid')
     parameter_map_affine = sitk.GetDefaultParameterMap('affine')
     parameter_map_bspline = sitk.GetDefaultParameterMap('bspline')
 
-    elastix_image_filter.SetParameterMap(parameter_map_rigid)
-    elastix_image_filter.AddParameterMap(parameter_map_affine)
-    elastix_image_filter.AddParameterMap(parameter_map_bspline)
-
-    # Other options
-    elastix_image_filter.SetOutputDirectory(path_to_output)
-    elastix_image_filter.LogToConsoleOff()
-
-    # Run elastix!
-    elastix_image_filter.Execute()
-
-
-    # Get the resulting image and transform parameters
-    result_image_elastix = elastix_image_filter.GetResultImage()
-    result_transform_parameters = elastix_image_filter.GetTransformParameterMap()
+    # The three stages are run one after the other. After each stage its transform parameters are saved in the
+    # checkpoint folder, so when the script is interrupted and started again it continues after the last finished stage.
+    path_to_checkpoints = os.path.join(path_to_output, 'checkpoints')
+    parameter_maps = [parameter_map_rigid, parameter_map_affine, parameter_map_bspline]
+    result_transform_parameters = cf.stagedRegistration(fixed_image, moving_image, parameter_maps, path_to_checkpoints,
+                                                        callback=lambda event: print("  stage {0}: {1}".format(
+                                                            event['stage'], event['status'])))
 
 
     # RUN TRANSFORMIX
@@ -108,7 +87,33 @@ if __name__ == "__main__":
     fixed_mask_np = np.asarray(fixed_mask)
     result_mask_np = np.asarray(result_image_transformix).round().astype(int)
 
-    print("Dice loss:", dice_loss(fixed_mask_np, result_mask_np))
+    print("Dice loss:", cf.diceCoefficient(fixed_mask_np, result_mask_np))
+
+
+    # COLLAPSED TRANSFORM
+    '''
+    Transformix evaluates the rigid, affine and B-spline transform one after the other for every voxel. When the same 
+    transform is applied to many images, the chain can be collapsed once into a single displacement field (or a single 
+    refitted B-spline) on the fixed image grid. Every following warp then only evaluates one transform.
+    '''
+    collapsed_transform = cf.collapseToDisplacementField(result_transform_parameters, fixed_image)
+
+    # The moving image and its mask are warped together: the transform is evaluated once and both images are
+    # interpolated at the same coordinates (the mask with nearest neighbour interpolation).
+    result_image_collapsed, result_mask_collapsed = cf.warpImages([moving_image, moving_mask], collapsed_transform,
+                                                                  fixed_image, label_channels=[1])
+
+    # Saved under its own name: the linear warp through the collapsed transform is only an alternative, the transformix
+    # output remains the reference result
+    sitk.WriteImage(result_image_collapsed, os.path.join(path_to_output, "result_image_collapsed.mha"))
+    result_mask_collapsed_np = np.asarray(result_mask_collapsed).round().astype(int)
+
+    print("Dice loss (collapsed transform):", cf.diceCoefficient(fixed_mask_np, result_mask_collapsed_np))
+
+    # The collapsed transforms must map points exactly like transformix does
+    deviations = cf.checkAgainstTransformix(result_transform_parameters, grid_spacing=8.0, reference_image=fixed_image)
+    for kind, deviation in deviations.items():
+        print("Largest deviation from transformix ({0}): {1:.4f} mm".format(kind, deviation))
 
 
     # POINT SET TRANSFORMATION
@@ -127,5 +132,27 @@ if __name__ == "__main__":
     transformix_image_filter.Execute()
 
 
-
-
+    # TARGET REGISTRATION ERROR
+    '''
+    Corresponding landmarks in the fixed and moving image give a direct measure of the registration accuracy: the target
+    registration error (TRE) is the distance between a transformed fixed landmark and its corresponding moving landmark.
+    The landmarks can be transformed in memory, without running transformix and reading back outputpoints.txt.
+    '''
+    fixed_point_set = cf.readPointSet(os.path.join(path_to_input, 'CT_3D_lung_fixed_point_set_corrected.txt'))
+    moving_point_set = cf.readPointSet(os.path.join(path_to_input, 'CT_3D_lung_moving_point_set_corrected.txt'))
+
+    identity_transform = sitk.TranslationTransform(3)
+    result_transform = cf.compositeTransform(result_transform_parameters)
+    target_registration_error = cf.targetRegistrationError([identity_transform, result_transform],
+                                                           fixed_point_set, moving_point_set)
+    statistics = cf.targetRegistrationErrorStatistics(target_registration_error)
+    print("TRE before registration: {0:.2f} +- {1:.2f} mm".format(statistics['mean'][0], statistics['std'][0]))
+    print("TRE after registration:  {0:.2f} +- {1:.2f} mm".format(statistics['mean'][1], statistics['std'][1]))
+
+    # The in-memory landmarks must agree with the points transformix wrote to outputpoints.txt above
+    transformix_points = cf.readOutputPoints(os.path.join(path_to_output, 'outputpoints.txt'))
+    transformix_error = np.linalg.norm(transformix_points - moving_point_set, axis=1)
+    print("TRE after registration (transformix points): {0:.2f} +- {1:.2f} mm".format(np.mean(transformix_error),
+                                                                                      np.std(transformix_error)))
+    print("Largest distance to the transformix points: {0:.4f} mm".format(
+        np.max(np.linalg.norm(cf.transformPoints(result_transform, fixed_point_set) - transformix_points, axis=1))))
@@ -1,9 +1,11 @@
 import os
+import multiprocessing
 
 import SimpleITK
 import numpy as np
 from matplotlib import pyplot as plt
 import SimpleITK as sitk
+import custom_functions as cf
 
 '''
 With the transformix algorithm the spatial jacobian and the determinant of the spatial jacobian of the transformation 
@@ -11,6 +13,14 @@ can be calculated. Especially the determinant of the spatial Jacobian, which ide
 or expansion and can be useful, for example in lung ventilation studies
 '''
 
+# Consumer process: receives the results of a registration through shared memory (without a copy or a file) and counts
+# the foldings in the determinant of the spatial jacobian
+def count_foldings(channel):
+    key, images, metadata = channel.receive()
+    number_of_foldings = int(np.sum(images['determinant'].array < 0))
+    print("{0}: {1} foldings (received in a separate process)".format(key, number_of_foldings))
+    channel.acknowledge(key, images)
+
 # MAIN FUNCTION
 if __name__ == "__main__":
 
@@ -62,9 +72,7 @@ if __name__ == "__main__":
     transformix_image_filter.SetMovingImage(moving_image_transformix)
     transformix_image_filter.SetTransformParameterMap(result_transform_parameters)
 
-    # Calculate Jacobian matrix and it's determinant in a tuple
-    transformix_image_filter.ComputeSpatialJacobianOn()
-    transformix_image_filter.ComputeDeterminantOfSpatialJacobianOn()
+    # Calculate the deformation field, the Jacobian matrix and its determinant are computed from it in memory
     transformix_image_filter.ComputeDeformationFieldOn()
 
     # Other options
@@ -78,9 +86,11 @@ if __name__ == "__main__":
     result_deformation_field = transformix_image_filter.GetDeformationField()
 
 
-    # Load spatial jacobian and deformation field from a file
-    result_spatial_jacobian = sitk.ReadImage(os.path.join(path_to_output, "fullSpatialJacobian.nii"))
-    result_det_spatial_jacobian = sitk.ReadImage(os.path.join(path_to_output, "spatialJacobian.nii"))
+    # Transformix can also write the spatial jacobian and its determinant to fullSpatialJacobian.nii and
+    # spatialJacobian.nii in the output folder (ComputeSpatialJacobianOn, ComputeDeterminantOfSpatialJacobianOn), but
+    # then they have to be read back from disk. Here they are computed directly from the deformation field.
+    spatial_jacobian = cf.spatialJacobian(result_deformation_field)
+    result_det_spatial_jacobian = cf.determinantOfSpatialJacobian(result_deformation_field)
 
     '''
     Inspect the deformation field by looking at the determinant of the Jacobian of Tµ(x). Values smaller than 1 indicate
@@ -95,17 +105,35 @@ if __name__ == "__main__":
     moving_image_arr = sitk.GetArrayFromImage(moving_image)
     result_image_arr = sitk.GetArrayFromImage(result_image_elastix)
 
-    # Casting tuple to two numpy matrices for further calculations.
-    spatial_jacobian = sitk.GetArrayFromImage(result_spatial_jacobian)
+    # Casting the determinant to a numpy matrix for further calculations.
     det_spatial_jacobian = sitk.GetArrayFromImage(result_det_spatial_jacobian)
 
     print("Number of foldings in transformation:", np.sum(det_spatial_jacobian < 0))
 
+    # Hand the results to another process through shared memory. Nothing is written to disk unless persist=True.
+    channel = cf.ResultChannel(persist_directory=path_to_output)
+    consumer = multiprocessing.Process(target=count_foldings, args=(channel,))
+    consumer.start()
+    channel.publish(moving_image_name, {'result_image': result_image_elastix,
+                                        'deformation_field': result_deformation_field,
+                                        'determinant': result_det_spatial_jacobian})
+    consumer.join()
+    channel.close()
+
+    '''
+    For a quick check of many transforms the dense Jacobian is not needed. The determinant of a B-spline transform can
+    be computed directly from its coefficients at the control points. Only the regions around control points with a
+    small or negative determinant are then evaluated at full resolution.
+    '''
+    fold_report = cf.screenFolding(result_transform_parameters, threshold=0.2)
+    print("Fold screening: folds = {0}, folded voxels = {1}, densely evaluated fraction = {2:.3f}".format(
+        fold_report['folds'], fold_report['folded_voxels'], fold_report['evaluated_fraction']))
+
     # Plot the images
     titles = ["Fixed image",
               "Moving image",
               "Result image (after registration)",
-              "Determinant of spatial jacobian (transformix output)"]
+              "Determinant of spatial jacobian (from the deformation field)"]
     images = [fixed_image_arr, moving_image_arr, result_image_arr, det_spatial_jacobian]
     cmaps = ['gray', 'gray', 'gray', 'viridis']
 
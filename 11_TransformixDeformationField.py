@@ -3,6 +3,7 @@ import os
 import numpy as np
 from matplotlib import pyplot as plt
 import SimpleITK as sitk
+import custom_functions as cf
 
 '''
 With the transformix algorithm the spatial jacobian and the determinant of the spatial jacobian of the transformation 
@@ -76,6 +77,14 @@ if __name__ == "__main__":
     # Get the resulting deformation field
     result_deformation_field = transformix_image_filter.GetDeformationField()
 
+    # Archive the deformation field in a chunked, compressed store. Chunks are stored as float16 when the error stays
+    # below 0.01 mm, and a part of the field can be read back without decompressing the rest.
+    path_to_store = os.path.join(path_to_output, 'deformation_field.chunked')
+    cf.writeChunkedImage(result_deformation_field, path_to_store, error_bound=0.01)
+    stored_deformation_field = cf.ChunkedImage(path_to_store)
+    region = stored_deformation_field.readRegion([0, 0], [64, 64])
+    print("Read a {0} region of the stored deformation field".format(region.GetSize()))
+
 
 
 
@@ -91,7 +100,16 @@ if __name__ == "__main__":
     same choices are relevant: optimisation algorithm, multiresolution etc... With Transformix the inverted transform 
     can then be used to calculate the inversion of the deformation field, just like Transformix normally calculates the
     deformation field from a transform.
+
+    Such an inversion costs as much as a second registration. A much faster alternative is to invert the deformation 
+    field directly: the inverse displacement v of a displacement u satisfies v(y) = -u(y + v(y)), which can be solved 
+    with a few fixed point iterations for all voxels at once. The remaining error of this equation (the residual) tells
+    how well the field has been inverted. Linear transforms are simply inverted in closed form.
     '''
+    print("Inverting the transformation... ")
+    inverse_transform, inversion_report = cf.invertTransform(result_transform_parameters, moving_image)
+    print("Maximum residual of the inversion: {0:.4f} mm".format(inversion_report['max_residual']))
+    inverse_deformation_arr = sitk.GetArrayFromImage(inverse_transform.GetDisplacementField())
 
     # Get arrays from images
     fixed_image_arr = sitk.GetArrayFromImage(fixed_image)
@@ -104,11 +122,13 @@ if __name__ == "__main__":
               "Moving image",
               "Result image (after registration)",
               "Deformation field - X",
-              "Deformation field - Y"]
-    images = [fixed_image_arr, moving_image_arr, result_image_arr, result_deformation_arr[:, :, 1], result_deformation_arr[:, :, 0]]
-    cmaps = ['gray', 'gray', 'gray', 'viridis', 'viridis']
+              "Deformation field - Y",
+              "Inverse deformation field - X"]
+    images = [fixed_image_arr, moving_image_arr, result_image_arr, result_deformation_arr[:, :, 1],
+              result_deformation_arr[:, :, 0], inverse_deformation_arr[:, :, 1]]
+    cmaps = ['gray', 'gray', 'gray', 'viridis', 'viridis', 'viridis']
 
-    for i in range(5):
+    for i in range(6):
         plt.subplot(2, 3, i + 1)
         plt.imshow(images[i], cmap=cmaps[i], interpolation='none')
         plt.title(titles[i])
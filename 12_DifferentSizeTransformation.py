@@ -3,6 +3,7 @@ import time
 import numpy as np
 from matplotlib import pyplot as plt
 import SimpleITK as sitk
+import custom_functions as cf
 
 '''
 The process of image registration can be made faster, when smaller version of the fixed and moving images are used for 
@@ -80,6 +81,14 @@ if __name__ == "__main__":
     # Get the resulting image and transform parameters
     result_image_transformix = transformix_image_filter.GetResultImage()
 
+    # Often only a part of the result is needed. Instead of overriding Size and Spacing by hand, the output grid can be
+    # derived from a physical bounding box (in mm) and an output spacing; transformix then only evaluates that region.
+    # A coarse spacing gives a cheap preview of the whole image.
+    result_image_roi = cf.warpRegionOfInterest(moving_image_large, result_transform_parameters,
+                                               lower=[200, 200], upper=[600, 600], spacing=[1, 1])
+    result_image_preview = cf.warpRegionOfInterest(moving_image_large, result_transform_parameters, spacing=[20, 20])
+    print("Region of interest: {0}, preview: {1}".format(result_image_roi.GetSize(), result_image_preview.GetSize()))
+
 
     # Get arrays from images
     fixed_image_small_arr = sitk.GetArrayFromImage(fixed_image_small)
@@ -94,13 +103,15 @@ if __name__ == "__main__":
               "Moving image (small)",
               "Result image (small)",
               "Moving image (large)",
-              "Result image (large)"]
+              "Result image (large)",
+              "Result image (region of interest)"]
 
-    images = [fixed_image_small_arr, moving_image_small_arr, result_image_small_arr, moving_image_large_arr, result_image_large_arr]
+    images = [fixed_image_small_arr, moving_image_small_arr, result_image_small_arr, moving_image_large_arr,
+              result_image_large_arr, sitk.GetArrayFromImage(result_image_roi)]
 
-    cmaps = ['gray', 'gray', 'gray', 'gray', 'gray']
+    cmaps = ['gray', 'gray', 'gray', 'gray', 'gray', 'gray']
 
-    for i in range(5):
+    for i in range(6):
         plt.subplot(2, 3, i + 1)
         plt.imshow(images[i], cmap=cmaps[i], interpolation='none')
         plt.title(titles[i])
@@ -0,0 +1,62 @@
+import os
+import numpy as np
+import SimpleITK as sitk
+import custom_functions as cf
+
+'''
+A common use of image registration is to register many images to one reference image, the atlas. Examples are building
+population statistics or propagating an atlas segmentation to every new scan. The fixed side of such a registration
+(the atlas image, its mask and the parameter maps) is the same for every moving image, so it only needs to be loaded and
+validated once. The moving images can then be registered independently of each other, which means that they can be
+registered in parallel. The AtlasRegistration class in custom_functions.py does exactly that and returns the results as
+soon as they are finished, together with the time each registration took.
+
+Large 3D B-spline registrations can need more memory than is available when several run at the same time. With an
+AdmissionController, the peak memory of every job is estimated beforehand from the image sizes, pyramid levels, pixel
+types and B-spline grid. A job only starts when it fits next to the running jobs, and switches to "short" internal pixel
+types when it would not fit at all.
+'''
+
+if __name__ == "__main__":
+
+    # Get the path to working directory, input and output
+    path_to_working_directory = os.getcwd()
+    path_to_input = os.path.join(path_to_working_directory, 'data')
+    path_to_output = os.path.join(path_to_working_directory, 'output')
+
+    # Atlas image, its mask and the moving images. Any number of moving images can be added to the list.
+    fixed_image_name = "CT_3D_lung_fixed.mha"
+    fixed_mask_name = "CT_3D_lung_fixed_mask.mha"
+    moving_image_names = ["CT_3D_lung_moving.mha"]
+
+    # Set up the fixed side of the registration once
+    atlas_registration = cf.AtlasRegistration(os.path.join(path_to_input, fixed_image_name),
+                                              [sitk.GetDefaultParameterMap('rigid'),
+                                               sitk.GetDefaultParameterMap('bspline')],
+                                              fixed_mask=os.path.join(path_to_input, fixed_mask_name),
+                                              number_of_workers=2,
+                                              admission_controller=cf.AdmissionController())
+
+    # Estimated peak memory of a single job, with the number of threads the scheduler would give it
+    estimate = cf.estimateRegistrationMemory(atlas_registration.fixed_image,
+                                             os.path.join(path_to_input, moving_image_names[0]),
+                                             atlas_registration.parameter_maps,
+                                             number_of_threads=atlas_registration.scheduler.threadsFor(
+                                                 atlas_registration.fixed_image))
+    print("Estimated peak memory per registration: {0:.0f} MB".format(estimate['peak'] / 2 ** 20))
+
+    # Register all moving images, the results arrive in the order in which they finish. Every registration runs in its
+    # own scratch directory, only the result images are written (atomically) to the output folder.
+    print("Running elastix registrations... ")
+    os.makedirs(path_to_output, exist_ok=True)
+    moving_images = {name: os.path.join(path_to_input, name) for name in moving_image_names}
+    for result in atlas_registration.registerMany(moving_images):
+        if result.error is not None:
+            print("Registration of {0} failed: {1}".format(result.key, result.error))
+            continue
+
+        print("Registered {0} in {1:.1f} s".format(result.key, result.elapsed_time))
+        cf.atomicWrite(os.path.join(path_to_output, "result_" + result.key),
+                       lambda temporary_file_name: sitk.WriteImage(result.result_image, temporary_file_name))
+
+    print("Mean time per subject: {0:.1f} s".format(np.mean(atlas_registration.elapsed_times)))
@@ -0,0 +1,54 @@
+import os
+import numpy as np
+import SimpleITK as sitk
+import custom_functions as cf
+
+'''
+Example 09 showed that a segmentation can be moved from the moving image to the fixed image by transforming the mask
+with the transform found by elastix. Multi-atlas segmentation takes this one step further: a number of atlases (images
+with a known segmentation) are all registered to the target image and their warped segmentations are combined into one
+segmentation of the target. Errors of a single registration are then outvoted by the other atlases. The labels can be
+fused by:
+
+    majority voting:            every atlas has one vote per voxel
+    STAPLE:                     the votes are weighted by an estimate of the performance of each atlas
+    locally weighted voting:    the votes are weighted by how well the atlas matches the target around the voxel
+
+The fusion is done in chunks of slices, so the memory use stays bounded when the number of atlases grows.
+'''
+
+# MAIN FUNCTION
+if __name__ == "__main__":
+
+    # Get the path to working directory, input and output
+    path_to_working_directory = os.getcwd()
+    path_to_input = os.path.join(path_to_working_directory, 'data')
+    path_to_output = os.path.join(path_to_working_directory, 'output')
+
+    # Target image and its reference segmentation
+    target_image_name = "CT_3D_lung_fixed.mha"
+    target_mask_name = "CT_3D_lung_fixed_mask.mha"
+    result_image_name = "result_segmentation.mha"
+
+    # Atlas images and their segmentations. Only one atlas is available in the data folder, in practice 20-50 atlases
+    # are used.
+    atlas_image_names = ["CT_3D_lung_moving.mha"]
+    atlas_label_names = ["CT_3D_lung_moving_mask.mha"]
+
+    # Load the target image
+    target_image = sitk.ReadImage(os.path.join(path_to_input, target_image_name))
+    target_mask = sitk.ReadImage(os.path.join(path_to_input, target_mask_name))
+
+    # Register all atlases and fuse their labels
+    print("Running multi-atlas segmentation... ")
+    parameter_maps = [sitk.GetDefaultParameterMap('affine'), sitk.GetDefaultParameterMap('bspline')]
+    segmentation = cf.multiAtlasSegmentation(target_image,
+                                             [os.path.join(path_to_input, name) for name in atlas_image_names],
+                                             [os.path.join(path_to_input, name) for name in atlas_label_names],
+                                             parameter_maps, method='majority', number_of_workers=2)
+    sitk.WriteImage(segmentation, os.path.join(path_to_output, result_image_name))
+
+    # Compare the fused segmentation to the reference segmentation of the target
+    target_mask_np = sitk.GetArrayFromImage(target_mask).astype(int)
+    segmentation_np = (sitk.GetArrayFromImage(segmentation) > 0).astype(int)
+    print("Dice loss:", cf.diceCoefficient(target_mask_np, segmentation_np))
@@ -0,0 +1,49 @@
+import os
+import numpy as np
+import SimpleITK as sitk
+import custom_functions as cf
+
+'''
+The quality of a registration depends strongly on the parameter settings, for example the B-spline grid spacing, the
+number of spatial samples or the weights of the metrics in a multimetric registration. Instead of changing the
+parameter files by hand, a sweep can try many settings on a set of validation pairs with a known answer. Every setting
+is scored with the Dice coefficient of the warped masks, the error of the corresponding landmarks and the run time.
+
+Running every setting to the end is wasteful, because bad settings are usually recognizable after a few iterations. The
+sweep therefore uses successive halving: all settings run a small number of iterations, only the best third continues
+with three times more iterations, and so on, until the full number of iterations is reached.
+'''
+
+if __name__ == "__main__":
+
+    # Get the path to working directory, input and output
+    path_to_working_directory = os.getcwd()
+    path_to_input = os.path.join(path_to_working_directory, 'data')
+    path_to_output = os.path.join(path_to_working_directory, 'output')
+
+    # Validation pair with masks and corrected landmarks
+    fixed_point_set = np.loadtxt(os.path.join(path_to_input, 'CT_3D_lung_fixed_point_set_corrected.txt'),
+                                 skiprows=2, delimiter=' ')
+    moving_point_set = np.loadtxt(os.path.join(path_to_input, 'CT_3D_lung_moving_point_set_corrected.txt'),
+                                  skiprows=2, delimiter=' ')
+    validation_pairs = [cf.ValidationPair(os.path.join(path_to_input, "CT_3D_lung_fixed.mha"),
+                                          os.path.join(path_to_input, "CT_3D_lung_moving.mha"),
+                                          os.path.join(path_to_input, "CT_3D_lung_fixed_mask.mha"),
+                                          os.path.join(path_to_input, "CT_3D_lung_moving_mask.mha"),
+                                          fixed_point_set, moving_point_set)]
+
+    # Base parameter maps and the values to try
+    parameter_maps = [sitk.GetDefaultParameterMap('affine'),
+                      sitk.ReadParameterFile(os.path.join(path_to_input, 'parameters_BSpline.txt'))]
+    search_space = {(1, 'FinalGridSpacingInPhysicalUnits'): [8, 16, 32],
+                    (1, 'NumberOfSpatialSamples'): [1024, 2048, 4096],
+                    'NumberOfResolutions': [3, 4]}
+
+    # Run the sweep
+    print("Running parameter sweep... ")
+    ranking = cf.parameterSweep(parameter_maps, search_space, validation_pairs, minimum_iterations=50, eta=3,
+                                number_of_workers=2, output_directory=path_to_output)
+
+    for result in ranking[:5]:
+        print("score {0:.3f} after {1} iterations: {2}".format(result['score'], result['iterations'],
+                                                               result['configuration']))
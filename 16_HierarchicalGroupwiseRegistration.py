@@ -0,0 +1,40 @@
+import os
+import SimpleITK as sitk
+import custom_functions as cf
+
+'''
+Example 06 registers all frames of a series in one groupwise registration. The frames are optimized jointly in a single
+job, so a long series does not get faster with more cores. The hierarchical groupwise registration splits the series in
+sub-groups of consecutive frames that are registered groupwise in parallel. The mean image of every sub-group (its
+template) is then registered to the template of the middle sub-group, which brings all sub-groups into one frame of
+reference. A short groupwise registration of all frames together finally removes the remaining differences.
+'''
+
+if __name__ == "__main__":
+
+    # Get the path to working directory, input and output
+    path_to_working_directory = os.getcwd()
+    path_to_input = os.path.join(path_to_working_directory, 'data')
+    path_to_output = os.path.join(path_to_working_directory, 'output')
+
+    # Folder containing the image
+    folder_image_name = "00"
+    result_image_name = "result_image_hierarchical.mha"
+
+    # Load the frames through the DICOM index, as in example 06
+    os.makedirs(path_to_output, exist_ok=True)
+    dicom_index = cf.DicomIndex(os.path.join(path_to_output, 'dicom_index.sqlite'))
+    dicom_index.update(os.path.join(path_to_input, folder_image_name))
+    images = dicom_index.loadStack(next(iter(dicom_index.series())))
+    dicom_index.close()
+
+    # Run the registration in sub-groups of about four frames
+    print("Running hierarchical groupwise registration... ")
+    result_image, report = cf.hierarchicalGroupwiseRegistration(images, transform='EulerStackTransform', group_size=4)
+    sitk.WriteImage(result_image, os.path.join(path_to_output, result_image_name))
+
+    print("{0} sub-groups with {1} frames: {2:.1f} s".format(len(report['groups']),
+                                                            ", ".join(str(size) for size in report['groups']),
+                                                            report['subgroup_time']))
+    print("Template alignment: {0:.1f} s".format(report['template_time']))
+    print("Joint refinement: {0:.1f} s".format(report['refinement_time']))
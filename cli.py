@@ -0,0 +1,292 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+
+'''
+Command line entry point for the workflows of the examples: register, transform, jacobian, groupwise and points. Paths
+and parameter maps are given as arguments instead of being hard-coded. SimpleITK, NumPy and custom_functions are only
+imported when a command runs, so printing the help or parsing arguments does not pay for loading them.
+
+Short jobs spend a noticeable part of their time starting the interpreter and importing the heavy modules. The worker
+command therefore keeps a process resident with all modules loaded. It reads one job per line as JSON, either a list of
+arguments (["register", "--fixed", ...]) or {"command": ..., "arguments": [...]}, from stdin or from a local (unix)
+socket, and answers every job with one line of JSON.
+
+Examples:
+    python cli.py register --fixed data/CT_2D_head_fixed.mha --moving data/CT_2D_head_moving.mha -p rigid -p bspline
+    python cli.py transform --moving data/CT_2D_head_moving.mha -t output/TransformParameters.0.txt -o output
+    python cli.py worker --socket /tmp/elastix.sock
+'''
+
+
+# PARAMETER MAPS
+# A parameter argument is either the name of a default parameter map (translation, rigid, affine, bspline, spline,
+# groupwise) or the path to a parameter file.
+def loadParameterMaps(parameters):
+    import SimpleITK as sitk
+    return [sitk.ReadParameterFile(parameter) if os.path.exists(parameter) else sitk.GetDefaultParameterMap(parameter)
+            for parameter in parameters]
+
+
+def loadTransformParameterMaps(transform_parameter_files):
+    import SimpleITK as sitk
+    return [sitk.ReadParameterFile(file_name) for file_name in transform_parameter_files]
+
+
+# COMMANDS
+# Every command returns a dictionary with the files it wrote.
+def register(arguments):
+    import SimpleITK as sitk
+    import custom_functions as cf
+
+    elastix_image_filter = sitk.ElastixImageFilter()
+    elastix_image_filter.SetFixedImage(sitk.ReadImage(arguments.fixed))
+    elastix_image_filter.SetMovingImage(sitk.ReadImage(arguments.moving))
+    if arguments.fixed_mask:
+        elastix_image_filter.SetFixedMask(sitk.ReadImage(arguments.fixed_mask, sitk.sitkUInt8))
+    if arguments.moving_mask:
+        elastix_image_filter.SetMovingMask(sitk.ReadImage(arguments.moving_mask, sitk.sitkUInt8))
+    if arguments.initial_transform:
+        elastix_image_filter.SetInitialTransformParameterFileName(arguments.initial_transform)
+    cf._setParameterMaps(elastix_image_filter, loadParameterMaps(arguments.parameters))
+    if arguments.threads:
+        elastix_image_filter.SetNumberOfThreads(arguments.threads)
+    elastix_image_filter.LogToConsoleOff()
+    if arguments.log_to_file:
+        elastix_image_filter.LogToFileOn()
+
+    # Elastix writes into a scratch directory of its own (or the given work directory), only the results are moved to
+    # the output directory
+    with cf.RunDirectory('register_', arguments.output_directory, path=arguments.work_directory) as run:
+        elastix_image_filter.SetOutputDirectory(run.path)
+        elastix_image_filter.Execute()
+        return {'result_image': run.persistImage(elastix_image_filter.GetResultImage(), arguments.result_image_name),
+                'transform_parameters': run.persistParameterMaps(elastix_image_filter.GetTransformParameterMap())}
+
+
+def transform(arguments):
+    import SimpleITK as sitk
+    import custom_functions as cf
+
+    transformix_image_filter = sitk.TransformixImageFilter()
+    transformix_image_filter.SetMovingImage(sitk.ReadImage(arguments.moving))
+    cf._setTransformParameterMaps(transformix_image_filter, loadTransformParameterMaps(arguments.transform_parameters))
+    if arguments.label:
+        transformix_image_filter.SetTransformParameter('FinalBSplineInterpolationOrder', '0')
+    if arguments.threads:
+        transformix_image_filter.SetNumberOfThreads(arguments.threads)
+    transformix_image_filter.LogToConsoleOff()
+
+    with cf.RunDirectory('transform_', arguments.output_directory) as run:
+        transformix_image_filter.SetOutputDirectory(run.path)
+        transformix_image_filter.Execute()
+        return {'result_image': run.persistImage(transformix_image_filter.GetResultImage(),
+                                                 arguments.result_image_name)}
+
+
+def jacobian(arguments):
+    import numpy as np
+    import SimpleITK as sitk
+    import custom_functions as cf
+
+    transform_parameter_maps = loadTransformParameterMaps(arguments.transform_parameters)
+    if arguments.screen:
+        report = cf.screenFolding(transform_parameter_maps, threshold=arguments.threshold)
+        return {'folds': report['folds'], 'folded_voxels': report['folded_voxels'],
+                'evaluated_fraction': report['evaluated_fraction']}
+
+    displacement_field = cf.collapseToDisplacementField(transform_parameter_maps).GetDisplacementField()
+    determinant = cf.determinantOfSpatialJacobian(displacement_field)
+    os.makedirs(arguments.output_directory, exist_ok=True)
+    determinant_file = os.path.join(arguments.output_directory, 'spatialJacobian.nii')
+    cf.atomicWrite(determinant_file, lambda temporary_file_name: sitk.WriteImage(determinant, temporary_file_name))
+    return {'determinant': determinant_file,
+            'folded_voxels': int(np.sum(sitk.GetArrayViewFromImage(determinant) < 0))}
+
+
+def groupwise(arguments):
+    import SimpleITK as sitk
+    import custom_functions as cf
+
+    # Load all images of the folder as 2D images with a common origin, as in example 06
+    file_names = sorted(os.listdir(arguments.input_directory))
+    vector_of_images = sitk.VectorOfImage()
+    for file_name in file_names:
+        image = sitk.ReadImage(os.path.join(arguments.input_directory, file_name))
+        if image.GetDimension() == 3 and image.GetDepth() == 1:
+            image = sitk.Extract(image, (image.GetWidth(), image.GetHeight(), 0), (0, 0, 0))
+        vector_of_images.push_back(image)
+    for index in range(1, vector_of_images.size()):
+        vector_of_images[index].SetOrigin(vector_of_images[0].GetOrigin())
+    images = sitk.JoinSeries(vector_of_images)
+
+    elastix_image_filter = sitk.ElastixImageFilter()
+    elastix_image_filter.SetFixedImage(images)
+    elastix_image_filter.SetMovingImage(images)
+    elastix_image_filter.SetParameterMap(sitk.GetDefaultParameterMap('groupwise'))
+    if arguments.transform:
+        elastix_image_filter.SetParameter("Transform", arguments.transform)
+    if arguments.threads:
+        elastix_image_filter.SetNumberOfThreads(arguments.threads)
+    elastix_image_filter.LogToConsoleOff()
+
+    with cf.RunDirectory('groupwise_', arguments.output_directory) as run:
+        elastix_image_filter.SetOutputDirectory(run.path)
+        elastix_image_filter.Execute()
+        return {'result_image': run.persistImage(elastix_image_filter.GetResultImage(), arguments.result_image_name)}
+
+
+def points(arguments):
+    import numpy as np
+    import SimpleITK as sitk
+    import custom_functions as cf
+
+    reference_image = sitk.ReadImage(arguments.reference) if arguments.reference else None
+    fixed_points = cf.readPointSet(arguments.points, reference_image)
+    transform_parameter_maps = loadTransformParameterMaps(arguments.transform_parameters)
+    output_points = cf.transformPoints(cf.compositeTransform(transform_parameter_maps), fixed_points)
+
+    def write(file_name):
+        with open(file_name, 'w') as point_set_file:
+            point_set_file.write("point\n{0}\n".format(len(output_points)))
+            np.savetxt(point_set_file, output_points)
+
+    # Optionally compare with the points of transformix itself (the -def option)
+    outputs = {'points': arguments.output}
+    if arguments.check:
+        transformix_points = cf.transformixPoints(transform_parameter_maps, fixed_points)
+        outputs['max_deviation_from_transformix'] = float(np.max(np.linalg.norm(output_points - transformix_points,
+                                                                                axis=1)))
+        if outputs['max_deviation_from_transformix'] > arguments.check_tolerance:
+            raise RuntimeError("Points deviate {0} mm from transformix".format(
+                outputs['max_deviation_from_transformix']))
+
+    os.makedirs(os.path.dirname(os.path.abspath(arguments.output)), exist_ok=True)
+    cf.atomicWrite(arguments.output, write)
+    return outputs
+
+
+# ARGUMENT PARSER
+def createParser():
+    parser = argparse.ArgumentParser(description="Elastix and transformix workflows")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    register_parser = commands.add_parser('register', help="register a moving image to a fixed image")
+    register_parser.add_argument('--fixed', required=True)
+    register_parser.add_argument('--moving', required=True)
+    register_parser.add_argument('--fixed-mask')
+    register_parser.add_argument('--moving-mask')
+    register_parser.add_argument('-p', '--parameters', action='append', required=True,
+                                 help="default parameter map name or parameter file, may be repeated")
+    register_parser.add_argument('--initial-transform')
+    register_parser.add_argument('--result-image-name', default='result_image.mha')
+    register_parser.add_argument('--log-to-file', action='store_true', help="write elastix.log to the work directory")
+    register_parser.add_argument('--work-directory', help="directory for the elastix output instead of a scratch "
+                                                          "directory, it is not removed afterwards")
+    register_parser.set_defaults(function=register)
+
+    transform_parser = commands.add_parser('transform', help="apply transform parameters to an image")
+    transform_parser.add_argument('--moving', required=True)
+    transform_parser.add_argument('--label', action='store_true', help="nearest neighbour interpolation")
+    transform_parser.add_argument('--result-image-name', default='result_image.mha')
+    transform_parser.set_defaults(function=transform)
+
+    jacobian_parser = commands.add_parser('jacobian', help="determinant of the spatial jacobian of a transform")
+    jacobian_parser.add_argument('--screen', action='store_true', help="only screen for foldings")
+    jacobian_parser.add_argument('--threshold', type=float, default=0.2)
+    jacobian_parser.set_defaults(function=jacobian)
+
+    groupwise_parser = commands.add_parser('groupwise', help="groupwise registration of the images in a folder")
+    groupwise_parser.add_argument('--input-directory', required=True)
+    groupwise_parser.add_argument('--transform', help="for example EulerStackTransform")
+    groupwise_parser.add_argument('--result-image-name', default='result_image.mha')
+    groupwise_parser.set_defaults(function=groupwise)
+
+    points_parser = commands.add_parser('points', help="transform a point set from the fixed to the moving domain")
+    points_parser.add_argument('--points', required=True)
+    points_parser.add_argument('--reference', help="fixed image, needed for index point sets")
+    points_parser.add_argument('--output', required=True)
+    points_parser.add_argument('--check', action='store_true', help="compare with the output points of transformix")
+    points_parser.add_argument('--check-tolerance', type=float, default=1e-3, help="largest allowed deviation in mm")
+    points_parser.set_defaults(function=points)
+
+    # Arguments shared by several commands
+    for command_parser in (transform_parser, jacobian_parser, points_parser):
+        command_parser.add_argument('-t', '--transform-parameters', action='append', required=True,
+                                    help="transform parameter file, may be repeated to form a chain")
+    for command_parser in (register_parser, transform_parser, jacobian_parser, groupwise_parser):
+        command_parser.add_argument('-o', '--output-directory', default='output')
+    for command_parser in (register_parser, transform_parser, jacobian_parser, groupwise_parser, points_parser):
+        command_parser.add_argument('--threads', type=int)
+
+    worker_parser = commands.add_parser('worker', help="stay resident and run jobs from stdin or a socket")
+    worker_parser.add_argument('--socket', help="path of a unix socket to listen on instead of stdin")
+    return parser
+
+
+# WORKER
+# Every job is answered with exactly one line of JSON. Whatever argparse prints while parsing a job (the help, or the
+# usage and message of invalid arguments) is captured and returned as the error instead of being written to stdout.
+def runJob(parser, line):
+    start_time = time.perf_counter()
+    parser_output = io.StringIO()
+    try:
+        job = json.loads(line)
+        job_arguments = [job['command']] + list(job.get('arguments', [])) if isinstance(job, dict) else list(job)
+        if job_arguments and job_arguments[0] == 'worker':
+            raise ValueError("A worker cannot start another worker")
+        with contextlib.redirect_stdout(parser_output), contextlib.redirect_stderr(parser_output):
+            arguments = parser.parse_args(job_arguments)
+        response = {'status': 'ok', 'outputs': arguments.function(arguments)}
+    except SystemExit:
+        response = {'status': 'error', 'error': parser_output.getvalue().strip() or "invalid arguments"}
+    except Exception as error:
+        response = {'status': 'error', 'error': str(error)}
+    response['elapsed_time'] = time.perf_counter() - start_time
+    return json.dumps(response)
+
+
+def worker(parser, socket_path=None):
+
+    # Load the heavy modules once, every following job uses them directly
+    import numpy
+    import SimpleITK
+    import custom_functions
+
+    if socket_path is None:
+        for line in sys.stdin:
+            if line.strip():
+                print(runJob(parser, line), flush=True)
+        return
+
+    import socketserver
+
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if line.strip():
+                    self.wfile.write((runJob(parser, line.decode()) + "\n").encode())
+                    self.wfile.flush()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with socketserver.UnixStreamServer(socket_path, JobHandler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+
+# MAIN FUNCTION
+if __name__ == "__main__":
+
+    parser = createParser()
+    arguments = parser.parse_args()
+    if arguments.command == 'worker':
+        worker(parser, arguments.socket)
+    else:
+        print(json.dumps(arguments.function(arguments), indent=2))
@@ -1,6 +1,24 @@
 import os
+import sys
+import json
 import time
+import hashlib
+import collections
+import tempfile
+import threading
+import itertools
+import queue
+import contextlib
+import shutil
+import sqlite3
+import struct
+import socket
+import subprocess
+import concurrent.futures
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
 import warnings
+import zlib
 import numpy as np
 import SimpleITK as sitk
 
@@ -28,4 +46,3482 @@ def checkerboardImage(image_1, image_2, gridSize=20):
     mask = mask[0:image_1.shape[0], 0:image_1.shape[1]]
 
     # Combine both images to one
-    return image_1 * mask + image_2 * np.invert(mask)
\ No newline at end of file
+    return image_1 * mask + image_2 * np.invert(mask)
+
+# PARAMETER MAP HELPERS
+# SimpleITK hands parameter maps around as a single map, a tuple of maps or a VectorOfParameterMap. Internally they are
+# copied into a list of plain dictionaries so they can be modified without touching the originals.
+def _parameterMapList(parameter_maps):
+    if hasattr(parameter_maps, 'keys'):
+        parameter_maps = [parameter_maps]
+    return [{key: list(value) for key, value in parameter_map.items()} for parameter_map in parameter_maps]
+
+
+def _setParameterMaps(elastix_image_filter, parameter_maps):
+    parameter_maps = _parameterMapList(parameter_maps)
+    elastix_image_filter.SetParameterMap(parameter_maps[0])
+    for parameter_map in parameter_maps[1:]:
+        elastix_image_filter.AddParameterMap(parameter_map)
+
+
+def _setTransformParameterMaps(transformix_image_filter, transform_parameter_maps):
+    transform_parameter_maps = _parameterMapList(transform_parameter_maps)
+    transformix_image_filter.SetTransformParameterMap(transform_parameter_maps[0])
+    for transform_parameter_map in transform_parameter_maps[1:]:
+        transformix_image_filter.AddTransformParameterMap(transform_parameter_map)
+
+
+# MASK BOUNDING BOX
+# Bounding box of the non-zero voxels of a mask, grown by a margin in physical units (mm) and clipped to the image.
+# Returns the start index and the size of the box in voxels.
+def maskBoundingBox(mask, margin=10.0):
+
+    # Get the bounding box of all foreground voxels
+    label_statistics = sitk.LabelShapeStatisticsImageFilter()
+    label_statistics.Execute(sitk.Cast(mask != 0, sitk.sitkUInt8))
+    if not label_statistics.HasLabel(1):
+        raise ValueError("Mask does not contain any foreground voxels")
+    bounding_box = label_statistics.GetBoundingBox(1)
+    dimension = mask.GetDimension()
+    lower = np.array(bounding_box[:dimension])
+    upper = lower + np.array(bounding_box[dimension:])
+
+    # Grow the box by the margin and clip it to the image extent
+    margin_voxels = np.ceil(np.asarray(margin, dtype=float) / np.array(mask.GetSpacing())).astype(int)
+    lower = np.maximum(lower - margin_voxels, 0)
+    upper = np.minimum(upper + margin_voxels, mask.GetSize())
+    return [int(i) for i in lower], [int(s) for s in upper - lower]
+
+
+# CROP IMAGE TO MASK
+# RegionOfInterest keeps the physical position of every voxel (the origin of the cropped image is shifted), so the
+# cropped image and mask live in the same physical space as the originals.
+def cropToMask(image, mask, margin=10.0):
+
+    if image.GetSize() != mask.GetSize():
+        raise ValueError("Image and mask do not have the same dimensions")
+
+    index, size = maskBoundingBox(mask, margin)
+    cropped_image = sitk.RegionOfInterest(image, size, index)
+    cropped_mask = sitk.Cast(sitk.RegionOfInterest(mask, size, index) != 0, sitk.sitkUInt8)
+    return cropped_image, cropped_mask
+
+
+# SET TRANSFORM DOMAIN
+# Overwrite the output grid (Size, Index, Spacing, Origin, Direction) of transform parameter maps with the grid of a
+# reference image. The transform itself is defined in physical coordinates and is left untouched.
+def _setOutputGrid(transform_parameter_maps, size, origin, spacing, direction):
+    transform_parameter_maps = _parameterMapList(transform_parameter_maps)
+    for transform_parameter_map in transform_parameter_maps:
+        transform_parameter_map['Size'] = [str(int(s)) for s in size]
+        transform_parameter_map['Index'] = ['0'] * len(size)
+        transform_parameter_map['Spacing'] = [repr(float(s)) for s in spacing]
+        transform_parameter_map['Origin'] = [repr(float(o)) for o in origin]
+        transform_parameter_map['Direction'] = [repr(float(d)) for d in direction]
+    return transform_parameter_maps
+
+
+def setTransformDomain(transform_parameter_maps, reference_image):
+    return _setOutputGrid(transform_parameter_maps, reference_image.GetSize(), reference_image.GetOrigin(),
+                          reference_image.GetSpacing(), reference_image.GetDirection())
+
+
+# MASK CROPPED REGISTRATION
+# Crop the fixed and moving images to the bounding boxes of their masks (plus a margin), register the cropped images
+# and move the output grid of the resulting transform back to the full fixed image. Pyramids and samplers then only see
+# the region around the masks instead of the whole field of view. Note that a B-spline grid only covers the cropped
+# fixed region; outside of it only the preceding (linear) transforms act, which is why the margin should not be zero.
+def maskCroppedRegistration(fixed_image, moving_image, fixed_mask, moving_mask, parameter_maps, margin=10.0,
+                            output_directory=None):
+
+    # Crop both images and masks
+    fixed_image_cropped, fixed_mask_cropped = cropToMask(fixed_image, fixed_mask, margin)
+    moving_image_cropped, moving_mask_cropped = cropToMask(moving_image, moving_mask, margin)
+
+    # Register the cropped images
+    elastix_image_filter = sitk.ElastixImageFilter()
+    elastix_image_filter.SetFixedImage(fixed_image_cropped)
+    elastix_image_filter.SetMovingImage(moving_image_cropped)
+    elastix_image_filter.SetFixedMask(fixed_mask_cropped)
+    elastix_image_filter.SetMovingMask(moving_mask_cropped)
+    _setParameterMaps(elastix_image_filter, parameter_maps)
+    if output_directory is not None:
+        elastix_image_filter.SetOutputDirectory(output_directory)
+    elastix_image_filter.LogToConsoleOff()
+    elastix_image_filter.Execute()
+
+    # Shift the output grid back to the full fixed image
+    return setTransformDomain(elastix_image_filter.GetTransformParameterMap(), fixed_image)
+
+
+# IMAGE CONTENT HASH
+# Hash of the voxel data and the geometry of an image, used as key for caches of derived images.
+def imageContentHash(image):
+    content_hash = hashlib.sha1()
+    content_hash.update(repr((image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection(),
+                              image.GetPixelIDValue(), image.GetNumberOfComponentsPerPixel())).encode())
+    content_hash.update(np.ascontiguousarray(sitk.GetArrayViewFromImage(image)))
+    return content_hash.hexdigest()
+
+
+# INTENSITY PREPROCESSING
+# Cast an image to a common pixel type, clip its intensities (to a fixed range or to percentiles), optionally denoise it
+# with a Gaussian of the given sigma in mm and normalize it. The statistics are taken inside the mask when one is given.
+# Normalization is either 'zscore' (zero mean, unit variance), 'minmax' (range [0, 1]) or None.
+def preprocessImage(image, pixel_type=sitk.sitkFloat32, clip_range=None, clip_percentiles=(0.5, 99.5),
+                    normalization='zscore', denoise_sigma=None, mask=None):
+
+    if normalization not in ('zscore', 'minmax', None):
+        raise ValueError("Unknown normalization: {0}".format(normalization))
+
+    # Cast the image and get the intensities used for the statistics
+    image = sitk.Cast(image, pixel_type)
+    values = sitk.GetArrayViewFromImage(image)
+    if mask is not None:
+        values = values[sitk.GetArrayViewFromImage(mask) != 0]
+
+    # Clip the intensities
+    if clip_range is None and clip_percentiles is not None:
+        clip_range = np.percentile(values, clip_percentiles)
+    if clip_range is not None:
+        image = sitk.Clamp(image, pixel_type, float(clip_range[0]), float(clip_range[1]))
+        values = np.clip(values, clip_range[0], clip_range[1])
+
+    # Denoise
+    if denoise_sigma:
+        image = sitk.SmoothingRecursiveGaussian(image, denoise_sigma)
+
+    # Normalize the intensities
+    if normalization == 'zscore':
+        image = (image - float(np.mean(values))) / max(float(np.std(values)), 1e-12)
+    elif normalization == 'minmax':
+        low, high = float(np.min(values)), float(np.max(values))
+        image = (image - low) / max(high - low, 1e-12)
+    return sitk.Cast(image, pixel_type)
+
+
+# PREPROCESSED IMAGE CACHE
+# Keeps preprocessed fixed images, keyed by the content hash of the input image and the preprocessing settings.
+# Registering many moving images to one atlas then preprocesses the atlas once. The most recently used entries are kept
+# in memory; with a directory they are also stored on disk and survive between processes.
+class PreprocessedImageCache:
+
+    def __init__(self, directory=None, max_items=4):
+        self.directory = directory
+        self.max_items = max_items
+        self._items = collections.OrderedDict()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _key(self, image, settings):
+        return hashlib.sha1((imageContentHash(image) + repr(sorted(settings.items()))).encode()).hexdigest()
+
+    def _remember(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    # Preprocessed image, see preprocessImage for the keyword arguments
+    def preprocessed(self, image, **kwargs):
+        key = self._key(image, dict(kwargs, mask=None if kwargs.get('mask') is None else
+                                    imageContentHash(kwargs['mask'])))
+        if key not in self._items:
+            file_name = None if self.directory is None else os.path.join(self.directory, key + '.mha')
+            if file_name is not None and os.path.exists(file_name):
+                result = sitk.ReadImage(file_name)
+            else:
+                result = preprocessImage(image, **kwargs)
+                if file_name is not None:
+                    atomicWrite(file_name, lambda temporary_file_name: sitk.WriteImage(result, temporary_file_name))
+            self._remember(key, result)
+        self._items.move_to_end(key)
+        return self._items[key]
+
+
+# REGISTRATION RESULT
+# Result of a single registration job. The error field holds the exception of a failed job, in which case the image and
+# transform parameter maps are None.
+RegistrationResult = collections.namedtuple('RegistrationResult', ['key', 'result_image', 'transform_parameter_maps',
+                                                                 'elapsed_time', 'error'])
+
+
+def _readImage(image, pixel_type=sitk.sitkUnknown):
+    if isinstance(image, str):
+        return sitk.ReadImage(image, pixel_type)
+    return image
+
+
+def _sameGeometry(image_1, image_2, tolerance=1e-6):
+    return image_1.GetSize() == image_2.GetSize() and \
+        np.allclose(image_1.GetSpacing(), image_2.GetSpacing(), atol=tolerance) and \
+        np.allclose(image_1.GetOrigin(), image_2.GetOrigin(), atol=tolerance) and \
+        np.allclose(image_1.GetDirection(), image_2.GetDirection(), atol=tolerance)
+
+
+# ATLAS REGISTRATION
+# One-to-many registration: many moving images are registered to one fixed image (the atlas). The fixed image, its mask
+# and the parameter maps are loaded and validated once, after which a stream of moving images (images or file names) is
+# registered in parallel. Results are yielded as soon as they finish, each with the time it took.
+# With preprocessing (keyword arguments of preprocessImage) the atlas is preprocessed once through a
+# PreprocessedImageCache, which may be shared between instances (and processes, with a cache directory), and every
+# moving image is preprocessed with the same settings; the result images are then the warped preprocessed moving images.
+class AtlasRegistration:
+
+    def __init__(self, fixed_image, parameter_maps, fixed_mask=None, number_of_workers=None, number_of_threads=None,
+                 scheduler=None, admission_controller=None, preprocessing=None, cache=None):
+
+        # Load the fixed side
+        self.fixed_image = _readImage(fixed_image)
+        self.fixed_mask = None if fixed_mask is None else _readImage(fixed_mask)
+        self.parameter_maps = _parameterMapList(parameter_maps)
+
+        # Validate it once
+        if self.fixed_image.GetDimension() not in (2, 3):
+            raise ValueError("Fixed image must be 2D or 3D")
+        if not self.parameter_maps:
+            raise ValueError("At least one parameter map is required")
+        for parameter_map in self.parameter_maps:
+            if 'Transform' not in parameter_map:
+                raise ValueError("Parameter map does not define a Transform")
+        if self.fixed_mask is not None:
+            if not _sameGeometry(self.fixed_image, self.fixed_mask):
+                raise ValueError("Fixed image and fixed mask do not have the same geometry")
+            self.fixed_mask = sitk.Cast(self.fixed_mask != 0, sitk.sitkUInt8)
+            if not np.any(sitk.GetArrayViewFromImage(self.fixed_mask)):
+                raise ValueError("Fixed mask does not contain any foreground voxels")
+
+        # Preprocess the atlas once
+        self.preprocessing = preprocessing
+        if preprocessing is not None:
+            self.cache = cache or PreprocessedImageCache()
+            self.fixed_image = self.cache.preprocessed(self.fixed_image, mask=self.fixed_mask, **preprocessing)
+
+        # The scheduler splits the cores between the parallel jobs to avoid oversubscription, unless a fixed number of
+        # threads per job is given
+        self.scheduler = scheduler or ThreadScheduler()
+        self.number_of_workers = number_of_workers or max(1, self.scheduler.cpus // 4)
+        self.number_of_threads = number_of_threads
+        self.elapsed_times = []
+
+        # Optionally, jobs only start when their estimated memory fits next to the running jobs
+        self.admission_controller = admission_controller
+
+    # Register a single moving image to the atlas
+    def register(self, moving_image, moving_mask=None, key=None):
+
+        start_time = time.perf_counter()
+        # Scratch data in /dev/shm counts against the memory, so with admission control the scratch directory is on disk
+        scratch_root = tempfile.gettempdir() if self.admission_controller is not None else None
+        with RunDirectory('elastix_', scratch_root=scratch_root) as run_directory:
+            output_directory = run_directory.path
+            try:
+                moving_image = _readImage(moving_image)
+                if moving_image.GetDimension() != self.fixed_image.GetDimension():
+                    raise ValueError("Moving image {0} does not have the dimension of the fixed image".format(key))
+
+                if moving_mask is not None:
+                    moving_mask = sitk.Cast(_readImage(moving_mask) != 0, sitk.sitkUInt8)
+                if self.preprocessing is not None:
+                    moving_image = preprocessImage(moving_image, mask=moving_mask, **self.preprocessing)
+
+                elastix_image_filter = sitk.ElastixImageFilter()
+                elastix_image_filter.SetFixedImage(self.fixed_image)
+                elastix_image_filter.SetMovingImage(moving_image)
+                if self.fixed_mask is not None:
+                    elastix_image_filter.SetFixedMask(self.fixed_mask)
+                if moving_mask is not None:
+                    elastix_image_filter.SetMovingMask(moving_mask)
+                elastix_image_filter.SetOutputDirectory(output_directory)
+                elastix_image_filter.LogToConsoleOff()
+
+                # The memory estimate needs the number of threads, so it is chosen before the job is admitted. Elastix
+                # writes the full result image, so the untiled peak is reserved.
+                parameter_maps, admission = self.parameter_maps, contextlib.nullcontext()
+                number_of_threads = self.number_of_threads
+                if self.admission_controller is not None:
+                    number_of_threads = number_of_threads or self.scheduler.threadsFor(self.fixed_image)
+                    parameter_maps, plan = fitMemoryBudget(self.fixed_image, moving_image, self.parameter_maps,
+                                                           self.admission_controller.memory_budget,
+                                                           number_of_threads=number_of_threads, allow_tiles=False)
+                    admission = self.admission_controller.admit(plan['estimate']['peak'])
+                _setParameterMaps(elastix_image_filter, parameter_maps)
+                with admission, self.scheduler.allocate(self.fixed_image, elastix_image_filter,
+                                                        number_of_threads=number_of_threads):
+                    elastix_image_filter.Execute()
+
+                result = RegistrationResult(key, elastix_image_filter.GetResultImage(),
+                                            _parameterMapList(elastix_image_filter.GetTransformParameterMap()),
+                                            time.perf_counter() - start_time, None)
+            except Exception as error:
+                result = RegistrationResult(key, None, None, time.perf_counter() - start_time, error)
+
+        self.elapsed_times.append(result.elapsed_time)
+        return result
+
+    # Register a stream of moving images. The moving images are either a dictionary {key: image} or an iterable of
+    # images, in which case the key is the position in the stream. Moving masks are given the same way (or None). Only a
+    # limited number of jobs is queued at a time, so a lazy stream of file names is not read all at once.
+    def registerMany(self, moving_images, moving_masks=None):
+
+        if hasattr(moving_images, 'items'):
+            jobs = iter(moving_images.items())
+        else:
+            jobs = enumerate(moving_images)
+
+        with self.scheduler.pool(self.number_of_workers), \
+                concurrent.futures.ThreadPoolExecutor(self.number_of_workers) as executor:
+            pending = set()
+            for key, moving_image in jobs:
+                moving_mask = None if moving_masks is None else moving_masks[key]
+                pending.add(executor.submit(self.register, moving_image, moving_mask, key))
+                if len(pending) >= 2 * self.number_of_workers:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in concurrent.futures.as_completed(pending):
+                yield future.result()
+
+
+# WARP LABEL IMAGE
+# Apply a transform to a label image with nearest neighbour interpolation (FinalBSplineInterpolationOrder 0), so the
+# warped image only contains the original label values.
+def warpLabelImage(label_image, transform_parameter_maps, number_of_threads=None, scheduler=None):
+
+    with RunDirectory('transformix_') as run_directory:
+        output_directory = run_directory.path
+        transformix_image_filter = sitk.TransformixImageFilter()
+        transformix_image_filter.SetMovingImage(label_image)
+        _setTransformParameterMaps(transformix_image_filter, transform_parameter_maps)
+        transformix_image_filter.SetTransformParameter('FinalBSplineInterpolationOrder', '0')
+        transformix_image_filter.SetOutputDirectory(output_directory)
+        transformix_image_filter.LogToConsoleOff()
+        if scheduler is None:
+            if number_of_threads is not None:
+                transformix_image_filter.SetNumberOfThreads(number_of_threads)
+            transformix_image_filter.Execute()
+        else:
+            with scheduler.allocate(label_image, transformix_image_filter, number_of_threads=number_of_threads):
+                transformix_image_filter.Execute()
+        return transformix_image_filter.GetResultImage()
+
+
+# LABEL FUSION
+# The fusion functions below combine the warped labels of N atlases, given as an array of shape (N, ...) which may be a
+# memory map on disk. The volume is processed in chunks of chunk_size slices along the first array axis, so only
+# N x chunk_size slices are held in memory at a time, however large N becomes. The labels argument is the sorted array
+# of all label values that occur.
+def majorityVoteFusion(warped_labels, labels, chunk_size=16):
+
+    labels = np.asarray(labels)
+    fused = np.empty(warped_labels.shape[1:], dtype=labels.dtype)
+    for start in range(0, fused.shape[0], chunk_size):
+        chunk = np.asarray(warped_labels[:, start:start + chunk_size])
+
+        # Count the votes for every label and take the label with most votes
+        votes = np.empty((len(labels),) + chunk.shape[1:], dtype=np.uint16)
+        for label_index, label in enumerate(labels):
+            np.sum(chunk == label, axis=0, out=votes[label_index])
+        fused[start:start + chunk_size] = labels[np.argmax(votes, axis=0)]
+    return fused
+
+
+# Locally weighted voting: the vote of every atlas is weighted with the inverse of its local intensity error around the
+# voxel, (local_error + epsilon) ^ -power, so atlases that match the target well at a location count more there.
+def weightedVoteFusion(warped_labels, local_errors, labels, chunk_size=16, power=1.0, epsilon=1e-6):
+
+    labels = np.asarray(labels)
+    fused = np.empty(warped_labels.shape[1:], dtype=labels.dtype)
+    for start in range(0, fused.shape[0], chunk_size):
+        chunk = np.asarray(warped_labels[:, start:start + chunk_size])
+        weights = (np.asarray(local_errors[:, start:start + chunk_size], dtype=np.float32) + epsilon) ** -power
+
+        votes = np.empty((len(labels),) + chunk.shape[1:], dtype=np.float32)
+        for label_index, label in enumerate(labels):
+            np.sum(weights * (chunk == label), axis=0, out=votes[label_index])
+        fused[start:start + chunk_size] = labels[np.argmax(votes, axis=0)]
+    return fused
+
+
+# Multi-label STAPLE (Warfield et al. 2004, Rohlfing et al. 2004): an expectation-maximization estimate of the true
+# segmentation and of a confusion matrix per atlas, theta[j, m, l] = P(atlas j says m | true label l). Every iteration
+# makes one chunked pass over the volume that computes the label probabilities (E-step) and accumulates the new
+# confusion matrices (M-step); a last pass picks the most probable label for every voxel.
+def stapleFusion(warped_labels, labels, chunk_size=16, number_of_iterations=20, tolerance=1e-5):
+
+    labels = np.asarray(labels)
+    number_of_atlases, number_of_labels = warped_labels.shape[0], len(labels)
+
+    # Initial confusion matrices with a high sensitivity and global label frequencies as prior
+    theta = np.full((number_of_atlases, number_of_labels, number_of_labels), 0.05 / max(number_of_labels - 1, 1))
+    theta[:, np.arange(number_of_labels), np.arange(number_of_labels)] = 0.95
+    prior = np.zeros(number_of_labels)
+    for start in range(0, warped_labels.shape[1], chunk_size):
+        chunk = np.searchsorted(labels, np.asarray(warped_labels[:, start:start + chunk_size]))
+        prior += np.bincount(chunk.ravel(), minlength=number_of_labels)
+    prior /= prior.sum()
+
+    # Label probabilities of a chunk, shape (number_of_labels, number_of_voxels)
+    def labelProbabilities(chunk):
+        log_theta = np.log(np.maximum(theta, 1e-12))
+        log_probability = np.repeat(np.log(np.maximum(prior, 1e-12))[:, np.newaxis], chunk.shape[1], axis=1)
+        for atlas in range(number_of_atlases):
+            log_probability += log_theta[atlas][chunk[atlas]].T
+        log_probability -= log_probability.max(axis=0)
+        probability = np.exp(log_probability)
+        return probability / probability.sum(axis=0)
+
+    for iteration in range(number_of_iterations):
+        numerator = np.zeros_like(theta)
+        denominator = np.zeros(number_of_labels)
+        for start in range(0, warped_labels.shape[1], chunk_size):
+            chunk = np.searchsorted(labels, np.asarray(warped_labels[:, start:start + chunk_size]))
+            chunk = chunk.reshape(number_of_atlases, -1)
+            probability = labelProbabilities(chunk)
+            denominator += probability.sum(axis=1)
+            for atlas in range(number_of_atlases):
+                for label_index in range(number_of_labels):
+                    numerator[atlas, :, label_index] += np.bincount(chunk[atlas], weights=probability[label_index],
+                                                                    minlength=number_of_labels)
+        theta_new = numerator / np.maximum(denominator, 1e-12)
+        converged = np.max(np.abs(theta_new - theta)) < tolerance
+        theta = theta_new
+        if converged:
+            break
+
+    fused = np.empty(warped_labels.shape[1:], dtype=labels.dtype)
+    for start in range(0, fused.shape[0], chunk_size):
+        chunk = np.searchsorted(labels, np.asarray(warped_labels[:, start:start + chunk_size]))
+        probability = labelProbabilities(chunk.reshape(number_of_atlases, -1))
+        fused[start:start + chunk_size] = labels[np.argmax(probability, axis=0)].reshape(chunk.shape[1:])
+    return fused
+
+
+# MULTI ATLAS SEGMENTATION
+# Segment a target image by registering N atlases (images with label images) to it and fusing the warped labels with
+# 'majority' voting, 'staple' or locally 'weighted' voting. The registrations and label warps run in parallel. The
+# warped labels (and for weighted voting the local intensity errors) are stored in memory maps in a scratch directory,
+# so the memory use does not grow with the number of atlases. Atlases whose registration or label warp fails are left
+# out with a warning.
+def multiAtlasSegmentation(target_image, atlas_images, atlas_labels, parameter_maps, method='majority',
+                           target_mask=None, number_of_workers=None, chunk_size=16, patch_radius=2,
+                           scratch_directory=None):
+
+    if method not in ('majority', 'staple', 'weighted'):
+        raise ValueError("Unknown fusion method: {0}".format(method))
+    if len(atlas_images) != len(atlas_labels):
+        raise ValueError("Number of atlas images and atlas label images differ")
+
+    target_image = _readImage(target_image)
+    atlas_registration = AtlasRegistration(target_image, parameter_maps, fixed_mask=target_mask,
+                                           number_of_workers=number_of_workers)
+    target_float = sitk.Cast(target_image, sitk.sitkFloat32)
+    shape = sitk.GetArrayViewFromImage(target_image).shape
+
+    # The memory maps are kept on disk (not in /dev/shm), so the memory use stays bounded
+    with RunDirectory('label_fusion_', scratch_root=scratch_directory or tempfile.gettempdir()) as run_directory:
+        scratch_directory = run_directory.path
+        warped_labels = np.lib.format.open_memmap(os.path.join(scratch_directory, 'labels.npy'), mode='w+',
+                                                  dtype=np.uint16, shape=(len(atlas_images),) + shape)
+        local_errors = None
+        if method == 'weighted':
+            local_errors = np.lib.format.open_memmap(os.path.join(scratch_directory, 'errors.npy'), mode='w+',
+                                                     dtype=np.float32, shape=(len(atlas_images),) + shape)
+
+        # Register one atlas, warp its labels and compute the local intensity error to the target. Successful atlases
+        # are stored in consecutive slots, so the fusion can work on a view of the memory maps.
+        slot_lock = threading.Lock()
+        number_of_valid = [0]
+
+        def atlasJob(index):
+            result = atlas_registration.register(atlas_images[index], key=index)
+            if result.error is not None:
+                return index, result.error
+            try:
+                label_image = sitk.Cast(_readImage(atlas_labels[index]), sitk.sitkUInt16)
+                warped_label_image = warpLabelImage(label_image, result.transform_parameter_maps,
+                                                    atlas_registration.number_of_threads, atlas_registration.scheduler)
+            except Exception as error:
+                return index, error
+            with slot_lock:
+                slot = number_of_valid[0]
+                number_of_valid[0] += 1
+            warped_labels[slot] = np.rint(sitk.GetArrayViewFromImage(warped_label_image))
+            if local_errors is not None:
+                difference = sitk.Square(target_float - sitk.Cast(result.result_image, sitk.sitkFloat32))
+                local_errors[slot] = sitk.GetArrayViewFromImage(sitk.Mean(difference, [patch_radius] * len(shape)))
+            return index, None
+
+        with atlas_registration.scheduler.pool(atlas_registration.number_of_workers), \
+                concurrent.futures.ThreadPoolExecutor(atlas_registration.number_of_workers) as executor:
+            for index, error in executor.map(atlasJob, range(len(atlas_images))):
+                if error is not None:
+                    warnings.warn("Atlas {0} failed: {1}".format(index, error))
+        if number_of_valid[0] == 0:
+            raise RuntimeError("All atlas registrations failed")
+
+        # All labels that occur in the warped atlases
+        valid_labels = warped_labels[:number_of_valid[0]]
+        labels = np.unique(np.concatenate([np.unique(warped_labels[slot]) for slot in range(number_of_valid[0])]))
+
+        # Fuse the labels
+        if method == 'majority':
+            fused = majorityVoteFusion(valid_labels, labels, chunk_size)
+        elif method == 'staple':
+            fused = stapleFusion(valid_labels, labels, chunk_size)
+        else:
+            fused = weightedVoteFusion(valid_labels, local_errors[:number_of_valid[0]], labels, chunk_size)
+
+        segmentation = sitk.GetImageFromArray(fused)
+        segmentation.CopyInformation(target_image)
+        del warped_labels, local_errors, valid_labels
+        return segmentation
+
+
+# ELASTIX TRANSFORM PARAMETER MAPS TO SIMPLEITK TRANSFORMS
+# Elastix transform parameter maps are converted to SimpleITK transforms so they can be evaluated, combined and
+# resampled with directly. A list of maps [T0, T1, T2] as returned by GetTransformParameterMap is a chain in which every
+# map uses the previous one as initial transform (HowToCombineTransforms "Compose"), so a fixed point x is mapped to
+# T2(T1(T0(x))): the first map acts on the fixed points, every later map on the output of the maps before it. A
+# SimpleITK CompositeTransform applies the transform that was added last first, so the maps are added in reverse order.
+LINEAR_TRANSFORMS = ('TranslationTransform', 'EulerTransform', 'SimilarityTransform', 'AffineTransform')
+BSPLINE_TRANSFORMS = ('BSplineTransform', 'RecursiveBSplineTransform')
+
+
+def _floats(parameter_map, key, default=None):
+    if key not in parameter_map:
+        return default
+    return [float(value) for value in parameter_map[key]]
+
+
+def _expandInitialTransforms(transform_parameter_maps):
+
+    # Prepend the initial transforms that the first map refers to by file name
+    transform_parameter_maps = _parameterMapList(transform_parameter_maps)
+    while transform_parameter_maps:
+        file_name = transform_parameter_maps[0].get('InitialTransformParametersFileName', ['NoInitialTransform'])[0]
+        if file_name == 'NoInitialTransform':
+            break
+        transform_parameter_maps[0]['InitialTransformParametersFileName'] = ['NoInitialTransform']
+        transform_parameter_maps.insert(0, _parameterMapList(sitk.ReadParameterFile(file_name))[0])
+
+    for transform_parameter_map in transform_parameter_maps[1:]:
+        if transform_parameter_map.get('HowToCombineTransforms', ['Compose'])[0] != 'Compose':
+            raise ValueError("Only transforms combined with HowToCombineTransforms \"Compose\" are supported")
+    return transform_parameter_maps
+
+
+def transformFromParameterMap(transform_parameter_map):
+
+    name = transform_parameter_map['Transform'][0]
+    parameters = _floats(transform_parameter_map, 'TransformParameters')
+    center = _floats(transform_parameter_map, 'CenterOfRotationPoint')
+
+    if name in BSPLINE_TRANSFORMS:
+        grid_size = [int(size) for size in transform_parameter_map['GridSize']]
+        dimension = len(grid_size)
+        grid_spacing = np.array(_floats(transform_parameter_map, 'GridSpacing'))
+        grid_direction = np.array(_floats(transform_parameter_map, 'GridDirection',
+                                          list(np.eye(dimension).ravel()))).reshape(dimension, dimension)
+        grid_index = np.array(_floats(transform_parameter_map, 'GridIndex', [0.0] * dimension))
+        grid_origin = np.array(_floats(transform_parameter_map, 'GridOrigin')) + \
+            grid_direction.dot(grid_spacing * grid_index)
+        order = int(transform_parameter_map.get('BSplineTransformSplineOrder', ['3'])[0])
+
+        transform = sitk.BSplineTransform(dimension, order)
+        transform.SetFixedParameters(grid_size + list(grid_origin) + list(grid_spacing) + list(grid_direction.ravel()))
+        transform.SetParameters(parameters)
+        return transform
+
+    dimension = len(center) if center is not None else len(parameters)
+    if name == 'TranslationTransform':
+        return sitk.TranslationTransform(len(parameters), parameters)
+    elif name == 'EulerTransform' and dimension == 2:
+        transform = sitk.Euler2DTransform()
+    elif name == 'EulerTransform' and dimension == 3:
+        transform = sitk.Euler3DTransform()
+        transform.SetComputeZYX(transform_parameter_map.get('ComputeZYX', ['false'])[0] == 'true')
+    elif name == 'SimilarityTransform' and dimension == 2:
+        transform = sitk.Similarity2DTransform()
+    elif name == 'SimilarityTransform' and dimension == 3:
+        transform = sitk.Similarity3DTransform()
+    elif name == 'AffineTransform':
+        transform = sitk.AffineTransform(dimension)
+    else:
+        raise ValueError("Transform {0} is not supported".format(name))
+    transform.SetCenter(center)
+    transform.SetParameters(parameters)
+    return transform
+
+
+def transformsFromParameterMaps(transform_parameter_maps):
+    return [transformFromParameterMap(transform_parameter_map)
+            for transform_parameter_map in _expandInitialTransforms(transform_parameter_maps)]
+
+
+def _compositeFromTransforms(transforms):
+    composite_transform = sitk.CompositeTransform(transforms[0].GetDimension())
+    for transform in reversed(transforms):
+        composite_transform.AddTransform(transform)
+    return composite_transform
+
+
+def compositeTransform(transform_parameter_maps):
+    return _compositeFromTransforms(transformsFromParameterMaps(transform_parameter_maps))
+
+
+# MERGE LINEAR TRANSFORMS
+# Every linear transform is x -> A x + b and is found by mapping the origin and the unit vectors. Consecutive linear
+# transforms in a chain multiply into one homogeneous matrix (the later transform on the left, M_next M_prev) and are
+# replaced by a single AffineTransform.
+def _isLinear(transform):
+    return transform.GetName() in ('TranslationTransform', 'Euler2DTransform', 'Euler3DTransform',
+                                   'Similarity2DTransform', 'Similarity3DTransform', 'AffineTransform',
+                                   'VersorRigid3DTransform', 'ScaleTransform')
+
+
+def homogeneousMatrix(transform):
+    dimension = transform.GetDimension()
+    offset = np.array(transform.TransformPoint([0.0] * dimension))
+    matrix = np.eye(dimension + 1)
+    for axis in range(dimension):
+        matrix[:dimension, axis] = np.array(transform.TransformPoint(list(np.eye(dimension)[axis]))) - offset
+    matrix[:dimension, dimension] = offset
+    return matrix
+
+
+def _affineFromHomogeneous(matrix):
+    dimension = matrix.shape[0] - 1
+    return sitk.AffineTransform(list(matrix[:dimension, :dimension].ravel()), list(matrix[:dimension, dimension]))
+
+
+def mergeLinearTransforms(transforms):
+    merged = []
+    for transform in transforms:
+        if _isLinear(transform) and merged and _isLinear(merged[-1]):
+            merged[-1] = _affineFromHomogeneous(homogeneousMatrix(transform).dot(homogeneousMatrix(merged[-1])))
+        else:
+            merged.append(transform)
+    return merged
+
+
+# Same for elastix transform parameter maps: runs of linear maps are replaced by one AffineTransform map, so transformix
+# evaluates a single matrix instead of the whole run.
+def mergeLinearParameterMaps(transform_parameter_maps):
+
+    merged = []
+    for transform_parameter_map in _expandInitialTransforms(transform_parameter_maps):
+        if transform_parameter_map['Transform'][0] in LINEAR_TRANSFORMS and merged and \
+                merged[-1]['Transform'][0] in LINEAR_TRANSFORMS:
+            matrix = homogeneousMatrix(transformFromParameterMap(transform_parameter_map)).dot(
+                homogeneousMatrix(transformFromParameterMap(merged[-1])))
+            dimension = matrix.shape[0] - 1
+
+            affine_map = dict(transform_parameter_map)
+            for key in ('ComputeZYX', 'Scales'):
+                affine_map.pop(key, None)
+            affine_map['Transform'] = ['AffineTransform']
+            affine_map['NumberOfParameters'] = [str(dimension * (dimension + 1))]
+            affine_map['TransformParameters'] = [repr(float(value)) for value in
+                                                 list(matrix[:dimension, :dimension].ravel()) +
+                                                 list(matrix[:dimension, dimension])]
+            affine_map['CenterOfRotationPoint'] = ['0.0'] * dimension
+            affine_map['InitialTransformParametersFileName'] = ['NoInitialTransform']
+            merged[-1] = affine_map
+        else:
+            merged.append(transform_parameter_map)
+    return merged
+
+
+# OUTPUT GRID OF A TRANSFORM PARAMETER MAP
+def _gridFromParameterMap(transform_parameter_map):
+    size = [int(size) for size in transform_parameter_map['Size']]
+    dimension = len(size)
+    spacing = np.array(_floats(transform_parameter_map, 'Spacing'))
+    direction = np.array(_floats(transform_parameter_map, 'Direction',
+                                 list(np.eye(dimension).ravel()))).reshape(dimension, dimension)
+    index = np.array(_floats(transform_parameter_map, 'Index', [0.0] * dimension))
+    origin = np.array(_floats(transform_parameter_map, 'Origin')) + direction.dot(spacing * index)
+    return size, list(origin), list(spacing), list(direction.ravel())
+
+
+def _gridFromImage(image):
+    return list(image.GetSize()), list(image.GetOrigin()), list(image.GetSpacing()), list(image.GetDirection())
+
+
+# COLLAPSE TO DISPLACEMENT FIELD
+# Evaluate the whole chain once on the output grid (of a reference image, or of the last parameter map) and return it as
+# one DisplacementFieldTransform.
+def collapseToDisplacementField(transform_parameter_maps, reference_image=None):
+
+    transform_parameter_maps = _expandInitialTransforms(transform_parameter_maps)
+    composite_transform = _compositeFromTransforms(mergeLinearTransforms(
+        [transformFromParameterMap(transform_parameter_map) for transform_parameter_map in transform_parameter_maps]))
+
+    if reference_image is None:
+        size, origin, spacing, direction = _gridFromParameterMap(transform_parameter_maps[-1])
+    else:
+        size, origin, spacing, direction = _gridFromImage(reference_image)
+    displacement_field = sitk.TransformToDisplacementField(composite_transform, sitk.sitkVectorFloat64, size, origin,
+                                                           spacing, direction)
+    return sitk.DisplacementFieldTransform(displacement_field)
+
+
+# CUBIC B-SPLINE PREFILTER
+# Coefficients of the cubic B-spline that interpolates the samples along one axis (Unser 1993, mirror boundaries).
+def _cubicBSplinePrefilter(samples, axis):
+
+    pole = np.sqrt(3.0) - 2.0
+    coefficients = np.moveaxis(np.array(samples, dtype=float) * 6.0, axis, 0)
+    length = coefficients.shape[0]
+    if length == 1:
+        return np.moveaxis(coefficients / 6.0, 0, axis)
+
+    # Causal initialization and recursion
+    horizon = min(length, int(np.ceil(np.log(1e-12) / np.log(abs(pole)))))
+    powers = pole ** np.arange(horizon)
+    coefficients[0] = np.tensordot(powers, coefficients[:horizon], axes=1)
+    for index in range(1, length):
+        coefficients[index] += pole * coefficients[index - 1]
+
+    # Anti-causal initialization and recursion
+    coefficients[-1] = (pole / (pole * pole - 1.0)) * (pole * coefficients[-2] + coefficients[-1])
+    for index in range(length - 2, -1, -1):
+        coefficients[index] = pole * (coefficients[index + 1] - coefficients[index])
+    return np.moveaxis(coefficients, 0, axis)
+
+
+# COLLAPSE TO B-SPLINE
+# Refit the whole chain with one cubic B-spline transform with the given control point spacing (mm) on the output grid.
+# The displacement of the chain is sampled at the control points and the coefficients are chosen such that the B-spline
+# interpolates these samples. Smooth chains are represented well; details smaller than the grid spacing are lost.
+def collapseToBSpline(transform_parameter_maps, grid_spacing, reference_image=None):
+
+    transform_parameter_maps = _expandInitialTransforms(transform_parameter_maps)
+    composite_transform = _compositeFromTransforms(mergeLinearTransforms(
+        [transformFromParameterMap(transform_parameter_map) for transform_parameter_map in transform_parameter_maps]))
+
+    # Without a reference image, a single voxel image with the physical extent of the output grid is used, so the full
+    # grid does not have to be allocated
+    if reference_image is None:
+        size, origin, spacing, direction = _gridFromParameterMap(transform_parameter_maps[-1])
+        reference_image = sitk.Image([1] * len(size), sitk.sitkUInt8)
+        reference_image.SetSpacing([sp * sz for sp, sz in zip(spacing, size)])
+        reference_image.SetOrigin(list(np.array(origin) + 0.5 * np.array(direction).reshape(len(size), -1).dot(
+            np.array(spacing) * (np.array(size) - 1))))
+        reference_image.SetDirection(direction)
+
+    # Control point grid covering the reference image
+    dimension = reference_image.GetDimension()
+    physical_size = np.array(reference_image.GetSize()) * np.array(reference_image.GetSpacing())
+    mesh_size = [max(1, int(np.ceil(extent / grid_spacing))) for extent in physical_size]
+    bspline_transform = sitk.BSplineTransformInitializer(reference_image, mesh_size, 3)
+    fixed_parameters = np.array(bspline_transform.GetFixedParameters())
+    grid_size = [int(size) for size in fixed_parameters[:dimension]]
+    grid_origin = fixed_parameters[dimension:2 * dimension]
+    grid_spacing = fixed_parameters[2 * dimension:3 * dimension]
+    grid_direction = fixed_parameters[3 * dimension:].reshape(dimension, dimension)
+
+    # Displacement of the chain at every control point, in numpy (z, y, x) order
+    indices = np.indices(grid_size[::-1]).reshape(dimension, -1)[::-1].T
+    points = grid_origin + (indices * grid_spacing).dot(grid_direction.T)
+    displacements = np.array([composite_transform.TransformPoint(list(point)) for point in points]) - points
+
+    # Interpolating coefficients of every displacement component
+    coefficients = []
+    for component in range(dimension):
+        samples = displacements[:, component].reshape(grid_size[::-1])
+        for axis in range(dimension):
+            samples = _cubicBSplinePrefilter(samples, axis)
+        coefficients.append(samples.ravel())
+    bspline_transform.SetParameters(list(np.concatenate(coefficients)))
+    return bspline_transform
+
+
+# COLLAPSED TRANSFORM CACHE
+# Collapsed transforms keyed by the content of the transform parameter maps, the kind of collapse and the output grid,
+# so a chain that is used for many warps is collapsed once. With a directory the transforms are also written to disk.
+class CollapsedTransformCache:
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._transforms = {}
+        self.reports = {}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, transform_parameter_maps, kind, *settings):
+        content = repr([sorted(transform_parameter_map.items()) for transform_parameter_map in
+                        _parameterMapList(transform_parameter_maps)]) + kind + repr(settings)
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def _get(self, key, collapse):
+        if key not in self._transforms:
+            file_name = None if self.directory is None else os.path.join(self.directory, key + '.h5')
+            if file_name is not None and os.path.exists(file_name):
+                self._transforms[key] = sitk.ReadTransform(file_name).Downcast()
+            else:
+                self._transforms[key] = collapse()
+                if file_name is not None:
+                    atomicWrite(file_name, lambda temporary_file_name: sitk.WriteTransform(self._transforms[key],
+                                                                                           temporary_file_name))
+        return self._transforms[key]
+
+    def displacementField(self, transform_parameter_maps, reference_image=None):
+        grid = None if reference_image is None else _gridFromImage(reference_image)
+        key = self.key(transform_parameter_maps, 'field', grid)
+        return self._get(key, lambda: collapseToDisplacementField(transform_parameter_maps, reference_image))
+
+    def bspline(self, transform_parameter_maps, grid_spacing, reference_image=None):
+        grid = None if reference_image is None else _gridFromImage(reference_image)
+        key = self.key(transform_parameter_maps, 'bspline', grid_spacing, grid)
+        return self._get(key, lambda: collapseToBSpline(transform_parameter_maps, grid_spacing, reference_image))
+
+    # The inverse is cached next to the forward transform, together with its residual report
+    def inverse(self, transform_parameter_maps, reference_image=None, **kwargs):
+        grid = None if reference_image is None else _gridFromImage(reference_image)
+        key = self.key(transform_parameter_maps, 'inverse', grid, sorted(kwargs.items()))
+        report_file_name = None if self.directory is None else os.path.join(self.directory, key + '.json')
+
+        def invert():
+            inverse_transform, report = invertTransform(transform_parameter_maps, reference_image, **kwargs)
+            self.reports[key] = report
+            if report_file_name is not None:
+                _writeJson(report_file_name, report)
+            return inverse_transform
+
+        inverse_transform = self._get(key, invert)
+        if key not in self.reports and report_file_name is not None and os.path.exists(report_file_name):
+            with open(report_file_name) as report_file:
+                self.reports[key] = json.load(report_file)
+        return inverse_transform, self.reports.get(key)
+
+
+# WARP IMAGE
+# Resample an image with a single (collapsed) SimpleITK transform onto the grid of a reference image.
+def warpImage(image, transform, reference_image, interpolator=sitk.sitkLinear, default_value=0.0):
+    return sitk.Resample(image, reference_image, transform, interpolator, default_value)
+
+
+# WARP IMAGES
+# Warp several images that share the moving grid (channels, masks, slices of a stack) with the same transform. The
+# transform (SimpleITK transform or transform parameter maps) is evaluated once per output voxel, after which all
+# channels are interpolated at the same coordinates: linearly, or with nearest neighbour for the label channels. The
+# images are given as a list, a vector image (one channel per component) or an image with one more dimension than the
+# reference image (one channel per slice of the last axis), and returned in the same form. The output grid is that of
+# the reference image, or of the last parameter map (a reference image is required for a SimpleITK transform). Points
+# mapped outside the moving image get the default value. The work is done in chunks of slices to bound the memory of the
+# coordinates.
+def warpImages(images, transform, reference_image=None, label_channels=(), default_value=0.0, chunk_size=16):
+
+    # Output grid
+    if reference_image is not None:
+        size, origin, spacing, direction = _gridFromImage(reference_image)
+    elif isinstance(transform, sitk.Transform):
+        raise ValueError("A reference image is needed when the transform is a sitk.Transform")
+    else:
+        size, origin, spacing, direction = _gridFromParameterMap(_parameterMapList(transform)[-1])
+    if not isinstance(transform, sitk.Transform):
+        transform = compositeTransform(transform)
+
+    # Stack the channels into one (z, y, x, channels) array
+    if isinstance(images, sitk.Image):
+        if images.GetNumberOfComponentsPerPixel() > 1:
+            form, moving_grid = 'vector', images
+            channels = sitk.GetArrayFromImage(images).astype(np.float32)
+        else:
+            form = 'stack'
+            moving_grid = sitk.Extract(images, list(images.GetSize()[:-1]) + [0], [0] * images.GetDimension())
+            channels = np.moveaxis(sitk.GetArrayFromImage(images).astype(np.float32), 0, -1)
+        pixel_types = [images.GetPixelID()]
+    else:
+        form, moving_grid = 'list', images[0]
+        for image in images[1:]:
+            if not _sameGeometry(moving_grid, image):
+                raise ValueError("All images must have the same geometry")
+        channels = np.stack([sitk.GetArrayViewFromImage(image).astype(np.float32) for image in images], axis=-1)
+        pixel_types = [image.GetPixelID() for image in images]
+    number_of_channels = channels.shape[-1]
+    _, moving_origin, moving_spacing, moving_direction = _gridFromImage(moving_grid)
+
+    linear = np.array([channel not in label_channels for channel in range(number_of_channels)])
+    linear_channels, nearest_channels = channels[..., linear], channels[..., ~linear]
+    del channels
+    moving_shape = np.array(linear_channels.shape[:-1][::-1])
+    output = np.empty(list(size[::-1]) + [number_of_channels], dtype=np.float32)
+    for start in range(0, size[-1], chunk_size):
+        points = transformPoints(transform, _gridPoints(size, origin, spacing, direction, start, start + chunk_size))
+        continuous_index = _physicalToIndex(points, moving_origin, moving_spacing, moving_direction)
+        inside = np.all((continuous_index >= -0.5) & (continuous_index <= moving_shape - 0.5), axis=1)
+
+        values = np.empty((len(points), number_of_channels), dtype=np.float32)
+        if np.any(linear):
+            values[:, linear] = _interpolateLinear(linear_channels, continuous_index)
+        if not np.all(linear):
+            nearest = np.clip(np.rint(continuous_index).astype(int), 0, moving_shape - 1)
+            values[:, ~linear] = nearest_channels[tuple(nearest[:, axis] for axis in range(len(size) - 1, -1, -1))]
+        values[~inside] = default_value
+        output[start:start + chunk_size] = values.reshape(output[start:start + chunk_size].shape)
+
+    def toImage(array, pixel_type, is_vector=False):
+        if pixel_type not in (sitk.sitkFloat32, sitk.sitkFloat64, sitk.sitkVectorFloat32, sitk.sitkVectorFloat64):
+            array = np.rint(array)
+        image = sitk.Cast(sitk.GetImageFromArray(array, isVector=is_vector), pixel_type)
+        image.SetOrigin(origin)
+        image.SetSpacing(spacing)
+        image.SetDirection(direction)
+        return image
+
+    if form == 'list':
+        return [toImage(output[..., channel], pixel_types[channel]) for channel in range(number_of_channels)]
+    if form == 'vector':
+        return toImage(output, pixel_types[0], True)
+    result_images = [toImage(output[..., channel], pixel_types[0]) for channel in range(number_of_channels)]
+    return sitk.JoinSeries(result_images, images.GetOrigin()[-1], images.GetSpacing()[-1])
+
+
+# LINEAR INTERPOLATION
+# Multilinear interpolation of a numpy array (in numpy (z, y, x) order, optionally with a trailing component axis) at
+# continuous indices given in (x, y, z) order, shape (n, dimension). Points outside the array take the value at the
+# nearest edge. Returns an array of shape (n,) or (n, components).
+def _interpolateLinear(array, continuous_index):
+
+    dimension = continuous_index.shape[1]
+    shape = np.array(array.shape[:dimension][::-1])
+    continuous_index = np.clip(continuous_index, 0, shape - 1)
+    lower = np.minimum(np.floor(continuous_index).astype(int), np.maximum(shape - 2, 0))
+    fraction = continuous_index - lower
+
+    result = 0
+    for corner in range(2 ** dimension):
+        offset = np.array([(corner >> axis) & 1 for axis in range(dimension)])
+        index = np.minimum(lower + offset, shape - 1)
+        weight = np.prod(np.where(offset, fraction, 1.0 - fraction), axis=1)
+        values = array[tuple(index[:, axis] for axis in range(dimension - 1, -1, -1))]
+        result = result + (weight[:, np.newaxis] * values if values.ndim > 1 else weight * values)
+    return result
+
+
+def _physicalToIndex(points, origin, spacing, direction):
+    dimension = len(origin)
+    direction = np.array(direction).reshape(dimension, dimension)
+    return (points - np.array(origin)).dot(np.linalg.inv(direction).T) / np.array(spacing)
+
+
+def _gridPoints(size, origin, spacing, direction, start=0, stop=None):
+
+    # Physical points of the grid voxels with numpy index [start:stop] along the first (slowest) axis
+    dimension = len(size)
+    shape = list(size[::-1])
+    stop = shape[0] if stop is None else min(stop, shape[0])
+    indices = np.indices([stop - start] + shape[1:]).reshape(dimension, -1)
+    indices[0] += start
+    indices = indices[::-1].T
+    direction = np.array(direction).reshape(dimension, dimension)
+    return np.array(origin) + (indices * np.array(spacing)).dot(direction.T)
+
+
+# INVERT LINEAR TRANSFORM
+def invertLinearTransform(transform):
+    return _affineFromHomogeneous(np.linalg.inv(homogeneousMatrix(transform)))
+
+
+# INVERT DISPLACEMENT FIELD
+# Inverse of a dense displacement field u (x -> x + u(x)) on the grid of a reference image (the moving image grid) or on
+# the grid of the field itself. The inverse v satisfies v(y) = -u(y + v(y)), which is solved with a fixed point
+# iteration for all voxels of a tile (a number of slices) at once. The residual |v(y) + u(y + v(y))| in mm is reported,
+# the iteration stops for a tile when it drops below the tolerance everywhere. The iteration converges when the field is
+# invertible and not too steep (the Jacobian of u has norm < 1).
+def invertDisplacementField(displacement_field, reference_image=None, number_of_iterations=50, tolerance=1e-3,
+                            tile_size=16):
+
+    forward = sitk.GetArrayViewFromImage(displacement_field)
+    forward_grid = _gridFromImage(displacement_field)
+    size, origin, spacing, direction = _gridFromImage(displacement_field if reference_image is None else
+                                                      reference_image)
+    dimension = len(size)
+
+    inverse = np.zeros(tuple(size[::-1]) + (dimension,))
+    residuals = np.zeros(tuple(size[::-1]))
+    iterations = 0
+    for start in range(0, size[-1], tile_size):
+        points = _gridPoints(size, origin, spacing, direction, start, start + tile_size)
+        displacement = -_interpolateLinear(forward, _physicalToIndex(points, *forward_grid[1:]))
+        residual = displacement + _interpolateLinear(forward, _physicalToIndex(points + displacement,
+                                                                               *forward_grid[1:]))
+        iteration = 0
+        while iteration < number_of_iterations and np.max(np.abs(residual)) >= tolerance:
+            displacement -= residual
+            residual = displacement + _interpolateLinear(forward, _physicalToIndex(points + displacement,
+                                                                                    *forward_grid[1:]))
+            iteration += 1
+        iterations = max(iterations, iteration)
+
+        stop = min(start + tile_size, size[-1])
+        inverse[start:stop] = displacement.reshape((stop - start,) + tuple(size[::-1][1:]) + (dimension,))
+        residuals[start:stop] = np.linalg.norm(residual, axis=1).reshape((stop - start,) + tuple(size[::-1][1:]))
+
+    inverse_field = sitk.GetImageFromArray(inverse, isVector=True)
+    inverse_field.SetOrigin(origin)
+    inverse_field.SetSpacing(spacing)
+    inverse_field.SetDirection(direction)
+    report = {'max_residual': float(residuals.max()), 'mean_residual': float(residuals.mean()),
+              'converged_fraction': float(np.mean(residuals < tolerance)), 'iterations': iterations}
+    return inverse_field, report
+
+
+# INVERT TRANSFORM
+# Inverse of an elastix transform chain. A chain of linear transforms is inverted in closed form, any other chain is
+# collapsed into a displacement field on its fixed grid, which is inverted on the grid of the reference image (usually
+# the moving image). Returns the inverse as SimpleITK transform and a report with the residual errors in mm.
+def invertTransform(transform_parameter_maps, reference_image=None, **kwargs):
+
+    transforms = mergeLinearTransforms(transformsFromParameterMaps(transform_parameter_maps))
+    if len(transforms) == 1 and _isLinear(transforms[0]):
+        return invertLinearTransform(transforms[0]), {'max_residual': 0.0, 'mean_residual': 0.0,
+                                                      'converged_fraction': 1.0, 'iterations': 0}
+
+    forward_transform = collapseToDisplacementField(transform_parameter_maps)
+    inverse_field, report = invertDisplacementField(forward_transform.GetDisplacementField(), reference_image, **kwargs)
+    return sitk.DisplacementFieldTransform(inverse_field), report
+
+
+# JACOBIAN DETERMINANT AT THE B-SPLINE CONTROL POINTS
+# At a control point (knot) of a cubic B-spline the basis functions of the neighbouring control points are 1/6, 4/6, 1/6
+# and their derivatives -1/2, 0, 1/2 (per grid spacing). The spatial Jacobian of x -> x + u(x) at all interior control
+# points is therefore a separable three-tap filter over the coefficients, which costs a tiny fraction of evaluating the
+# dense Jacobian. Returns the determinants (numpy order) and the physical positions of the interior control points.
+def _threeTapFilter(array, weights_per_axis):
+    for axis, weights in enumerate(weights_per_axis):
+        array = np.moveaxis(array, axis, 0)
+        array = weights[0] * array[:-2] + weights[1] * array[1:-1] + weights[2] * array[2:]
+        array = np.moveaxis(array, 0, axis)
+    return array
+
+
+def bsplineControlPointJacobianDeterminant(bspline_transform):
+
+    dimension = bspline_transform.GetDimension()
+    fixed_parameters = np.array(bspline_transform.GetFixedParameters())
+    grid_size = [int(size) for size in fixed_parameters[:dimension]]
+    grid_origin = fixed_parameters[dimension:2 * dimension]
+    grid_spacing = fixed_parameters[2 * dimension:3 * dimension]
+    grid_direction = fixed_parameters[3 * dimension:].reshape(dimension, dimension)
+    if bspline_transform.GetOrder() != 3:
+        raise ValueError("Only cubic B-spline transforms are supported")
+    if min(grid_size) < 3:
+        raise ValueError("B-spline grid has no interior control points")
+
+    # Derivatives of every displacement component along every grid axis, in index units
+    coefficients = np.array(bspline_transform.GetParameters()).reshape([dimension] + grid_size[::-1])
+    value_weights, derivative_weights = (1.0 / 6.0, 4.0 / 6.0, 1.0 / 6.0), (-0.5, 0.0, 0.5)
+    jacobian = np.empty([size - 2 for size in grid_size[::-1]] + [dimension, dimension])
+    for component in range(dimension):
+        for axis in range(dimension):
+            numpy_axis = dimension - 1 - axis
+            weights = [derivative_weights if a == numpy_axis else value_weights for a in range(dimension)]
+            jacobian[..., component, axis] = _threeTapFilter(coefficients[component], weights)
+
+    # Chain rule to physical units and the determinant of I + du/dx
+    jacobian = jacobian.dot(np.linalg.inv(grid_direction.dot(np.diag(grid_spacing))))
+    determinant = np.linalg.det(np.eye(dimension) + jacobian)
+
+    indices = np.indices(determinant.shape).reshape(dimension, -1)[::-1].T + 1
+    points = grid_origin + (indices * grid_spacing).dot(grid_direction.T)
+    return determinant, points.reshape(determinant.shape + (dimension,))
+
+
+# FOLD SCREENING
+# Quick check whether a transform chain folds (has a negative Jacobian determinant) and roughly where. The determinant
+# of every B-spline transform is first evaluated on its control point lattice and the sign of every linear transform is
+# checked. Only the regions around control points with a determinant below the threshold are evaluated densely on the
+# fixed image grid. Because the determinant of a chain is the product of the determinants of its transforms, the chain
+# can only fold where one of its transforms does. A B-spline that is not applied first acts on the output of the
+# transforms before it, so its regions are mapped back to the fixed grid through the inverse of those transforms when
+# they are linear; when one of them is not, the whole fixed grid is refined. Overlapping regions are merged, so every
+# voxel is evaluated at most once.
+def _mergeBoxes(boxes):
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for first, second in itertools.combinations(range(len(boxes)), 2):
+            (lower_1, upper_1), (lower_2, upper_2) = boxes[first], boxes[second]
+            if np.all(lower_1 <= upper_2) and np.all(lower_2 <= upper_1):
+                boxes[first] = (np.minimum(lower_1, lower_2), np.maximum(upper_1, upper_2))
+                del boxes[second]
+                merged = True
+                break
+    return boxes
+
+
+def screenFolding(transform_parameter_maps, threshold=0.2, margin=2):
+
+    transform_parameter_maps = _expandInitialTransforms(transform_parameter_maps)
+    transforms = mergeLinearTransforms([transformFromParameterMap(transform_parameter_map)
+                                        for transform_parameter_map in transform_parameter_maps])
+    composite_transform = _compositeFromTransforms(transforms)
+    size, origin, spacing, direction = _gridFromParameterMap(transform_parameter_maps[-1])
+    dimension = len(size)
+
+    report = {'folds': False, 'min_control_point_determinant': None, 'linear_reflection': False,
+              'suspicious_regions': [], 'folded_voxels': 0, 'evaluated_fraction': 0.0}
+
+    # Coarse screening of every transform, the suspicious regions are collected as boxes of voxel indices of the fixed
+    # grid
+    boxes = []
+    refine_everything = False
+    for position, transform in enumerate(transforms):
+        if _isLinear(transform):
+            if np.linalg.det(homogeneousMatrix(transform)[:dimension, :dimension]) <= 0:
+                report['folds'] = report['linear_reflection'] = True
+            continue
+
+        determinant, points = bsplineControlPointJacobianDeterminant(transform.Downcast())
+        minimum = float(determinant.min())
+        if report['min_control_point_determinant'] is None or minimum < report['min_control_point_determinant']:
+            report['min_control_point_determinant'] = minimum
+        suspicious = determinant < threshold
+        if not np.any(suspicious):
+            continue
+
+        # Inverse of the transforms applied before this one, from its input space back to the fixed grid
+        preceding = transforms[:position]
+        if not all(_isLinear(preceding_transform) for preceding_transform in preceding):
+            refine_everything = True
+            continue
+        to_fixed = np.linalg.inv(homogeneousMatrix(mergeLinearTransforms(preceding)[0])) if preceding else \
+            np.eye(dimension + 1)
+
+        # Group the suspicious control points into connected regions, grown by a margin of control points
+        components = sitk.ConnectedComponent(sitk.GetImageFromArray(suspicious.astype(np.uint8)))
+        label_statistics = sitk.LabelShapeStatisticsImageFilter()
+        label_statistics.Execute(components)
+        for label in label_statistics.GetLabels():
+            bounding_box = np.array(label_statistics.GetBoundingBox(label))
+            lower = np.maximum(bounding_box[:dimension] - margin, 0)
+            upper = np.minimum(bounding_box[:dimension] + bounding_box[dimension:] - 1 + margin,
+                               np.array(determinant.shape[::-1]) - 1)
+            index_corners = np.array([[upper[axis] if (corner >> axis) & 1 else lower[axis]
+                                       for axis in range(dimension)] for corner in range(2 ** dimension)])
+            corners = points[tuple(index_corners[:, ::-1].T)]
+            corners = corners.dot(to_fixed[:dimension, :dimension].T) + to_fixed[:dimension, dimension]
+            corner_indices = _physicalToIndex(corners, origin, spacing, direction)
+            boxes.append((np.clip(np.floor(corner_indices.min(axis=0)).astype(int), 0, np.array(size) - 1),
+                          np.clip(np.ceil(corner_indices.max(axis=0)).astype(int), 0, np.array(size) - 1)))
+
+    if refine_everything:
+        boxes = [(np.zeros(dimension, dtype=int), np.array(size) - 1)]
+
+    # Dense evaluation of the suspicious regions on the fixed image grid
+    evaluated_voxels = 0
+    for lower, upper in _mergeBoxes(boxes):
+        region_size = [int(s) for s in upper - lower + 1]
+        region_origin = list(np.array(origin) + np.array(direction).reshape(dimension, dimension).dot(
+            np.array(spacing) * lower))
+
+        displacement_field = sitk.TransformToDisplacementField(composite_transform, sitk.sitkVectorFloat64,
+                                                               region_size, region_origin, spacing, direction)
+        region_determinant = sitk.GetArrayViewFromImage(sitk.DisplacementFieldJacobianDeterminant(displacement_field))
+        folded_voxels = int(np.sum(region_determinant < 0))
+        evaluated_voxels += int(np.prod(region_size))
+        report['folded_voxels'] += folded_voxels
+        report['folds'] = report['folds'] or folded_voxels > 0
+        report['suspicious_regions'].append({'lower': list(region_origin), 'size': region_size,
+                                             'min_determinant': float(region_determinant.min()),
+                                             'folded_voxels': folded_voxels})
+
+    report['evaluated_fraction'] = evaluated_voxels / float(np.prod(size))
+    return report
+
+
+# DICE COEFFICIENT
+def diceCoefficient(mask_1, mask_2):
+    mask_1 = np.asarray(mask_1) != 0
+    mask_2 = np.asarray(mask_2) != 0
+    volume = mask_1.sum() + mask_2.sum()
+    return 2.0 * np.logical_and(mask_1, mask_2).sum() / volume if volume else 1.0
+
+
+# VALIDATION PAIR
+# Fixed and moving image with optional masks (for the Dice coefficient) and optional corresponding physical points of
+# shape (n, dimension) (for the landmark error). Images and masks may be given as file names.
+ValidationPair = collections.namedtuple('ValidationPair', ['fixed_image', 'moving_image', 'fixed_mask', 'moving_mask',
+                                                           'fixed_points', 'moving_points'],
+                                        defaults=(None, None, None, None))
+
+
+# PARAMETER CONFIGURATIONS
+# A search space maps a parameter map key to the list of values to try. A key applies to every parameter map, a
+# (map index, key) tuple only to one map. A value may itself be a list (for example one value per resolution).
+# Returns all combinations, or a random subset of them when number_of_configurations is given.
+def parameterConfigurations(search_space, number_of_configurations=None, seed=0):
+
+    keys = list(search_space.keys())
+    configurations = [dict(zip(keys, values)) for values in itertools.product(*[search_space[key] for key in keys])]
+    if number_of_configurations is not None and number_of_configurations < len(configurations):
+        random_state = np.random.RandomState(seed)
+        selection = random_state.choice(len(configurations), number_of_configurations, replace=False)
+        configurations = [configurations[index] for index in sorted(selection)]
+    return configurations
+
+
+def applyConfiguration(parameter_maps, configuration):
+
+    parameter_maps = _parameterMapList(parameter_maps)
+    for key, value in configuration.items():
+        values = [str(v) for v in value] if isinstance(value, (list, tuple)) else [str(value)]
+        if isinstance(key, tuple):
+            parameter_maps[key[0]][key[1]] = values
+        else:
+            for parameter_map in parameter_maps:
+                parameter_map[key] = values
+    return parameter_maps
+
+
+# EVALUATE PARAMETER MAPS
+# Register a validation pair and measure the Dice coefficient of the warped moving mask, the mean landmark error in mm
+# and the run time. The number of iterations of every map can be capped (used for the early rungs of a sweep).
+def evaluateParameterMaps(parameter_maps, validation_pair, maximum_iterations=None, number_of_threads=None,
+                          scheduler=None):
+
+    parameter_maps = _parameterMapList(parameter_maps)
+    if maximum_iterations is not None:
+        for parameter_map in parameter_maps:
+            parameter_map['MaximumNumberOfIterations'] = [str(int(maximum_iterations))]
+
+    start_time = time.perf_counter()
+    with RunDirectory('elastix_') as run_directory:
+        output_directory = run_directory.path
+        fixed_image = _readImage(validation_pair.fixed_image)
+        elastix_image_filter = sitk.ElastixImageFilter()
+        elastix_image_filter.SetFixedImage(fixed_image)
+        elastix_image_filter.SetMovingImage(_readImage(validation_pair.moving_image))
+        _setParameterMaps(elastix_image_filter, parameter_maps)
+        elastix_image_filter.SetOutputDirectory(output_directory)
+        elastix_image_filter.LogToConsoleOff()
+        if scheduler is None:
+            if number_of_threads is not None:
+                elastix_image_filter.SetNumberOfThreads(number_of_threads)
+            elastix_image_filter.Execute()
+        else:
+            with scheduler.allocate(fixed_image, elastix_image_filter, number_of_threads=number_of_threads):
+                elastix_image_filter.Execute()
+        transform_parameter_maps = _parameterMapList(elastix_image_filter.GetTransformParameterMap())
+    metrics = {'time': time.perf_counter() - start_time, 'dice': None, 'landmark_error': None}
+
+    if validation_pair.fixed_mask is not None and validation_pair.moving_mask is not None:
+        warped_mask = warpLabelImage(_readImage(validation_pair.moving_mask), transform_parameter_maps,
+                                     number_of_threads, scheduler)
+        metrics['dice'] = diceCoefficient(sitk.GetArrayViewFromImage(_readImage(validation_pair.fixed_mask)),
+                                          sitk.GetArrayViewFromImage(warped_mask))
+    if validation_pair.fixed_points is not None and validation_pair.moving_points is not None:
+        metrics['landmark_error'] = float(np.mean(targetRegistrationError(
+            compositeTransform(transform_parameter_maps), validation_pair.fixed_points, validation_pair.moving_points)))
+    return metrics
+
+
+# Lower is better: the Dice coefficient enters as 1 - Dice, the landmark error in mm and the time in seconds
+def sweepScore(metrics, weights=None):
+    weights = {'dice': 1.0, 'landmark_error': 0.1, 'time': 0.001} if weights is None else weights
+    score = weights.get('time', 0.0) * metrics['time']
+    if metrics['dice'] is not None:
+        score += weights.get('dice', 0.0) * (1.0 - metrics['dice'])
+    if metrics['landmark_error'] is not None:
+        score += weights.get('landmark_error', 0.0) * metrics['landmark_error']
+    return score
+
+
+# PARAMETER SWEEP
+# Evaluate configurations of a search space on validation pairs with successive halving: all configurations first run
+# with a small number of iterations, only the best 1/eta of them continue with eta times more iterations, until the
+# iterations of the base parameter maps are reached. The jobs of a rung (configuration x validation pair) run in
+# parallel. Returns the evaluated configurations sorted from best to worst, and writes the parameter maps of the best
+# configuration to the output directory (Parameters.best.<index>.txt) when one is given.
+def parameterSweep(parameter_maps, search_space, validation_pairs, number_of_configurations=None,
+                   minimum_iterations=50, eta=3, weights=None, number_of_workers=None, output_directory=None):
+
+    parameter_maps = _parameterMapList(parameter_maps)
+    configurations = parameterConfigurations(search_space, number_of_configurations)
+    maximum_iterations = max(int(parameter_map.get('MaximumNumberOfIterations', ['250'])[-1])
+                             for parameter_map in parameter_maps)
+
+    scheduler = ThreadScheduler()
+    number_of_workers = number_of_workers or max(1, scheduler.cpus // 4)
+
+    def job(configuration_index, pair_index, iterations):
+        configuration_maps = applyConfiguration(parameter_maps, configurations[configuration_index])
+        try:
+            metrics = evaluateParameterMaps(configuration_maps, validation_pairs[pair_index], iterations,
+                                            scheduler=scheduler)
+        except Exception as error:
+            warnings.warn("Configuration {0} failed: {1}".format(configurations[configuration_index], error))
+            metrics = None
+        return configuration_index, metrics
+
+    results = {}
+    surviving = list(range(len(configurations)))
+    iterations = min(minimum_iterations, maximum_iterations)
+    with scheduler.pool(number_of_workers), concurrent.futures.ThreadPoolExecutor(number_of_workers) as executor:
+        while True:
+            final_rung = iterations >= maximum_iterations or len(surviving) == 1
+
+            # Evaluate all surviving configurations on all validation pairs
+            iterations = maximum_iterations if final_rung else iterations
+            futures = [executor.submit(job, configuration_index, pair_index, iterations)
+                       for configuration_index in surviving for pair_index in range(len(validation_pairs))]
+            rung_metrics = collections.defaultdict(list)
+            for future in concurrent.futures.as_completed(futures):
+                configuration_index, metrics = future.result()
+                rung_metrics[configuration_index].append(metrics)
+
+            for configuration_index in surviving:
+                metrics = rung_metrics[configuration_index]
+                if any(m is None for m in metrics):
+                    score = np.inf
+                else:
+                    score = float(np.mean([sweepScore(m, weights) for m in metrics]))
+                results[configuration_index] = {'configuration': configurations[configuration_index], 'score': score,
+                                                'iterations': iterations, 'metrics': metrics}
+            if final_rung:
+                break
+
+            # Keep the best 1/eta of the configurations
+            surviving.sort(key=lambda index: results[index]['score'])
+            surviving = surviving[:max(1, int(np.ceil(len(surviving) / float(eta))))]
+            iterations *= eta
+
+    # Configurations that reached the last rung rank before the ones that were dropped early
+    ranking = sorted(results.values(), key=lambda result: (-result['iterations'], result['score']))
+    if output_directory is not None and np.isfinite(ranking[0]['score']):
+        os.makedirs(output_directory, exist_ok=True)
+        for index, parameter_map in enumerate(applyConfiguration(parameter_maps, ranking[0]['configuration'])):
+            sitk.WriteParameterFile(parameter_map, os.path.join(output_directory,
+                                                                "Parameters.best.{0}.txt".format(index)))
+    return ranking
+
+
+# READ POINT SET
+# Read an elastix point set file ("point" or "index" on the first line, the number of points on the second line and
+# one point per line). Index point sets are converted to physical points with the geometry of the reference image.
+def readPointSet(file_name, reference_image=None):
+
+    with open(file_name) as point_set_file:
+        point_type = point_set_file.readline().strip()
+        number_of_points = int(point_set_file.readline())
+        points = np.loadtxt(point_set_file, ndmin=2)[:number_of_points]
+
+    if point_type == 'index':
+        if reference_image is None:
+            raise ValueError("An index point set needs a reference image")
+        _, origin, spacing, direction = _gridFromImage(reference_image)
+        dimension = len(origin)
+        matrix = np.array(direction).reshape(dimension, dimension)
+        points = np.array(origin) + (points * np.array(spacing)).dot(matrix.T)
+    elif point_type != 'point':
+        raise ValueError("Unknown point set type: {0}".format(point_type))
+    return points
+
+
+# TRANSFORM POINTS
+# Map an array of physical points (n, dimension) through a SimpleITK transform in a vectorized way. Linear transforms
+# are a matrix product, displacement fields and cubic B-splines are interpolated for all points at once, composite
+# transforms apply their transforms from last to first. Other transforms fall back to TransformPoint per point.
+def _bsplineDisplacement(bspline_transform, points):
+
+    dimension = bspline_transform.GetDimension()
+    fixed_parameters = np.array(bspline_transform.GetFixedParameters())
+    grid_size = np.array(fixed_parameters[:dimension], dtype=int)
+    coefficients = np.array(bspline_transform.GetParameters()).reshape([dimension] + list(grid_size[::-1]))
+    continuous_index = _physicalToIndex(points, fixed_parameters[dimension:2 * dimension],
+                                        fixed_parameters[2 * dimension:3 * dimension],
+                                        fixed_parameters[3 * dimension:])
+
+    # Cubic B-spline weights of the four control points around every point, per axis
+    start = np.floor(continuous_index).astype(int) - 1
+    t = continuous_index - np.floor(continuous_index)
+    weights = np.stack(_cubicBSplineWeights(t))
+
+    # Points without full support of the grid are not displaced, as in ITK
+    inside = np.all((start >= 0) & (start + 3 < grid_size), axis=1)
+    displacement = np.zeros_like(points, dtype=float)
+    for offsets in itertools.product(range(4), repeat=dimension):
+        weight = np.prod([weights[offsets[axis], :, axis] for axis in range(dimension)], axis=0)
+        index = np.minimum(np.maximum(start + np.array(offsets), 0), grid_size - 1)
+        values = coefficients[(slice(None),) + tuple(index[:, axis] for axis in range(dimension - 1, -1, -1))]
+        displacement += weight[:, np.newaxis] * values.T
+    displacement[~inside] = 0.0
+    return displacement
+
+
+def transformPoints(transform, points):
+
+    points = np.asarray(points, dtype=float)
+    transform = transform.Downcast()
+    name = transform.GetName()
+    if name == 'CompositeTransform':
+        for index in range(transform.GetNumberOfTransforms() - 1, -1, -1):
+            points = transformPoints(transform.GetNthTransform(index), points)
+        return points
+    if _isLinear(transform):
+        matrix = homogeneousMatrix(transform)
+        dimension = points.shape[1]
+        return points.dot(matrix[:dimension, :dimension].T) + matrix[:dimension, dimension]
+    if name == 'DisplacementFieldTransform':
+        displacement_field = transform.GetDisplacementField()
+        _, origin, spacing, direction = _gridFromImage(displacement_field)
+        return points + _interpolateLinear(sitk.GetArrayViewFromImage(displacement_field),
+                                           _physicalToIndex(points, origin, spacing, direction))
+    if name == 'BSplineTransform' and transform.GetOrder() == 3:
+        return points + _bsplineDisplacement(transform, points)
+    return np.array([transform.TransformPoint(list(point)) for point in points])
+
+
+# TRANSFORMIX POINTS
+# Map physical points (n, dimension) with transformix itself (the -def point set option) and read the OutputPoint of
+# every point back from outputpoints.txt. The output grid is reduced to a single voxel, as only the points are needed.
+def transformixPoints(transform_parameter_maps, points):
+
+    points = np.asarray(points, dtype=float)
+    transform_parameter_maps = _expandInitialTransforms(transform_parameter_maps)
+    dimension = points.shape[1]
+    for transform_parameter_map in transform_parameter_maps:
+        transform_parameter_map['Size'] = ['1'] * dimension
+
+    with RunDirectory('transformix_') as run_directory:
+        with open(run_directory.file('points.txt'), 'w') as point_set_file:
+            point_set_file.write("point\n{0}\n".format(len(points)))
+            np.savetxt(point_set_file, points)
+
+        transformix_image_filter = sitk.TransformixImageFilter()
+        transformix_image_filter.SetMovingImage(sitk.Image([1] * dimension, sitk.sitkFloat32))
+        _setTransformParameterMaps(transformix_image_filter, transform_parameter_maps)
+        transformix_image_filter.SetFixedPointSetFileName(run_directory.file('points.txt'))
+        transformix_image_filter.SetOutputDirectory(run_directory.path)
+        transformix_image_filter.LogToConsoleOff()
+        transformix_image_filter.Execute()
+
+        return readOutputPoints(run_directory.file('outputpoints.txt'))
+
+
+# Physical output points (n, dimension) of the outputpoints.txt file that transformix writes for a point set
+def readOutputPoints(file_name):
+    with open(file_name) as output_points_file:
+        return np.array([[float(value) for value in line.split('OutputPoint = [')[1].split(']')[0].split()]
+                         for line in output_points_file if 'OutputPoint' in line])
+
+
+# CHECK AGAINST TRANSFORMIX
+# Compare the in-memory transforms of a chain with transformix on a number of random voxel centers of the output grid
+# (of a reference image, or of the last parameter map). Returns the largest distance in mm per kind of transform: the
+# composite transform, the collapsed displacement field and, when a grid spacing is given, the refitted B-spline (which
+# is an approximation, the others should agree to rounding).
+def checkAgainstTransformix(transform_parameter_maps, number_of_points=100, grid_spacing=None, reference_image=None,
+                            seed=0):
+
+    if reference_image is None:
+        size, origin, spacing, direction = _gridFromParameterMap(_expandInitialTransforms(transform_parameter_maps)[-1])
+    else:
+        size, origin, spacing, direction = _gridFromImage(reference_image)
+    dimension = len(size)
+    indices = np.random.default_rng(seed).integers(0, size, (number_of_points, dimension))
+    points = np.array(origin) + (indices * np.array(spacing)).dot(np.array(direction).reshape(dimension, dimension).T)
+    expected = transformixPoints(transform_parameter_maps, points)
+
+    transforms = {'composite': compositeTransform(transform_parameter_maps),
+                  'displacement_field': collapseToDisplacementField(transform_parameter_maps, reference_image)}
+    if grid_spacing is not None:
+        transforms['bspline'] = collapseToBSpline(transform_parameter_maps, grid_spacing, reference_image)
+    return {kind: float(np.max(np.linalg.norm(transformPoints(transform, points) - expected, axis=1)))
+            for kind, transform in transforms.items()}
+
+
+# NEAREST NEIGHBOURS
+# Distance from every query point to its nearest target point and the index of that target point. A KD-tree from scipy
+# is used when it is installed, otherwise the distances are computed in blocks with numpy.
+def nearestNeighbours(query_points, target_points, block_size=4096):
+
+    query_points = np.asarray(query_points, dtype=float)
+    target_points = np.asarray(target_points, dtype=float)
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        cKDTree = None
+    if cKDTree is not None:
+        return cKDTree(target_points).query(query_points)
+
+    distances = np.empty(len(query_points))
+    indices = np.empty(len(query_points), dtype=int)
+    for start in range(0, len(query_points), block_size):
+        block = query_points[start:start + block_size]
+        squared = np.sum((block[:, np.newaxis, :] - target_points[np.newaxis, :, :]) ** 2, axis=2)
+        indices[start:start + block_size] = np.argmin(squared, axis=1)
+        distances[start:start + block_size] = np.sqrt(squared[np.arange(len(block)), indices[start:start + block_size]])
+    return distances, indices
+
+
+# TARGET REGISTRATION ERROR
+# The transform maps fixed points to the moving image, so the error of a landmark is the distance between the
+# transformed fixed landmark and the corresponding moving landmark (in mm). For unpaired point sets the nearest moving
+# point is taken as correspondence. Every function works on a batch of transforms at once: all landmarks of all
+# transforms are stacked into one array of shape (number_of_transforms, number_of_points, dimension).
+def targetRegistrationError(transforms, fixed_points, moving_points, paired=True):
+
+    if not isinstance(transforms, (list, tuple)):
+        transforms = [transforms]
+    fixed_points = np.asarray(fixed_points, dtype=float)
+    moving_points = np.asarray(moving_points, dtype=float)
+    if paired and fixed_points.shape != moving_points.shape:
+        raise ValueError("Paired point sets do not have the same number of points")
+
+    transformed = np.stack([transformPoints(transform, fixed_points) for transform in transforms])
+    if paired:
+        return np.linalg.norm(transformed - moving_points[np.newaxis], axis=2)
+    distances, _ = nearestNeighbours(transformed.reshape(-1, transformed.shape[2]), moving_points)
+    return distances.reshape(transformed.shape[:2])
+
+
+# Aggregate statistics of an array of errors of shape (number_of_transforms, number_of_points), one row per transform
+def targetRegistrationErrorStatistics(errors):
+    errors = np.atleast_2d(errors)
+    return {'mean': errors.mean(axis=1), 'std': errors.std(axis=1), 'median': np.median(errors, axis=1),
+            'p95': np.percentile(errors, 95, axis=1), 'max': errors.max(axis=1)}
+
+
+# ATOMIC WRITE
+# Write a file through a temporary file in the same directory that is renamed into place, so a killed process never
+# leaves a half written file behind. The write function gets the temporary file name.
+def atomicWrite(file_name, write):
+    directory, base_name = os.path.split(os.path.abspath(file_name))
+    temporary_file_name = os.path.join(directory, ".{0}.{1}.{2}.tmp{3}".format(base_name, os.getpid(),
+                                                                              threading.get_ident(),
+                                                                              os.path.splitext(base_name)[1]))
+    try:
+        write(temporary_file_name)
+        os.replace(temporary_file_name, file_name)
+    finally:
+        if os.path.exists(temporary_file_name):
+            os.remove(temporary_file_name)
+
+
+def _writeJson(file_name, content):
+    def write(temporary_file_name):
+        with open(temporary_file_name, 'w') as json_file:
+            json.dump(content, json_file, indent=2)
+            json_file.flush()
+            os.fsync(json_file.fileno())
+    atomicWrite(file_name, write)
+
+
+# STAGED REGISTRATION WITH CHECKPOINTS
+# Run a multi-stage registration (for example rigid -> affine -> B-spline) one stage at a time. After every stage its
+# transform parameter map and a small metadata file are written atomically to the checkpoint directory; the metadata
+# file is written last and marks the stage as complete. When the process is killed and started again, all completed
+# stages are skipped and the registration continues from the last completed stage, which is used as initial transform. A
+# stage is only reused when the images, the masks, its parameter map and all earlier parameter maps are unchanged;
+# images given as file names are identified by their path, size and modification time, other images by their content
+# hash. The stored maps do not refer to each other by path and the metadata only holds file names relative to the
+# checkpoint directory, so the directory can be moved. Progress is reported through the optional callback, which gets a
+# dictionary with the stage, its status ('resumed', 'running' or 'completed') and for completed stages the elapsed time.
+# Returns the transform parameter maps of all stages as a chain.
+def _inputIdentity(image):
+    if image is None:
+        return 'None'
+    if isinstance(image, str):
+        status = os.stat(image)
+        return repr((os.path.abspath(image), status.st_size, status.st_mtime))
+    return imageContentHash(image)
+
+
+def _writeInitialTransformChain(transform_parameter_maps, directory):
+
+    # Write a chain of maps as linked parameter files (elastix refers to initial transforms by file name), returns the
+    # file name of the last map
+    file_name = None
+    for index, transform_parameter_map in enumerate(transform_parameter_maps):
+        transform_parameter_map = dict(transform_parameter_map)
+        transform_parameter_map['InitialTransformParametersFileName'] = [file_name or 'NoInitialTransform']
+        file_name = os.path.join(directory, "InitialTransformParameters.{0}.txt".format(index))
+        sitk.WriteParameterFile(transform_parameter_map, file_name)
+    return file_name
+
+
+def stagedRegistration(fixed_image, moving_image, parameter_maps, checkpoint_directory, fixed_mask=None,
+                       moving_mask=None, number_of_threads=None, callback=None):
+
+    parameter_maps = _parameterMapList(parameter_maps)
+    if not parameter_maps:
+        raise ValueError("At least one parameter map is required")
+    os.makedirs(checkpoint_directory, exist_ok=True)
+    callback = callback or (lambda event: None)
+
+    chain = []
+    stage_hash = hashlib.sha1()
+    for image in (fixed_image, moving_image, fixed_mask, moving_mask):
+        stage_hash.update(_inputIdentity(image).encode())
+    for stage, parameter_map in enumerate(parameter_maps):
+        stage_hash.update(repr(sorted(parameter_map.items())).encode())
+        if chain:
+            stage_hash.update(repr(sorted(chain[-1].items())).encode())
+        transform_file_base_name = "TransformParameters.{0}.txt".format(stage)
+        transform_file_name = os.path.join(checkpoint_directory, transform_file_base_name)
+        metadata_file_name = os.path.join(checkpoint_directory, "stage.{0}.json".format(stage))
+
+        # Skip stages that were completed before with the same inputs and parameter maps
+        if os.path.exists(metadata_file_name) and os.path.exists(transform_file_name):
+            with open(metadata_file_name) as metadata_file:
+                metadata = json.load(metadata_file)
+            if metadata.get('parameter_hash') == stage_hash.hexdigest():
+                callback({'stage': stage, 'status': 'resumed'})
+                chain.append(_parameterMapList(sitk.ReadParameterFile(transform_file_name))[0])
+                continue
+
+        # Run this stage on top of the previous ones
+        callback({'stage': stage, 'status': 'running'})
+        start_time = time.perf_counter()
+        fixed_image = _readImage(fixed_image)
+        moving_image = _readImage(moving_image)
+        with RunDirectory('elastix_') as run_directory:
+            elastix_image_filter = sitk.ElastixImageFilter()
+            elastix_image_filter.SetFixedImage(fixed_image)
+            elastix_image_filter.SetMovingImage(moving_image)
+            if fixed_mask is not None:
+                elastix_image_filter.SetFixedMask(_readImage(fixed_mask))
+            if moving_mask is not None:
+                elastix_image_filter.SetMovingMask(_readImage(moving_mask))
+            elastix_image_filter.SetParameterMap(parameter_map)
+            if chain:
+                elastix_image_filter.SetInitialTransformParameterFileName(
+                    _writeInitialTransformChain(chain, run_directory.path))
+            if number_of_threads is not None:
+                elastix_image_filter.SetNumberOfThreads(number_of_threads)
+            elastix_image_filter.SetOutputDirectory(run_directory.path)
+            elastix_image_filter.LogToConsoleOff()
+            elastix_image_filter.Execute()
+            transform_parameter_map = _parameterMapList(elastix_image_filter.GetTransformParameterMap())[-1]
+
+        # Persist the stage: first the transform, then the metadata that marks it as complete
+        transform_parameter_map['InitialTransformParametersFileName'] = ['NoInitialTransform']
+        atomicWrite(transform_file_name, lambda file_name: sitk.WriteParameterFile(transform_parameter_map, file_name))
+        elapsed_time = time.perf_counter() - start_time
+        _writeJson(metadata_file_name, {'stage': stage, 'parameter_hash': stage_hash.hexdigest(),
+                                        'transform': parameter_map.get('Transform', [''])[0],
+                                        'transform_file': transform_file_base_name,
+                                        'initial_transform_file': "TransformParameters.{0}.txt".format(stage - 1)
+                                        if stage else None,
+                                        'elapsed_time': elapsed_time,
+                                        'completed_at': time.strftime('%Y-%m-%dT%H:%M:%S')})
+        chain.append(transform_parameter_map)
+        callback({'stage': stage, 'status': 'completed', 'elapsed_time': elapsed_time})
+
+    return chain
+
+
+# JACOBIAN OF A DEFORMATION FIELD
+# Spatial Jacobian (d(x + u)/dx, shape (..., dimension, dimension)) and its determinant computed in memory from a
+# deformation field, instead of letting transformix write spatialJacobian.nii / fullSpatialJacobian.nii and reading them
+# back. Central differences in the interior, one-sided differences at the border.
+def spatialJacobian(deformation_field):
+
+    displacement = sitk.GetArrayViewFromImage(deformation_field)
+    dimension = deformation_field.GetDimension()
+    spacing = deformation_field.GetSpacing()
+    direction = np.array(deformation_field.GetDirection()).reshape(dimension, dimension)
+
+    # Derivatives along the index axes (x, y, z), converted to physical axes with the direction cosines
+    jacobian = np.empty(displacement.shape[:dimension] + (dimension, dimension))
+    for axis in range(dimension):
+        jacobian[..., :, axis] = np.gradient(displacement, spacing[axis], axis=dimension - 1 - axis)
+    jacobian = jacobian.dot(direction.T)
+    return jacobian + np.eye(dimension)
+
+
+def determinantOfSpatialJacobian(deformation_field):
+    return sitk.DisplacementFieldJacobianDeterminant(sitk.Cast(deformation_field, sitk.sitkVectorFloat64))
+
+
+# SHARED IMAGE
+# An image whose voxels live in a shared memory block, so other processes on the same machine can use them without a
+# copy. The producer creates it from a SimpleITK image (one copy into the block); consumers attach to it with the
+# metadata (name of the block, array shape, data type and image geometry) and get a numpy view on the same memory.
+class SharedImage:
+
+    def __init__(self, shared_block, metadata):
+        self.shared_block = shared_block
+        self.metadata = metadata
+        self.array = np.ndarray(metadata['shape'], dtype=np.dtype(metadata['dtype']), buffer=shared_block.buf)
+
+    @classmethod
+    def create(cls, image):
+        view = sitk.GetArrayViewFromImage(image)
+        shared_block = shared_memory.SharedMemory(create=True, size=max(view.nbytes, 1))
+        metadata = {'name': shared_block.name, 'shape': view.shape, 'dtype': view.dtype.str,
+                    'vector': image.GetNumberOfComponentsPerPixel() > 1, 'spacing': image.GetSpacing(),
+                    'origin': image.GetOrigin(), 'direction': image.GetDirection()}
+        shared_image = cls(shared_block, metadata)
+        shared_image.array[...] = view
+        return shared_image
+
+    @classmethod
+    def attach(cls, metadata):
+
+        # The producer owns the block, so the consumer must not track it: the resource tracker (POSIX only) would
+        # otherwise remove the block when the consumer exits. Python 3.13 can open the block untracked; older versions
+        # register it on open, under the name with a leading slash.
+        if sys.version_info >= (3, 13):
+            shared_block = shared_memory.SharedMemory(name=metadata['name'], track=False)
+        else:
+            shared_block = shared_memory.SharedMemory(name=metadata['name'])
+            if os.name == 'posix':
+                resource_tracker.unregister('/' + shared_block.name, 'shared_memory')
+        return cls(shared_block, metadata)
+
+    # Copy into a SimpleITK image with the original geometry
+    def toImage(self):
+        image = sitk.GetImageFromArray(self.array, isVector=self.metadata['vector'])
+        image.SetSpacing(self.metadata['spacing'])
+        image.SetOrigin(self.metadata['origin'])
+        image.SetDirection(self.metadata['direction'])
+        return image
+
+    def close(self):
+        self.array = None
+        self.shared_block.close()
+
+    def unlink(self):
+        self.close()
+        self.shared_block.unlink()
+
+
+# RESULT CHANNEL
+# Hands results (result images, deformation fields, Jacobians, ...) from registration workers to consumer processes
+# through shared memory instead of through files. A published result is a set of named images plus a dictionary of
+# metadata; only the small description travels through the queue. The producer keeps the shared blocks alive until the
+# consumer acknowledges the result and the producer collects the acknowledgements. Images are only written to disk
+# when persistence is requested.
+class ResultChannel:
+
+    def __init__(self, persist_directory=None):
+        self.persist_directory = persist_directory
+        self.queue = multiprocessing.Queue()
+        self.acknowledgements = multiprocessing.Queue()
+        self._published = {}
+
+    # Only the queues are sent to other processes
+    def __getstate__(self):
+        return {'persist_directory': self.persist_directory, 'queue': self.queue,
+                'acknowledgements': self.acknowledgements}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._published = {}
+
+    # Producer side
+    def publish(self, key, images, metadata=None, persist=False):
+        self.collect()
+        shared_images = {name: SharedImage.create(image) for name, image in images.items()}
+        if persist:
+            if self.persist_directory is None:
+                raise ValueError("Channel has no directory to persist results to")
+            os.makedirs(self.persist_directory, exist_ok=True)
+            for name, image in images.items():
+                file_name = os.path.join(self.persist_directory, "{0}_{1}.mha".format(key, name))
+                atomicWrite(file_name, lambda temporary_file_name, image=image: sitk.WriteImage(image,
+                                                                                              temporary_file_name))
+        self._published[key] = shared_images
+        self.queue.put({'key': key, 'images': {name: shared_image.metadata
+                                               for name, shared_image in shared_images.items()},
+                        'metadata': metadata or {}})
+
+    # Release the shared memory of all results that were acknowledged by a consumer
+    def collect(self):
+        while True:
+            try:
+                key = self.acknowledgements.get_nowait()
+            except queue.Empty:
+                break
+            self.release(key)
+
+    def release(self, key):
+        for shared_image in self._published.pop(key, {}).values():
+            shared_image.unlink()
+
+    def close(self):
+        for key in list(self._published):
+            self.release(key)
+
+    # Consumer side: returns the key, the shared images {name: SharedImage} and the metadata of the next result
+    def receive(self, timeout=None):
+        message = self.queue.get(timeout=timeout)
+        images = {name: SharedImage.attach(image_metadata) for name, image_metadata in message['images'].items()}
+        return message['key'], images, message['metadata']
+
+    def acknowledge(self, key, images):
+        for shared_image in images.values():
+            shared_image.close()
+        self.acknowledgements.put(key)
+
+
+# AVAILABLE CPUS
+# Number of cores this process may use: the CPU affinity mask, limited by the CPU quota of the cgroup (containers).
+def availableCpus():
+
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = None
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as cpu_max:
+            limit, period = cpu_max.read().split()
+            if limit != 'max':
+                quota = float(limit) / float(period)
+    except (OSError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as quota_file, \
+                    open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as period_file:
+                limit, period = float(quota_file.read()), float(period_file.read())
+                if limit > 0:
+                    quota = limit / period
+        except (OSError, ValueError):
+            pass
+
+    if quota is not None:
+        cpus = min(cpus, int(np.ceil(quota)))
+    return max(1, cpus)
+
+
+# THREAD SCHEDULER
+# Chooses the number of threads of every elastix / transformix job from the number of available cores, the number of
+# jobs that may run at the same time and the image size. The cores are split by the size of the worker pools that use
+# the scheduler (see pool()), or by the number of running jobs when that is larger. Running jobs are registered as files
+# in a registry directory, so jobs of other processes (process pools, cli workers) that use the same directory are
+# counted too; entries of processes that no longer exist are ignored.
+# Until a size class has been measured, it gets one thread per voxels_per_thread voxels, which gives a 256 x 256 image
+# 4 threads and a 64^3 volume 16. The run time of every job is recorded per image size class, keeping the last
+# history_size timings per thread count that are at most max_age seconds old. From then on the measurements decide:
+# when doubling the threads gave less than minimum_efficiency of the ideal speedup, the size class is limited to the
+# smaller thread count, otherwise twice the largest thread count that was measured is tried next. Once the timings of a
+# thread count have expired it is measured again. The speedup that was achieved is available through speedup().
+class ThreadScheduler:
+
+    def __init__(self, cpus=None, voxels_per_thread=2 ** 14, minimum_efficiency=0.6, history_size=16, max_age=600.0,
+                 registry_directory=None):
+        self.cpus = cpus or availableCpus()
+        self.voxels_per_thread = voxels_per_thread
+        self.minimum_efficiency = minimum_efficiency
+        self.history_size = history_size
+        self.max_age = max_age
+        self.registry_directory = registry_directory or os.path.join(
+            tempfile.gettempdir(), "elastix_thread_scheduler_{0}".format(os.getuid() if hasattr(os, 'getuid') else 0))
+        os.makedirs(self.registry_directory, exist_ok=True)
+        self.pool_size = 0
+        self.history = {}
+        self.thread_caps = {}
+        self._lock = threading.Lock()
+
+    # The scheduler can be sent to worker processes, they share the registry directory
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _numberOfVoxels(image):
+        return int(np.prod(image.GetSize())) if hasattr(image, 'GetSize') else int(image)
+
+    @staticmethod
+    def _sizeClass(number_of_voxels):
+        return int(np.log2(max(number_of_voxels, 1)))
+
+    @staticmethod
+    def _processExists(pid):
+        if os.name != 'posix':
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    # Number of jobs in the registry (of all processes), stale entries are removed
+    def activeJobs(self):
+        active_jobs = 0
+        for file_name in os.listdir(self.registry_directory):
+            if self._processExists(int(file_name.split('_')[0])):
+                active_jobs += 1
+            else:
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.registry_directory, file_name))
+        return active_jobs
+
+    # Context manager for a pool of workers that submit jobs to this scheduler, so the cores are split by the pool size
+    # from the first job on
+    @contextlib.contextmanager
+    def pool(self, number_of_workers):
+        with self._lock:
+            self.pool_size += number_of_workers
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self.pool_size -= number_of_workers
+
+    # Number of threads for a job on an image (or a number of voxels), given the jobs that are running
+    def threadsFor(self, image, active_jobs=None):
+        number_of_voxels = self._numberOfVoxels(image)
+        active_jobs = self.activeJobs() if active_jobs is None else active_jobs
+        fair_share = max(1, self.cpus // max(1, self.pool_size, active_jobs))
+        size_limit = self.thread_caps.get(self._sizeClass(number_of_voxels),
+                                          max(1, number_of_voxels // self.voxels_per_thread))
+        return max(1, min(fair_share, size_limit))
+
+    # Context manager that sets the number of threads on the given ElastixImageFilter / TransformixImageFilter objects
+    # for the duration of the job, and records the run time afterwards. A fixed number of threads may be forced.
+    @contextlib.contextmanager
+    def allocate(self, image, *filters, number_of_threads=None):
+        number_of_voxels = self._numberOfVoxels(image)
+        registry_file_name = os.path.join(self.registry_directory, "{0}_{1}_{2}".format(
+            os.getpid(), threading.get_ident(), time.perf_counter_ns()))
+        with self._lock:
+            open(registry_file_name, 'w').close()
+            threads = number_of_threads or self.threadsFor(number_of_voxels)
+        for image_filter in filters:
+            image_filter.SetNumberOfThreads(threads)
+
+        start_time = time.perf_counter()
+        try:
+            yield threads
+            self.record(number_of_voxels, threads, time.perf_counter() - start_time)
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(registry_file_name)
+
+    # Median time per voxel of every thread count, from the timings that have not expired
+    def _timings(self, history):
+        now = time.monotonic()
+        timings = {}
+        for count, entries in history.items():
+            recent = [value for timestamp, value in entries if now - timestamp <= self.max_age]
+            if recent:
+                timings[count] = np.median(recent)
+        return timings
+
+    def record(self, number_of_voxels, threads, elapsed_time):
+        size_class = self._sizeClass(number_of_voxels)
+        with self._lock:
+            history = self.history.setdefault(size_class, {})
+            history.setdefault(threads, collections.deque(maxlen=self.history_size)).append(
+                (time.monotonic(), elapsed_time / max(number_of_voxels, 1)))
+
+            # Compare the scaling between successive thread counts that were observed for this size class
+            timings = self._timings(history)
+            counts = sorted(timings)
+            cap = min(self.cpus, 2 * counts[-1])
+            for fewer, more in zip(counts[:-1], counts[1:]):
+                efficiency = (timings[fewer] / timings[more]) / (float(more) / fewer)
+                if efficiency < self.minimum_efficiency:
+                    cap = fewer
+                    break
+            self.thread_caps[size_class] = cap
+
+    # Speedup per thread count relative to the smallest thread count that was observed, per size class
+    def speedup(self):
+        result = {}
+        for size_class, history in self.history.items():
+            timings = self._timings(history)
+            if not timings:
+                continue
+            reference = timings[min(timings)]
+            result[size_class] = {count: reference / timing for count, timing in sorted(timings.items())}
+        return result
+
+
+# MEMORY ESTIMATE
+# Predicts the peak memory (bytes) of an elastix registration and its transformix outputs without running it. Images are
+# given as images or file names (only the header is read). The estimate adds up:
+#
+#     inputs:         the fixed and moving image in their own pixel type
+#     internal:       the fixed and moving image cast to the Fixed/MovingInternalImagePixelType
+#     pyramid:        all resolution levels, which elastix computes up front (smoothing pyramids keep the full size)
+#     interpolator:   the B-spline coefficients of the moving image (double, or float for BSplineInterpolatorFloat)
+#     transform:      parameters, gradients and optimizer state, plus one gradient per thread for the metric
+#     outputs:        result image, deformation field and (spatial) Jacobian images on the fixed grid
+#
+# Stages run one after the other, so only the largest stage counts. Outputs may be computed in a number of tiles.
+PIXEL_TYPE_BYTES = {'char': 1, 'unsigned char': 1, 'short': 2, 'unsigned short': 2, 'int': 4, 'unsigned int': 4,
+                    'long': 8, 'unsigned long': 8, 'float': 4, 'double': 8}
+REGISTRATION_OUTPUTS = ('result_image', 'deformation_field', 'determinant_of_spatial_jacobian', 'spatial_jacobian')
+
+
+def _imageInformation(image):
+    if isinstance(image, str):
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(image)
+        reader.ReadImageInformation()
+        size, spacing, pixel_id = reader.GetSize(), reader.GetSpacing(), reader.GetPixelID()
+    else:
+        size, spacing, pixel_id = image.GetSize(), image.GetSpacing(), image.GetPixelID()
+    pixel = sitk.Image([1] * len(size), pixel_id)
+    return list(size), list(spacing), pixel_id, pixel.GetSizeOfPixelComponent() * pixel.GetNumberOfComponentsPerPixel()
+
+
+def _pyramidFactors(parameter_map, dimension):
+    number_of_resolutions = int(parameter_map.get('NumberOfResolutions', ['3'])[0])
+    schedule = _floats(parameter_map, 'ImagePyramidSchedule')
+    if schedule is None or len(schedule) != number_of_resolutions * dimension:
+        schedule = [2.0 ** (number_of_resolutions - 1 - level) for level in range(number_of_resolutions)
+                    for _ in range(dimension)]
+    return np.array(schedule).reshape(number_of_resolutions, dimension)
+
+
+def _stageMemory(parameter_map, fixed_size, fixed_spacing, moving_size, number_of_threads):
+    dimension = len(fixed_size)
+    fixed_voxels, moving_voxels = float(np.prod(fixed_size)), float(np.prod(moving_size))
+    fixed_bytes = PIXEL_TYPE_BYTES[parameter_map.get('FixedInternalImagePixelType', ['float'])[0]]
+    moving_bytes = PIXEL_TYPE_BYTES[parameter_map.get('MovingInternalImagePixelType', ['float'])[0]]
+
+    # Pyramids: recursive and shrinking pyramids downsample with the schedule, smoothing pyramids do not
+    factors = _pyramidFactors(parameter_map, dimension)
+    pyramid = 0.0
+    for pyramid_type, voxels, pixel_bytes in (('FixedImagePyramid', fixed_voxels, fixed_bytes),
+                                              ('MovingImagePyramid', moving_voxels, moving_bytes)):
+        if 'Smoothing' in parameter_map.get(pyramid_type, ['Smoothing'])[0]:
+            pyramid += len(factors) * voxels * pixel_bytes
+        else:
+            pyramid += np.sum(voxels / np.prod(factors, axis=1)) * pixel_bytes
+
+    interpolator = parameter_map.get('Interpolator', ['BSplineInterpolator'])[0]
+    if interpolator == 'BSplineInterpolator':
+        interpolator_memory = moving_voxels * 8
+    elif interpolator == 'BSplineInterpolatorFloat':
+        interpolator_memory = moving_voxels * 4
+    else:
+        interpolator_memory = 0.0
+
+    # Transform parameters: a B-spline has a grid of control points with three extra points per dimension
+    transform = parameter_map.get('Transform', [''])[0]
+    if 'BSpline' in transform:
+        grid_spacing = _floats(parameter_map, 'FinalGridSpacingInPhysicalUnits')
+        if grid_spacing is None:
+            grid_spacing = [spacing * voxels for spacing, voxels in
+                            zip(fixed_spacing, _floats(parameter_map, 'FinalGridSpacingInVoxels', [16.0]))]
+        if len(grid_spacing) == 1:
+            grid_spacing = grid_spacing * dimension
+        extent = np.array(fixed_size) * np.array(fixed_spacing)
+        number_of_parameters = dimension * np.prod(np.ceil(extent / np.array(grid_spacing)) + 3)
+    else:
+        number_of_parameters = dimension * (dimension + 1)
+    transform_memory = number_of_parameters * 8 * (6 + number_of_threads)
+
+    # Samples: a full or grid sampler keeps every fixed voxel, the other samplers a fixed number of samples
+    sampler = parameter_map.get('ImageSampler', ['Random'])[0]
+    if sampler in ('Full', 'Grid'):
+        number_of_samples = fixed_voxels
+    else:
+        number_of_samples = float(parameter_map.get('NumberOfSpatialSamples', ['5000'])[0])
+    sampler_memory = number_of_samples * (dimension + 1) * 8
+
+    return {'pyramid': pyramid, 'interpolator': interpolator_memory, 'transform': transform_memory,
+            'sampler': sampler_memory}
+
+
+def estimateRegistrationMemory(fixed_image, moving_image, parameter_maps, outputs=('result_image',),
+                               number_of_threads=1, output_tiles=1, overhead=64 * 2 ** 20):
+
+    parameter_maps = _parameterMapList(parameter_maps)
+    fixed_size, fixed_spacing, _, fixed_input_bytes = _imageInformation(fixed_image)
+    moving_size, _, _, moving_input_bytes = _imageInformation(moving_image)
+    dimension = len(fixed_size)
+    fixed_voxels, moving_voxels = float(np.prod(fixed_size)), float(np.prod(moving_size))
+
+    inputs = fixed_voxels * fixed_input_bytes + moving_voxels * moving_input_bytes
+    internal = fixed_voxels * PIXEL_TYPE_BYTES[parameter_maps[0].get('FixedInternalImagePixelType', ['float'])[0]] + \
+        moving_voxels * PIXEL_TYPE_BYTES[parameter_maps[0].get('MovingInternalImagePixelType', ['float'])[0]]
+    stages = [_stageMemory(parameter_map, fixed_size, fixed_spacing, moving_size, number_of_threads)
+              for parameter_map in parameter_maps]
+    registration = max(sum(stage.values()) for stage in stages)
+
+    # Outputs on the fixed grid. The result image also needs the B-spline coefficients of the moving image.
+    result_bytes = PIXEL_TYPE_BYTES[parameter_maps[-1].get('ResultImagePixelType', ['float'])[0]]
+    output_sizes = {'result_image': fixed_voxels * result_bytes + moving_voxels * 8,
+                    'deformation_field': fixed_voxels * dimension * 4,
+                    'determinant_of_spatial_jacobian': fixed_voxels * 4,
+                    'spatial_jacobian': fixed_voxels * dimension * dimension * 4}
+    unknown_outputs = set(outputs) - set(output_sizes)
+    if unknown_outputs:
+        raise ValueError("Unknown outputs: {0}".format(", ".join(sorted(unknown_outputs))))
+    output_memory = {output: output_sizes[output] / output_tiles for output in outputs}
+
+    peak = overhead + inputs + internal + max(registration, sum(output_memory.values()))
+    return {'inputs': inputs, 'internal': internal, 'stages': stages, 'registration': registration,
+            'outputs': output_memory, 'output_tiles': output_tiles, 'peak': int(peak)}
+
+
+# FIT MEMORY BUDGET
+# Adapt a registration job to a memory budget. When the estimate exceeds the budget, the internal pixel types are first
+# switched to short (only when both inputs are integer images of at most 16 bits, so no intensities are lost), then the
+# outputs are planned in tiles along the last axis. Tiles only help a caller that computes the outputs tile by tile
+# (outputTiles, warpRegionOfInterest); with allow_tiles=False the estimate is that of the full outputs, as elastix
+# computes them. Returns the adapted parameter maps and the plan with the estimate.
+def fitMemoryBudget(fixed_image, moving_image, parameter_maps, memory_budget, outputs=('result_image',),
+                    number_of_threads=1, allow_tiles=True):
+
+    parameter_maps = _parameterMapList(parameter_maps)
+    plan = {'internal_pixel_type': parameter_maps[0].get('FixedInternalImagePixelType', ['float'])[0],
+            'output_tiles': 1}
+    estimate = estimateRegistrationMemory(fixed_image, moving_image, parameter_maps, outputs, number_of_threads)
+
+    small_integer_types = (sitk.sitkUInt8, sitk.sitkInt8, sitk.sitkUInt16, sitk.sitkInt16)
+    if estimate['peak'] > memory_budget and \
+            _imageInformation(fixed_image)[2] in small_integer_types and \
+            _imageInformation(moving_image)[2] in small_integer_types:
+        for parameter_map in parameter_maps:
+            parameter_map['FixedInternalImagePixelType'] = ['short']
+            parameter_map['MovingInternalImagePixelType'] = ['short']
+        plan['internal_pixel_type'] = 'short'
+        estimate = estimateRegistrationMemory(fixed_image, moving_image, parameter_maps, outputs, number_of_threads)
+
+    output_memory = sum(estimate['outputs'].values())
+    if allow_tiles and estimate['peak'] > memory_budget and output_memory > estimate['registration']:
+        available = memory_budget - (estimate['peak'] - output_memory)
+        number_of_slices = _imageInformation(fixed_image)[0][-1]
+        output_tiles = number_of_slices if available <= 0 else int(np.ceil(output_memory / available))
+        plan['output_tiles'] = int(min(max(output_tiles, 1), number_of_slices))
+        estimate = estimateRegistrationMemory(fixed_image, moving_image, parameter_maps, outputs, number_of_threads,
+                                              plan['output_tiles'])
+
+    plan['estimate'] = estimate
+    plan['fits'] = estimate['peak'] <= memory_budget
+    return parameter_maps, plan
+
+
+# OUTPUT TILES
+# Split the grid of a reference image in tiles of whole slices along the last axis. Returns (index, size) per tile, for
+# sitk.RegionOfInterest or to set the output region of transformix.
+def outputTiles(reference_image, number_of_tiles):
+    size = list(_imageInformation(reference_image)[0])
+    bounds = np.linspace(0, size[-1], min(number_of_tiles, size[-1]) + 1).astype(int)
+    return [([0] * (len(size) - 1) + [int(start)], size[:-1] + [int(stop - start)])
+            for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+# AVAILABLE MEMORY
+# Memory (bytes) this process may still use: the available system memory, limited by the memory limit of the cgroup.
+def availableMemory():
+
+    try:
+        with open('/proc/meminfo') as meminfo:
+            fields = dict(line.split(':', 1) for line in meminfo)
+        memory = int(fields['MemAvailable'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+    for limit_file, usage_file in (('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                                    '/sys/fs/cgroup/memory/memory.usage_in_bytes')):
+        try:
+            with open(limit_file) as limit, open(usage_file) as usage:
+                limit, usage = limit.read().strip(), int(usage.read())
+            if limit != 'max':
+                memory = min(memory, int(limit) - usage)
+            break
+        except (OSError, ValueError):
+            continue
+    return max(0, memory)
+
+
+# ADMISSION CONTROLLER
+# Admits jobs only while the sum of their estimated peak memory stays within the budget (by default a fraction of the
+# available memory), so parallel jobs are not killed for running out of memory. A job that is larger than the whole
+# budget is admitted when nothing else runs, so it is not blocked forever.
+class AdmissionController:
+
+    def __init__(self, memory_budget=None, fraction=0.8):
+        self.memory_budget = memory_budget or int(fraction * availableMemory())
+        self.reserved = 0
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def admit(self, peak_memory):
+        with self._condition:
+            self._condition.wait_for(lambda: self.reserved == 0 or
+                                     self.reserved + peak_memory <= self.memory_budget)
+            self.reserved += peak_memory
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.reserved -= peak_memory
+                self._condition.notify_all()
+
+    # Pack jobs {key: peak memory} into waves that fit the budget together, with at most number_of_workers jobs per
+    # wave (first fit decreasing)
+    def pack(self, peak_memories, number_of_workers):
+        waves = []
+        for key in sorted(peak_memories, key=peak_memories.get, reverse=True):
+            for wave in waves:
+                if len(wave) < number_of_workers and \
+                        sum(peak_memories[other] for other in wave) + peak_memories[key] <= self.memory_budget:
+                    wave.append(key)
+                    break
+            else:
+                waves.append([key])
+        return waves
+
+
+# ITERATION INFO
+# Parser for the iteration table that elastix writes to elastix.log: a header line starting with "1:ItNr" (for example
+# 1:ItNr 2:Metric 3a:Time 3b:StepSize 4:||Gradient|| Time[ms]) followed by one tab separated line per iteration. Lines
+# are fed one at a time, so the parser also works on a log that is still being written. Every parsed iteration is
+# returned as (stage, resolution, {column: value}); the stage counts the parameter maps, it increases when the
+# resolution starts again at 0.
+class IterationInfoParser:
+
+    def __init__(self):
+        self.stage = -1
+        self.resolution = -1
+        self.columns = None
+
+    def feed(self, line):
+        line = line.strip()
+        if line.startswith('Resolution:'):
+            resolution = int(line.split(':')[1])
+            if resolution <= self.resolution or self.stage < 0:
+                self.stage += 1
+            self.resolution = resolution
+            self.columns = None
+            return None
+        if line.startswith('1:ItNr'):
+            self.columns = line.split('\t')
+            return None
+        if self.columns is not None:
+            fields = line.split('\t')
+            if len(fields) == len(self.columns):
+                try:
+                    values = [float(field) for field in fields]
+                except ValueError:
+                    return None
+                return max(self.stage, 0), max(self.resolution, 0), dict(zip(self.columns, values))
+        return None
+
+
+# Value (or array of values) of the first column whose name contains the given name, for example 'Gradient'
+def _iterationValue(row, name):
+    for column, value in row.items():
+        if name in column:
+            return value
+    return None
+
+
+# Read the iteration table of a finished log as {(stage, resolution): {column: array}}
+def readIterationInfo(log_file_name):
+    parser = IterationInfoParser()
+    rows = collections.defaultdict(lambda: collections.defaultdict(list))
+    with open(log_file_name) as log_file:
+        for line in log_file:
+            parsed = parser.feed(line)
+            if parsed is not None:
+                stage, resolution, row = parsed
+                for column, value in row.items():
+                    rows[(stage, resolution)][column].append(value)
+    return {key: {column: np.array(values) for column, values in columns.items()} for key, columns in rows.items()}
+
+
+def _runElastix(fixed_image, moving_image, parameter_maps, output_directory, fixed_mask=None, moving_mask=None,
+                number_of_threads=None):
+    elastix_image_filter = sitk.ElastixImageFilter()
+    elastix_image_filter.SetFixedImage(fixed_image)
+    elastix_image_filter.SetMovingImage(moving_image)
+    if fixed_mask is not None:
+        elastix_image_filter.SetFixedMask(fixed_mask)
+    if moving_mask is not None:
+        elastix_image_filter.SetMovingMask(moving_mask)
+    _setParameterMaps(elastix_image_filter, parameter_maps)
+    if number_of_threads is not None:
+        elastix_image_filter.SetNumberOfThreads(number_of_threads)
+    elastix_image_filter.SetOutputDirectory(output_directory)
+    elastix_image_filter.LogToConsoleOff()
+    elastix_image_filter.LogToFileOn()
+    elastix_image_filter.Execute()
+    return elastix_image_filter
+
+
+# SAMPLER BUDGET
+# Number of spatial samples per resolution for the random samplers (Random, RandomCoordinate, RandomSparseMask), instead
+# of one fixed number for all resolutions. The number of samples is the largest of:
+#
+#     histogram:  enough samples to fill the joint histogram, samples_per_bin * 2^(2 H) with H the entropy (bits) of
+#                 the fixed image inside the mask, measured with the number of histogram bins of the metric
+#     noise:      enough samples to bring the gradient noise of a pilot run down to the target. The noise is the
+#                 coefficient of variation of ||Gradient|| in the second half of the pilot iterations; its variance
+#                 scales with 1 / samples, so samples = pilot samples * (noise / target_noise)^2
+#
+# and it is limited to the number of (mask) voxels at that resolution. Parameter maps with other samplers are unchanged.
+# Returns the rewritten parameter maps and a report per parameter map and resolution.
+RANDOM_SAMPLERS = ('Random', 'RandomCoordinate', 'RandomSparseMask')
+
+
+def samplerBudget(fixed_image, parameter_maps, fixed_mask=None, iteration_info=None, samples_per_bin=4.0,
+                  target_noise=0.25, minimum_samples=256, maximum_samples=None):
+
+    fixed_image = _readImage(fixed_image)
+    parameter_maps = _parameterMapList(parameter_maps)
+    values = sitk.GetArrayViewFromImage(fixed_image)
+    if fixed_mask is not None:
+        mask_array = sitk.GetArrayViewFromImage(_readImage(fixed_mask)) != 0
+        values = values[mask_array]
+        mask_voxels = float(np.count_nonzero(mask_array))
+    else:
+        mask_voxels = float(values.size)
+
+    report = []
+    for stage, parameter_map in enumerate(parameter_maps):
+        if not all(sampler in RANDOM_SAMPLERS for sampler in parameter_map.get('ImageSampler', ['Random'])):
+            report.append(None)
+            continue
+
+        # Entropy of the fixed image with the histogram bins of the metric
+        bins = int(parameter_map.get('NumberOfHistogramBins', ['32'])[0])
+        histogram = np.histogram(values, bins)[0].astype(float)
+        probabilities = histogram[histogram > 0] / histogram.sum()
+        entropy = float(-np.sum(probabilities * np.log2(probabilities)))
+        histogram_samples = samples_per_bin * 2.0 ** (2 * entropy)
+
+        factors = _pyramidFactors(parameter_map, fixed_image.GetDimension())
+        samples = parameter_map.get('NumberOfSpatialSamples', ['5000'])
+        samples = [float(samples[min(resolution, len(samples) - 1)]) for resolution in range(len(factors))]
+        iterations = parameter_map.get('MaximumNumberOfIterations', ['250'])
+        iterations = [float(iterations[min(resolution, len(iterations) - 1)]) for resolution in range(len(factors))]
+
+        stage_report = []
+        new_samples = []
+        for resolution in range(len(factors)):
+            noise, noise_samples, time_per_iteration = None, 0.0, None
+            columns = (iteration_info or {}).get((stage, resolution))
+            if columns is not None:
+                gradient = _iterationValue(columns, 'Gradient')
+                if gradient is not None and len(gradient) >= 4:
+                    gradient = gradient[len(gradient) // 2:]
+                    noise = float(np.std(gradient) / max(np.mean(gradient), 1e-12))
+                    noise_samples = samples[resolution] * (noise / target_noise) ** 2
+                timing = _iterationValue(columns, 'Time[ms]')
+                if timing is not None and len(timing):
+                    time_per_iteration = float(np.median(timing)) / 1000.0
+
+            voxels = mask_voxels / np.prod(factors[resolution])
+            upper = min(voxels, maximum_samples or np.inf)
+            number_of_samples = int(np.clip(max(histogram_samples, noise_samples, minimum_samples), 1, upper))
+            new_samples.append(number_of_samples)
+
+            # The time per iteration is dominated by the samples, so the saving scales with the reduction
+            saved_time = None
+            if time_per_iteration is not None:
+                saved_time = iterations[resolution] * time_per_iteration * \
+                    (1.0 - number_of_samples / samples[resolution])
+            stage_report.append({'resolution': resolution, 'samples': int(samples[resolution]),
+                                 'new_samples': number_of_samples, 'entropy': entropy, 'gradient_noise': noise,
+                                 'predicted_saved_time': saved_time})
+
+        parameter_map['NumberOfSpatialSamples'] = [str(number_of_samples) for number_of_samples in new_samples]
+        report.append(stage_report)
+    return parameter_maps, report
+
+
+# SAMPLER BUDGET REGISTRATION
+# Registration with sample counts from samplerBudget(). A short pilot run (pilot_iterations per resolution, with the
+# original sample counts) measures the gradient noise and the time per iteration. When compare is set, the original
+# parameter maps are run as well, and the report contains the measured time saved (net of the pilot run) and the change
+# of the final metric value (negative is better for all elastix metrics). Returns the result image, the transform
+# parameter maps and the report.
+def samplerBudgetRegistration(fixed_image, moving_image, parameter_maps, fixed_mask=None, moving_mask=None,
+                              pilot_iterations=20, compare=False, **kwargs):
+
+    fixed_image, moving_image = _readImage(fixed_image), _readImage(moving_image)
+    fixed_mask = None if fixed_mask is None else sitk.Cast(_readImage(fixed_mask) != 0, sitk.sitkUInt8)
+    moving_mask = None if moving_mask is None else sitk.Cast(_readImage(moving_mask) != 0, sitk.sitkUInt8)
+    parameter_maps = _parameterMapList(parameter_maps)
+
+    def run(maps):
+        with RunDirectory('elastix_') as run_directory:
+            output_directory = run_directory.path
+            start_time = time.perf_counter()
+            elastix_image_filter = _runElastix(fixed_image, moving_image, maps, output_directory, fixed_mask,
+                                               moving_mask)
+            elapsed_time = time.perf_counter() - start_time
+            iteration_info = readIterationInfo(os.path.join(output_directory, 'elastix.log'))
+        return elastix_image_filter, elapsed_time, iteration_info
+
+    def finalMetric(iteration_info):
+        last = iteration_info[max(iteration_info)] if iteration_info else {}
+        metric = last.get('2:Metric')
+        return None if metric is None or not len(metric) else float(metric[-1])
+
+    pilot_maps = _parameterMapList(parameter_maps)
+    for parameter_map in pilot_maps:
+        parameter_map['MaximumNumberOfIterations'] = [str(pilot_iterations)]
+    _, pilot_time, pilot_info = run(pilot_maps)
+
+    budget_maps, stages = samplerBudget(fixed_image, parameter_maps, fixed_mask, pilot_info, **kwargs)
+    elastix_image_filter, elapsed_time, iteration_info = run(budget_maps)
+    report = {'stages': stages, 'pilot_time': pilot_time, 'elapsed_time': elapsed_time,
+              'final_metric': finalMetric(iteration_info)}
+
+    if compare:
+        _, original_time, original_info = run(parameter_maps)
+        report['original_time'] = original_time
+        report['saved_time'] = original_time - elapsed_time - pilot_time
+        report['original_final_metric'] = finalMetric(original_info)
+        if report['final_metric'] is not None and report['original_final_metric'] is not None:
+            report['metric_change'] = report['final_metric'] - report['original_final_metric']
+
+    return (elastix_image_filter.GetResultImage(), _parameterMapList(elastix_image_filter.GetTransformParameterMap()),
+            report)
+
+
+# SIMILARITY METRICS
+# Image similarity computed with numpy, for scoring registration results without running elastix. The values follow the
+# conventions of the elastix metrics, so lower is better for all of them:
+#
+#     mattes_mutual_information:  minus the mutual information of AdvancedMattesMutualInformation, with a joint
+#                                 histogram of a box (fixed) and cubic B-spline (moving) Parzen window, two padding bins
+#                                 and the intensity ranges extended by limit_range_ratio
+#     normalized_correlation:     minus the normalized cross correlation (AdvancedNormalizedCorrelation)
+#     mean_squares:               mean squared difference (AdvancedMeanSquares)
+#
+# The fixed side (voxels inside the mask, histogram bins, sums) is prepared once, after which every image on the fixed
+# grid is scored in chunks of voxels, so the memory stays bounded for large images.
+SIMILARITY_METRICS = ('mattes_mutual_information', 'normalized_correlation', 'mean_squares')
+
+
+def _cubicBSplineWeights(t):
+    return [(1 - t) ** 3 / 6, (3 * t ** 3 - 6 * t ** 2 + 4) / 6, (-3 * t ** 3 + 3 * t ** 2 + 3 * t + 1) / 6, t ** 3 / 6]
+
+
+def _histogramPosition(values, minimum, maximum, bins, limit_range_ratio=0.01, padding=2):
+    margin = limit_range_ratio * (maximum - minimum)
+    bin_size = max(maximum - minimum + 2 * margin, 1e-12) / (bins - 2 * padding)
+    return (values - (minimum - margin)) / bin_size + padding
+
+
+class SimilarityScorer:
+
+    def __init__(self, fixed_image, fixed_mask=None, bins=32, chunk_size=2 ** 20, limit_range_ratio=0.01):
+        fixed_array = np.asarray(sitk.GetArrayViewFromImage(_readImage(fixed_image)))
+        self.shape = fixed_array.shape
+        self.bins = bins
+        self.chunk_size = chunk_size
+        self.limit_range_ratio = limit_range_ratio
+
+        fixed_values = fixed_array.reshape(-1)
+        self.mask = None
+        if fixed_mask is not None:
+            self.mask = np.asarray(sitk.GetArrayViewFromImage(_readImage(fixed_mask))).reshape(-1) != 0
+            fixed_values = fixed_values[self.mask]
+        self.fixed_values = fixed_values.astype(np.float64)
+        if not len(self.fixed_values):
+            raise ValueError("The fixed mask does not contain any voxels")
+
+        position = _histogramPosition(self.fixed_values, self.fixed_values.min(), self.fixed_values.max(), bins,
+                                      limit_range_ratio)
+        self.fixed_bins = np.clip(np.floor(position).astype(np.int32), 0, bins - 1)
+        self.fixed_sum = self.fixed_values.sum()
+        self.fixed_squared_sum = np.dot(self.fixed_values, self.fixed_values)
+
+    # Masked moving values, chunk by chunk, together with the matching slice of the fixed values
+    def _chunks(self, moving_values):
+        fixed_start = 0
+        for start in range(0, len(moving_values), self.chunk_size):
+            chunk = moving_values[start:start + self.chunk_size]
+            if self.mask is not None:
+                chunk = chunk[self.mask[start:start + self.chunk_size]]
+            yield slice(fixed_start, fixed_start + len(chunk)), chunk.astype(np.float64)
+            fixed_start += len(chunk)
+
+    def score(self, image):
+        moving_values = np.asarray(sitk.GetArrayViewFromImage(_readImage(image)))
+        if moving_values.shape != self.shape:
+            raise ValueError("Image does not have the size of the fixed image")
+        moving_values = moving_values.reshape(-1)
+
+        # Intensity range of the moving values inside the mask
+        minimum, maximum = np.inf, -np.inf
+        for _, chunk in self._chunks(moving_values):
+            if len(chunk):
+                minimum, maximum = min(minimum, chunk.min()), max(maximum, chunk.max())
+
+        joint_histogram = np.zeros(self.bins * self.bins)
+        moving_sum = moving_squared_sum = cross_sum = squared_difference = 0.0
+        for fixed_slice, chunk in self._chunks(moving_values):
+            fixed_chunk = self.fixed_values[fixed_slice]
+            moving_sum += chunk.sum()
+            moving_squared_sum += np.dot(chunk, chunk)
+            cross_sum += np.dot(fixed_chunk, chunk)
+            squared_difference += np.dot(fixed_chunk - chunk, fixed_chunk - chunk)
+
+            position = _histogramPosition(chunk, minimum, maximum, self.bins, self.limit_range_ratio)
+            start = np.floor(position).astype(np.int32) - 1
+            weights = _cubicBSplineWeights(position - np.floor(position))
+            row = self.fixed_bins[fixed_slice] * self.bins
+            for offset in range(4):
+                moving_bins = np.clip(start + offset, 0, self.bins - 1)
+                joint_histogram += np.bincount(row + moving_bins, weights[offset], self.bins * self.bins)
+
+        number_of_values = float(len(self.fixed_values))
+        joint_probability = joint_histogram.reshape(self.bins, self.bins) / joint_histogram.sum()
+        product = np.outer(joint_probability.sum(axis=1), joint_probability.sum(axis=0))
+        nonzero = joint_probability > 0
+        mutual_information = np.sum(joint_probability[nonzero] * np.log(joint_probability[nonzero] / product[nonzero]))
+
+        covariance = cross_sum - self.fixed_sum * moving_sum / number_of_values
+        variance = (self.fixed_squared_sum - self.fixed_sum ** 2 / number_of_values) * \
+            (moving_squared_sum - moving_sum ** 2 / number_of_values)
+        correlation = covariance / np.sqrt(variance) if variance > 0 else 0.0
+
+        return {'mattes_mutual_information': -float(mutual_information),
+                'normalized_correlation': -float(correlation),
+                'mean_squares': float(squared_difference / number_of_values)}
+
+    # Score many images {key: image or file name} in parallel
+    def scoreMany(self, images, number_of_workers=None):
+        with concurrent.futures.ThreadPoolExecutor(number_of_workers or availableCpus()) as executor:
+            futures = {key: executor.submit(self.score, image) for key, image in images.items()}
+            return {key: future.result() for key, future in futures.items()}
+
+
+def similarityMetrics(fixed_image, moving_image, fixed_mask=None, **kwargs):
+    return SimilarityScorer(fixed_image, fixed_mask, **kwargs).score(moving_image)
+
+
+# FLAG OUTLIERS
+# Results whose score is much worse than that of the other results, by the modified z-score (median and median absolute
+# deviation) of every metric. Returns {key: [metrics for which the result is an outlier]} for the flagged results only.
+def flagOutliers(scores, metrics=SIMILARITY_METRICS, threshold=3.5):
+    outliers = collections.defaultdict(list)
+    keys = list(scores)
+    for metric in metrics:
+        values = np.array([scores[key][metric] for key in keys])
+        median = np.median(values)
+        deviation = np.median(np.abs(values - median))
+        if deviation == 0:
+            continue
+        z_scores = 0.6745 * (values - median) / deviation
+        for key, z_score in zip(keys, z_scores):
+            if z_score > threshold:
+                outliers[key].append(metric)
+    return dict(outliers)
+
+
+# DICOM HEADER
+# Minimal reader for the header of an uncompressed DICOM file: the meta group (explicit VR little endian) and the data
+# set in implicit or explicit VR little endian, up to the pixel data, which is not read. Returns the geometry and pixel
+# format of the slice and the offset and length of the pixel data in the file, or None for files that are not DICOM.
+# Big endian and deflated data sets are not parsed; compressed (encapsulated: JPEG, JPEG 2000, RLE, ...) pixel data is
+# marked with pixel_offset None, such files are read with SimpleITK instead.
+DICOM_TAGS = {(0x0002, 0x0010): 'transfer_syntax', (0x0008, 0x0018): 'sop_uid', (0x0018, 0x0050): 'slice_thickness',
+              (0x0020, 0x000E): 'series_uid', (0x0020, 0x0013): 'instance_number', (0x0020, 0x0032): 'position',
+              (0x0020, 0x0037): 'orientation', (0x0028, 0x0002): 'samples_per_pixel', (0x0028, 0x0010): 'rows',
+              (0x0028, 0x0011): 'columns', (0x0028, 0x0030): 'spacing', (0x0028, 0x0100): 'bits_allocated',
+              (0x0028, 0x0103): 'pixel_representation', (0x0028, 0x1052): 'rescale_intercept',
+              (0x0028, 0x1053): 'rescale_slope'}
+DICOM_UNSIGNED_SHORT_TAGS = ('samples_per_pixel', 'rows', 'columns', 'bits_allocated', 'pixel_representation')
+DICOM_LONG_LENGTH_VRS = (b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV')
+IMPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2'
+EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1'
+ENCAPSULATED_TRANSFER_SYNTAX_PREFIXES = ('1.2.840.10008.1.2.4', '1.2.840.10008.1.2.5')
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+
+def _readDicomElement(dicom_file, explicit):
+    header = dicom_file.read(8)
+    if len(header) < 8:
+        return None
+    group, element = struct.unpack('<HH', header[:4])
+    vr = None
+    if group == 0xFFFE:
+        length = struct.unpack('<I', header[4:])[0]
+    elif explicit:
+        vr = header[4:6]
+        if vr in DICOM_LONG_LENGTH_VRS:
+            length = struct.unpack('<I', dicom_file.read(4))[0]
+        else:
+            length = struct.unpack('<H', header[6:])[0]
+    else:
+        length = struct.unpack('<I', header[4:])[0]
+    return (group, element), vr, length
+
+
+def _skipUndefinedLength(dicom_file, explicit):
+
+    # Skip the items of a sequence (or encapsulated pixel data) of undefined length, up to its delimitation item
+    while True:
+        element = _readDicomElement(dicom_file, explicit)
+        if element is None or element[0] == (0xFFFE, 0xE0DD):
+            return
+        tag, _, length = element
+        if tag == (0xFFFE, 0xE000) and length == UNDEFINED_LENGTH:
+            while True:
+                nested = _readDicomElement(dicom_file, explicit)
+                if nested is None or nested[0] == (0xFFFE, 0xE00D):
+                    break
+                if nested[2] == UNDEFINED_LENGTH:
+                    _skipUndefinedLength(dicom_file, explicit)
+                else:
+                    dicom_file.seek(nested[2], os.SEEK_CUR)
+        elif length != UNDEFINED_LENGTH:
+            dicom_file.seek(length, os.SEEK_CUR)
+
+
+def readDicomHeader(file_name):
+
+    header = {'pixel_offset': None, 'pixel_length': None}
+    with open(file_name, 'rb') as dicom_file:
+        dicom_file.seek(128)
+        if dicom_file.read(4) != b'DICM':
+            return None
+
+        explicit, data_set = True, False
+        while True:
+            position = dicom_file.tell()
+            element = _readDicomElement(dicom_file, explicit)
+            if element is None:
+                break
+            tag, vr, length = element
+
+            # The data set after the meta group uses the transfer syntax
+            if tag[0] != 0x0002 and not data_set:
+                data_set = True
+                transfer_syntax = header.get('transfer_syntax')
+                if transfer_syntax == IMPLICIT_VR_LITTLE_ENDIAN:
+                    explicit = False
+                    dicom_file.seek(position)
+                    continue
+                if transfer_syntax != EXPLICIT_VR_LITTLE_ENDIAN and \
+                        not (transfer_syntax or '').startswith(ENCAPSULATED_TRANSFER_SYNTAX_PREFIXES):
+                    raise ValueError("Unsupported transfer syntax {0} in {1}".format(transfer_syntax, file_name))
+
+            if tag == (0x7FE0, 0x0010):
+                if length != UNDEFINED_LENGTH:
+                    header['pixel_offset'], header['pixel_length'] = dicom_file.tell(), length
+                break
+            if length == UNDEFINED_LENGTH:
+                _skipUndefinedLength(dicom_file, explicit)
+                continue
+
+            name = DICOM_TAGS.get(tag)
+            if name is None:
+                dicom_file.seek(length, os.SEEK_CUR)
+                continue
+            value = dicom_file.read(length)
+            if name in DICOM_UNSIGNED_SHORT_TAGS:
+                header[name] = struct.unpack('<H', value[:2])[0]
+            else:
+                header[name] = value.decode('ascii', 'replace').strip('\x00 ')
+
+    for name in ('position', 'orientation', 'spacing'):
+        if name in header:
+            header[name] = [float(value) for value in header[name].split('\\')]
+    for name in ('slice_thickness', 'rescale_intercept', 'rescale_slope'):
+        if name in header and header[name]:
+            header[name] = float(header[name])
+    if header.get('instance_number'):
+        header['instance_number'] = int(header['instance_number'])
+    return header
+
+
+# DICOM INDEX
+# Persistent SQLite index of the DICOM files in a number of folders: series UID, slice geometry, pixel format and the
+# offset of the pixel data in every file. update() only reads the headers of files that are new or changed (by size and
+# modification time) and removes files that are gone; files that cannot be indexed are listed in the report with the
+# reason. The same SOP instance in several files is only used once, files without a SOP instance UID are all used.
+# Stacks and volumes are then assembled from the index by reading the pixel data at the stored offsets, without parsing
+# the headers again. Rescaled pixels keep an integer type when the rescale slope and intercept are integers, as when
+# SimpleITK reads the files.
+class DicomIndex:
+
+    COLUMNS = ('path', 'size', 'mtime', 'series_uid', 'sop_uid', 'instance_number', 'position', 'orientation',
+               'spacing', 'slice_thickness', 'rows', 'columns', 'samples_per_pixel', 'bits_allocated',
+               'pixel_representation', 'rescale_slope', 'rescale_intercept', 'transfer_syntax', 'pixel_offset',
+               'pixel_length')
+
+    def __init__(self, database_file):
+        self.database_file = database_file
+        self.connection = sqlite3.connect(database_file, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, "
+                                    "mtime REAL, series_uid TEXT, sop_uid TEXT, instance_number INTEGER, "
+                                    "position TEXT, orientation TEXT, spacing TEXT, slice_thickness REAL, "
+                                    "rows INTEGER, columns INTEGER, samples_per_pixel INTEGER, bits_allocated INTEGER, "
+                                    "pixel_representation INTEGER, rescale_slope REAL, rescale_intercept REAL, "
+                                    "transfer_syntax TEXT, pixel_offset INTEGER, pixel_length INTEGER)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS files_series ON files (series_uid)")
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, directory):
+
+        directory = os.path.abspath(directory)
+        pattern = (directory + os.sep).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        known = {row['path']: (row['size'], row['mtime']) for row in self.connection.execute(
+            "SELECT path, size, mtime FROM files WHERE path LIKE ? ESCAPE '\\'", (pattern,))}
+        found = set()
+        report = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0, 'skipped': []}
+        with self.connection:
+            for root, _, file_names in os.walk(directory):
+                for file_name in file_names:
+                    path = os.path.join(root, file_name)
+                    status = os.stat(path)
+                    found.add(path)
+                    if known.get(path) == (status.st_size, status.st_mtime):
+                        report['unchanged'] += 1
+                        continue
+                    try:
+                        header = readDicomHeader(path)
+                    except (ValueError, struct.error, OSError) as error:
+                        report['skipped'].append({'path': path, 'reason': str(error) or type(error).__name__})
+                        continue
+                    if header is None or 'series_uid' not in header:
+                        report['skipped'].append({'path': path, 'reason': "not a DICOM image file" if header is None
+                                                  else "no series instance UID"})
+                        continue
+
+                    header.update(path=path, size=status.st_size, mtime=status.st_mtime)
+                    for name in ('position', 'orientation', 'spacing'):
+                        header[name] = json.dumps(header.get(name))
+                    self.connection.execute("INSERT OR REPLACE INTO files ({0}) VALUES ({1})".format(
+                        ", ".join(self.COLUMNS), ", ".join("?" * len(self.COLUMNS))),
+                        [header.get(column) for column in self.COLUMNS])
+                    report['updated' if path in known else 'added'] += 1
+
+            for path in set(known) - found:
+                self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+                report['removed'] += 1
+        return report
+
+    # All series as {series uid: number of slices}
+    def series(self):
+        return {row[0]: row[1] for row in self.connection.execute(
+            "SELECT series_uid, COUNT(DISTINCT COALESCE(sop_uid, path)) FROM files GROUP BY series_uid")}
+
+    # Slices of a series, one per SOP instance (files without a SOP instance UID are all kept), in file name order (as a
+    # sorted folder listing) or sorted along the slice normal (or by instance number when the geometry is missing)
+    def slices(self, series_uid, by_position=False):
+        rows, seen = [], set()
+        for row in self.connection.execute("SELECT * FROM files WHERE series_uid = ? ORDER BY path", (series_uid,)):
+            row = dict(row)
+            key = row['path'] if row['sop_uid'] is None else row['sop_uid']
+            if key in seen:
+                continue
+            seen.add(key)
+            for name in ('position', 'orientation', 'spacing'):
+                row[name] = json.loads(row[name])
+            rows.append(row)
+        if not rows:
+            raise ValueError("Series {0} is not in the index".format(series_uid))
+        if not by_position:
+            return rows
+
+        def sortKey(row):
+            if row['position'] is not None and row['orientation'] is not None:
+                return float(np.dot(np.cross(row['orientation'][:3], row['orientation'][3:]), row['position']))
+            return row['instance_number'] or 0
+        return sorted(rows, key=sortKey)
+
+    @staticmethod
+    def _readPixels(row):
+        if row['pixel_offset'] is None:
+            return sitk.GetArrayFromImage(sitk.ReadImage(row['path'])).reshape(row['rows'], row['columns'], -1)
+
+        dtype = np.dtype('<{0}{1}'.format('i' if row['pixel_representation'] else 'u', row['bits_allocated'] // 8))
+        samples = row['samples_per_pixel'] or 1
+        pixels = np.fromfile(row['path'], dtype, row['rows'] * row['columns'] * samples, offset=row['pixel_offset'])
+        pixels = pixels.reshape(row['rows'], row['columns'], samples)
+        slope = 1.0 if row['rescale_slope'] is None else row['rescale_slope']
+        intercept = row['rescale_intercept'] or 0.0
+        if slope == 1.0 and intercept == 0.0:
+            return pixels
+        if float(slope).is_integer() and float(intercept).is_integer():
+            pixels = pixels.astype(np.int32) * int(slope) + int(intercept)
+            fits_short = pixels.size == 0 or (pixels.min() >= np.iinfo(np.int16).min and
+                                              pixels.max() <= np.iinfo(np.int16).max)
+            return pixels.astype(np.int16) if fits_short else pixels
+        return pixels.astype(np.float32) * slope + intercept
+
+    def _array(self, rows):
+        array = np.stack([self._readPixels(row) for row in rows])
+        return array[..., 0] if array.shape[-1] == 1 else array
+
+    # The slices of a series as a 2D+t stack (as for groupwise registration) in file name order: all slices share the
+    # in-plane geometry of the first slice, the last axis has unit spacing
+    def loadStack(self, series_uid):
+        rows = self.slices(series_uid)
+        array = self._array(rows)
+        image = sitk.GetImageFromArray(array, isVector=array.ndim == 4)
+        spacing = rows[0]['spacing'] or [1.0, 1.0]
+        image.SetSpacing([spacing[1], spacing[0], 1.0])
+        if rows[0]['position'] is not None:
+            image.SetOrigin(rows[0]['position'][:2] + [0.0])
+        return image
+
+    # The slices of a series as a 3D volume with the geometry of the DICOM headers, sorted along the slice normal
+    def loadVolume(self, series_uid):
+        rows = self.slices(series_uid, by_position=True)
+        array = self._array(rows)
+        image = sitk.GetImageFromArray(array, isVector=array.ndim == 4)
+        spacing = rows[0]['spacing'] or [1.0, 1.0]
+        slice_spacing = rows[0]['slice_thickness'] or 1.0
+        if rows[0]['orientation'] is not None and rows[0]['position'] is not None:
+            row_direction, column_direction = np.array(rows[0]['orientation'][:3]), np.array(rows[0]['orientation'][3:])
+            normal = np.cross(row_direction, column_direction)
+            if len(rows) > 1:
+                distances = np.diff([np.dot(normal, row['position']) for row in rows])
+                slice_spacing = float(np.median(distances)) or slice_spacing
+            image.SetDirection(list(np.stack([row_direction, column_direction, normal], axis=1).ravel()))
+            image.SetOrigin(rows[0]['position'])
+        image.SetSpacing([spacing[1], spacing[0], slice_spacing])
+        return image
+
+
+# CHUNKED IMAGE STORE
+# Compressed, chunked storage of result images, displacement fields and Jacobians. An image is stored as a folder with a
+# meta.json file (geometry, pixel type, chunk shape and a record per chunk) and one zlib compressed file per chunk of
+# voxels. Floating point chunks can be stored as float16 (relative to the middle of their value range) when the
+# largest error stays within error_bound; other chunks keep their pixel type. Regions and slices are read by only
+# decompressing the chunks they overlap. The folder is written next to its final place and moved there at once.
+def _chunkSlices(chunk_index, chunk_shape, shape):
+    return tuple(slice(index * chunk, min((index + 1) * chunk, size))
+                 for index, chunk, size in zip(chunk_index, chunk_shape, shape))
+
+
+def writeChunkedImage(image, path, chunk_shape=None, error_bound=None, compression_level=6, number_of_workers=None):
+
+    array = sitk.GetArrayViewFromImage(image)
+    dimension = image.GetDimension()
+    shape = array.shape[:dimension]
+    chunk_shape = [min(chunk, size) for chunk, size in
+                   zip(chunk_shape or ([64] * dimension if dimension == 3 else [256] * dimension), shape)]
+    grid_shape = [int(np.ceil(size / float(chunk))) for size, chunk in zip(shape, chunk_shape)]
+
+    path = os.path.abspath(path)
+    temporary_path = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path))
+
+    def writeChunk(chunk_index):
+        chunk = np.ascontiguousarray(array[_chunkSlices(chunk_index, chunk_shape, shape)])
+        record = {'dtype': chunk.dtype.str, 'offset': 0.0}
+        if error_bound is not None and chunk.dtype.kind == 'f' and chunk.size:
+            offset = float(chunk.min() + chunk.max()) / 2.0
+            quantized = (chunk - offset).astype(np.float16)
+            if np.all(np.isfinite(quantized)) and \
+                    np.max(np.abs(quantized.astype(np.float64) + offset - chunk)) <= error_bound:
+                chunk, record = quantized, {'dtype': quantized.dtype.str, 'offset': offset}
+        name = '.'.join(str(index) for index in chunk_index)
+        with open(os.path.join(temporary_path, name), 'wb') as chunk_file:
+            chunk_file.write(zlib.compress(chunk.tobytes(), compression_level))
+        return name, record
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(number_of_workers or availableCpus()) as executor:
+            chunks = dict(executor.map(writeChunk, itertools.product(*[range(count) for count in grid_shape])))
+        meta = {'size': list(image.GetSize()), 'spacing': list(image.GetSpacing()), 'origin': list(image.GetOrigin()),
+                'direction': list(image.GetDirection()), 'pixel_id': image.GetPixelID(),
+                'components': image.GetNumberOfComponentsPerPixel(), 'dtype': array.dtype.str,
+                'chunk_shape': chunk_shape, 'error_bound': error_bound, 'chunks': chunks}
+        with open(os.path.join(temporary_path, 'meta.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+        # Replace an existing store only after the new one is complete
+        if os.path.exists(path):
+            old_path = tempfile.mkdtemp(prefix=os.path.basename(path) + '.old.', dir=os.path.dirname(path))
+            os.replace(path, os.path.join(old_path, 'store'))
+            os.replace(temporary_path, path)
+            shutil.rmtree(old_path, ignore_errors=True)
+        else:
+            os.replace(temporary_path, path)
+    except BaseException:
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        raise
+
+
+class ChunkedImage:
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            self.meta = json.load(meta_file)
+        self.size = self.meta['size']
+        self.dimension = len(self.size)
+        self.shape = self.size[::-1]
+        self.chunk_shape = self.meta['chunk_shape']
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.components = self.meta['components']
+
+    def _readChunk(self, chunk_index):
+        name = '.'.join(str(index) for index in chunk_index)
+        record = self.meta['chunks'][name]
+        slices = _chunkSlices(chunk_index, self.chunk_shape, self.shape)
+        chunk_shape = [piece.stop - piece.start for piece in slices] + \
+            ([self.components] if self.components > 1 else [])
+        with open(os.path.join(self.path, name), 'rb') as chunk_file:
+            chunk = np.frombuffer(zlib.decompress(chunk_file.read()), np.dtype(record['dtype'])).reshape(chunk_shape)
+        if record['offset'] or chunk.dtype != self.dtype:
+            chunk = (chunk.astype(np.float64) + record['offset']).astype(self.dtype)
+        return chunk
+
+    # Read a region given as start index and size in (x, y, z) order, as an image with the matching geometry
+    def readRegion(self, index, size):
+        index, size = list(index), list(size)
+        if any(start < 0 or start + length > total for start, length, total in zip(index, size, self.size)):
+            raise ValueError("Region is outside the image")
+        lower, upper = np.array(index[::-1]), np.array(index[::-1]) + np.array(size[::-1])
+        region = np.empty(list(upper - lower) + ([self.components] if self.components > 1 else []), self.dtype)
+
+        chunk_ranges = [range(start // chunk, (stop - 1) // chunk + 1)
+                        for start, stop, chunk in zip(lower, upper, self.chunk_shape)]
+        for chunk_index in itertools.product(*chunk_ranges):
+            chunk_slices = _chunkSlices(chunk_index, self.chunk_shape, self.shape)
+            overlap_lower = np.maximum(lower, [piece.start for piece in chunk_slices])
+            overlap_upper = np.minimum(upper, [piece.stop for piece in chunk_slices])
+            chunk = self._readChunk(chunk_index)
+            chunk_lower = overlap_lower - [piece.start for piece in chunk_slices]
+            region[tuple(slice(start, stop) for start, stop in zip(overlap_lower - lower, overlap_upper - lower))] = \
+                chunk[tuple(slice(start, stop) for start, stop in zip(chunk_lower, chunk_lower + overlap_upper -
+                                                                      overlap_lower))]
+
+        image = sitk.GetImageFromArray(region, isVector=self.components > 1)
+        dimension = self.dimension
+        direction = np.array(self.meta['direction']).reshape(dimension, dimension)
+        image.SetOrigin(list(np.array(self.meta['origin']) + direction.dot(np.array(self.meta['spacing']) *
+                                                                           np.array(index))))
+        image.SetSpacing(self.meta['spacing'])
+        image.SetDirection(self.meta['direction'])
+        return image
+
+    # Read slices along an axis (default the last axis, z in 3D), as one image per slice with one dimension less
+    def readSlices(self, slice_indices, axis=None):
+        axis = self.dimension - 1 if axis is None else axis
+        slices = []
+        for slice_index in slice_indices:
+            index, size = [0] * self.dimension, list(self.size)
+            index[axis], size[axis] = slice_index, 1
+            region = self.readRegion(index, size)
+            size[axis] = 0
+            slices.append(sitk.Extract(region, size, [0] * self.dimension))
+        return slices
+
+    def toImage(self):
+        return self.readRegion([0] * self.dimension, self.size)
+
+
+# HIERARCHICAL GROUPWISE REGISTRATION
+# Groupwise registration of a long series of frames (a list of images with the same geometry, or a stack with the frames
+# along the last axis) in parallel jobs instead of one joint job:
+#
+#     1. the frames are split into sub-groups of about group_size consecutive frames, which are registered groupwise in
+#        parallel; the mean of the registered frames of a sub-group is its template
+#     2. every template is registered to the middle template (in parallel) with the pairwise equivalent of the stack
+#        transform, and the registered frames of its sub-group are warped with that transform in one batch
+#     3. all frames are refined together with a short groupwise registration (one resolution, few iterations)
+#
+# Returns the registered frames as a stack and a report with the time of every phase.
+PAIRWISE_PARAMETER_MAPS = {'TranslationStackTransform': 'translation', 'EulerStackTransform': 'rigid',
+                           'AffineLogStackTransform': 'affine', 'BSplineStackTransform': 'bspline'}
+
+
+def _framesFromStack(stack):
+    size = list(stack.GetSize())
+    return [sitk.Extract(stack, size[:-1] + [0], [0] * (len(size) - 1) + [frame]) for frame in range(size[-1])]
+
+
+def _groupwiseFrames(frames, parameter_map, scheduler):
+    stack = sitk.JoinSeries(frames)
+    with RunDirectory('elastix_') as run_directory:
+        output_directory = run_directory.path
+        with scheduler.allocate(stack) as number_of_threads:
+            elastix_image_filter = _runElastix(stack, stack, parameter_map, output_directory,
+                                               number_of_threads=number_of_threads)
+        return _framesFromStack(elastix_image_filter.GetResultImage())
+
+
+def hierarchicalGroupwiseRegistration(frames, parameter_map=None, transform='EulerStackTransform', group_size=8,
+                                      refinement_iterations=64, number_of_workers=None, scheduler=None):
+
+    if isinstance(frames, sitk.Image):
+        frames = _framesFromStack(frames)
+    for frame in frames[1:]:
+        if not _sameGeometry(frames[0], frame):
+            raise ValueError("All frames must have the same geometry")
+    if transform not in PAIRWISE_PARAMETER_MAPS:
+        raise ValueError("Unsupported stack transform: {0}".format(transform))
+    parameter_map = _parameterMapList(parameter_map or sitk.GetDefaultParameterMap('groupwise'))[0]
+    parameter_map['Transform'] = [transform]
+
+    scheduler = scheduler or ThreadScheduler()
+    groups = [list(group) for group in np.array_split(np.arange(len(frames)),
+                                                      max(1, len(frames) // max(group_size, 2)))]
+    number_of_workers = number_of_workers or min(len(groups), scheduler.cpus)
+    report = {'groups': [len(group) for group in groups]}
+
+    with scheduler.pool(number_of_workers), concurrent.futures.ThreadPoolExecutor(number_of_workers) as executor:
+
+        # Sub-groups in parallel
+        start_time = time.perf_counter()
+        group_frames = list(executor.map(lambda group: _groupwiseFrames([frames[index] for index in group],
+                                                                        parameter_map, scheduler), groups))
+        templates = []
+        for registered_frames in group_frames:
+            template = sitk.GetImageFromArray(np.mean([sitk.GetArrayViewFromImage(frame)
+                                                       for frame in registered_frames], axis=0).astype(np.float32))
+            template.CopyInformation(registered_frames[0])
+            templates.append(template)
+        report['subgroup_time'] = time.perf_counter() - start_time
+
+        # Templates to the middle template in parallel, then warp the frames of every sub-group in one batch
+        start_time = time.perf_counter()
+        reference_index = len(groups) // 2
+        pairwise_map = sitk.GetDefaultParameterMap(PAIRWISE_PARAMETER_MAPS[transform])
+
+        def alignTemplate(index):
+            if index == reference_index:
+                return group_frames[index]
+            with RunDirectory('elastix_') as run_directory:
+                output_directory = run_directory.path
+                with scheduler.allocate(templates[index]) as number_of_threads:
+                    elastix_image_filter = _runElastix(templates[reference_index], templates[index], pairwise_map,
+                                                       output_directory, number_of_threads=number_of_threads)
+                transform_parameter_maps = _parameterMapList(elastix_image_filter.GetTransformParameterMap())
+            return warpImages(group_frames[index], transform_parameter_maps, templates[reference_index])
+
+        aligned_frames = list(itertools.chain.from_iterable(executor.map(alignTemplate, range(len(groups)))))
+        report['template_time'] = time.perf_counter() - start_time
+
+    # Short joint refinement of all frames
+    start_time = time.perf_counter()
+    refinement_map = _parameterMapList(parameter_map)[0]
+    refinement_map['NumberOfResolutions'] = ['1']
+    refinement_map['MaximumNumberOfIterations'] = [str(refinement_iterations)]
+    result_frames = _groupwiseFrames(aligned_frames, refinement_map, scheduler)
+    report['refinement_time'] = time.perf_counter() - start_time
+
+    return sitk.JoinSeries(result_frames), report
+
+
+# REGION OF INTEREST RESAMPLING
+# Let transformix evaluate only a part of the output grid of the transform parameter maps: a physical bounding box
+# (lower and upper corner in mm), a list of slices along the last axis, and/or a coarser output spacing for a preview.
+# The Size, Index, Origin and Spacing overrides are derived from the output grid of the last parameter map, so the cost
+# of the warp is proportional to the size of the region.
+def regionOfInterestGrid(transform_parameter_maps, lower=None, upper=None, spacing=None, index_range=None):
+
+    size, origin, grid_spacing, direction = _gridFromParameterMap(_parameterMapList(transform_parameter_maps)[-1])
+    dimension = len(size)
+    size, origin, grid_spacing = np.array(size), np.array(origin), np.array(grid_spacing)
+    direction_matrix = np.array(direction).reshape(dimension, dimension)
+
+    # Region in continuous indices of the output grid
+    lower_index, upper_index = np.zeros(dimension), size - 1.0
+    if lower is not None and upper is not None:
+        corners = np.array([[upper[axis] if (corner >> axis) & 1 else lower[axis] for axis in range(dimension)]
+                            for corner in range(2 ** dimension)])
+        corner_indices = _physicalToIndex(corners, origin, grid_spacing, direction)
+        lower_index = np.clip(np.ceil(corner_indices.min(axis=0) - 1e-6), 0, size - 1)
+        upper_index = np.clip(np.floor(corner_indices.max(axis=0) + 1e-6), 0, size - 1)
+    if index_range is not None:
+        lower_index[-1], upper_index[-1] = max(index_range[0], 0), min(index_range[1], size[-1] - 1)
+    if np.any(upper_index < lower_index):
+        raise ValueError("The region of interest does not overlap the output grid")
+
+    output_spacing = grid_spacing if spacing is None else np.broadcast_to(np.array(spacing, dtype=float), (dimension,))
+    output_size = np.floor((upper_index - lower_index) * grid_spacing / output_spacing + 1e-6).astype(int) + 1
+    output_origin = origin + direction_matrix.dot(grid_spacing * lower_index)
+    return list(output_size), list(output_origin), list(output_spacing), direction
+
+
+def _runTransformix(moving_image, transform_parameter_maps, label=False, number_of_threads=None):
+    with RunDirectory('transformix_') as run_directory:
+        output_directory = run_directory.path
+        transformix_image_filter = sitk.TransformixImageFilter()
+        transformix_image_filter.SetMovingImage(moving_image)
+        _setTransformParameterMaps(transformix_image_filter, transform_parameter_maps)
+        if label:
+            transformix_image_filter.SetTransformParameter('FinalBSplineInterpolationOrder', '0')
+        if number_of_threads is not None:
+            transformix_image_filter.SetNumberOfThreads(number_of_threads)
+        transformix_image_filter.SetOutputDirectory(output_directory)
+        transformix_image_filter.LogToConsoleOff()
+        transformix_image_filter.Execute()
+        return transformix_image_filter.GetResultImage()
+
+
+def warpRegionOfInterest(moving_image, transform_parameter_maps, lower=None, upper=None, spacing=None, label=False,
+                         number_of_threads=None):
+    grid = regionOfInterestGrid(transform_parameter_maps, lower, upper, spacing)
+    return _runTransformix(_readImage(moving_image), _setOutputGrid(transform_parameter_maps, *grid), label,
+                           number_of_threads)
+
+
+# Warp a list of slices (indices along the last axis of the output grid). Consecutive slices are warped in one run.
+# Returns {slice index: image of one slice thick}.
+def warpSlices(moving_image, transform_parameter_maps, slice_indices, spacing=None, label=False,
+               number_of_threads=None):
+
+    moving_image = _readImage(moving_image)
+    slice_indices = sorted(set(int(index) for index in slice_indices))
+    runs = []
+    for slice_index in slice_indices:
+        if runs and slice_index == runs[-1][-1] + 1:
+            runs[-1].append(slice_index)
+        else:
+            runs.append([slice_index])
+    if spacing is not None:
+        grid_spacing = _gridFromParameterMap(_parameterMapList(transform_parameter_maps)[-1])[2]
+        spacing = list(np.broadcast_to(np.array(spacing, dtype=float), (len(grid_spacing) - 1,))) + \
+            [grid_spacing[-1]]
+
+    slices = {}
+    for run in runs:
+        grid = regionOfInterestGrid(transform_parameter_maps, spacing=spacing, index_range=(run[0], run[-1]))
+        result_image = _runTransformix(moving_image, _setOutputGrid(transform_parameter_maps, *grid), label,
+                                       number_of_threads)
+        size = list(result_image.GetSize())
+        for position, slice_index in enumerate(run):
+            slices[slice_index] = sitk.RegionOfInterest(result_image, size[:-1] + [1],
+                                                        [0] * (len(size) - 1) + [position])
+    return slices
+
+
+# REGISTRATION TELEMETRY
+# Follows the elastix.log of a running registration in a background thread and turns every iteration into an event:
+# {'stage', 'resolution', 'iteration', 'metric', 'step_size', 'gradient', 'iteration_time', 'time'}. Events are passed
+# to a callback and/or sent as JSON datagrams to a UDP address (host, port) or a unix datagram socket (path), and the
+# last history_size events are kept in ring buffers (all events and the metric per stage and resolution).
+#
+# The telemetry also watches the job. It is stalled when no iteration arrives for stall_time seconds, and diverging
+# when the metric or gradient is not finite or the mean metric of the last window iterations is worse than the first
+# metric of the resolution by more than divergence_tolerance (relative). On an anomaly, on_anomaly(status, telemetry) is
+# called and, with kill set, the monitored process (for example a subprocess.Popen) is killed.
+class RegistrationTelemetry:
+
+    def __init__(self, log_file_name, callback=None, address=None, history_size=1000, poll_interval=0.2,
+                 stall_time=120.0, window=20, divergence_tolerance=0.5, on_anomaly=None, process=None, kill=False):
+        self.log_file_name = log_file_name
+        self.callback = callback
+        self.address = address
+        self.poll_interval = poll_interval
+        self.stall_time = stall_time
+        self.window = window
+        self.divergence_tolerance = divergence_tolerance
+        self.on_anomaly = on_anomaly
+        self.process = process
+        self.kill = kill
+
+        self.events = collections.deque(maxlen=history_size)
+        self.metric_history = collections.defaultdict(lambda: collections.deque(maxlen=history_size))
+        self.first_metric = {}
+        self.status = 'waiting'
+        self.last_event_time = None
+        self._socket = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._follow, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exception):
+        self.stop()
+
+    def start(self):
+        if self.address is not None:
+            family = socket.AF_UNIX if isinstance(self.address, str) else socket.AF_INET
+            self._socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.start_time = time.time()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        if self._socket is not None:
+            self._socket.close()
+        if self.status in ('waiting', 'running'):
+            self.status = 'finished'
+
+    # Latest event, or None before the first iteration
+    def latest(self):
+        return self.events[-1] if self.events else None
+
+    def _follow(self):
+
+        # Only the part of the log that is written after the start is followed; a log that is truncated or replaced
+        # is followed from its beginning
+        parser = IterationInfoParser()
+        position = os.path.getsize(self.log_file_name) if os.path.exists(self.log_file_name) else 0
+        buffer = ''
+        while True:
+            stopping = self._stop.is_set()
+            if os.path.exists(self.log_file_name):
+                if os.path.getsize(self.log_file_name) < position:
+                    position, buffer, parser = 0, '', IterationInfoParser()
+                with open(self.log_file_name, errors='replace') as log_file:
+                    log_file.seek(position)
+                    buffer += log_file.read()
+                    position = log_file.tell()
+                *lines, buffer = buffer.split('\n')
+                for line in lines:
+                    parsed = parser.feed(line)
+                    if parsed is not None:
+                        self._publish(*parsed)
+            if stopping:
+                return
+            self._check()
+            self._stop.wait(self.poll_interval)
+
+    def _publish(self, stage, resolution, row):
+        event = {'stage': stage, 'resolution': resolution, 'iteration': int(row.get('1:ItNr', -1)),
+                 'metric': row.get('2:Metric'), 'step_size': _iterationValue(row, 'StepSize'),
+                 'gradient': _iterationValue(row, 'Gradient'), 'iteration_time': _iterationValue(row, 'Time[ms]'),
+                 'time': time.time()}
+        self.events.append(event)
+        self.last_event_time = event['time']
+        if self.status == 'waiting':
+            self.status = 'running'
+        if event['metric'] is not None:
+            self.metric_history[(stage, resolution)].append(event['metric'])
+            self.first_metric.setdefault((stage, resolution), event['metric'])
+
+        if self.callback is not None:
+            self.callback(event)
+        if self._socket is not None:
+            try:
+                self._socket.sendto(json.dumps(event).encode(), self.address)
+            except OSError:
+                pass
+
+    def _check(self):
+        if self.status not in ('waiting', 'running'):
+            return
+        status = None
+        latest = self.latest()
+        if time.time() - (self.last_event_time or self.start_time) > self.stall_time:
+            status = 'stalled'
+        elif latest is not None:
+            values = [latest[key] for key in ('metric', 'gradient') if latest[key] is not None]
+            history = self.metric_history[(latest['stage'], latest['resolution'])]
+            first = self.first_metric.get((latest['stage'], latest['resolution']))
+            if not np.all(np.isfinite(values)):
+                status = 'diverging'
+            elif first is not None and len(history) >= self.window and \
+                    np.mean(list(history)[-self.window:]) > first + self.divergence_tolerance * abs(first):
+                status = 'diverging'
+        if status is None:
+            return
+
+        self.status = status
+        if self.on_anomaly is not None:
+            self.on_anomaly(status, self)
+        if self.kill and self.process is not None:
+            self.process.kill()
+
+
+# MONITORED REGISTRATION
+# Run a registration in a separate process (the register command of cli.py, in its own scratch directory, with only the
+# results written to the output directory) and follow it with RegistrationTelemetry, so a stalled or diverging job can
+# be killed early instead of waiting for a time out. Returns the exit code of the process (negative when it was killed),
+# the telemetry and the outputs reported by the command.
+def monitoredRegistration(fixed_image_file, moving_image_file, parameters, output_directory, kill=True, **kwargs):
+
+    with RunDirectory('monitored_') as run_directory:
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py'), 'register',
+                   '--fixed', fixed_image_file, '--moving', moving_image_file, '-o', output_directory,
+                   '--work-directory', run_directory.path, '--log-to-file']
+        for parameter in parameters:
+            command += ['-p', parameter]
+
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+        with RegistrationTelemetry(run_directory.file('elastix.log'), process=process, kill=kill,
+                                   **kwargs) as telemetry:
+            output, _ = process.communicate()
+    try:
+        outputs = json.loads(output)
+    except ValueError:
+        outputs = None
+    return process.returncode, telemetry, outputs
+
+
+# DETERMINISTIC MODE
+# Random samplers and multi-threaded metrics make two runs of the same registration differ slightly. In deterministic
+# mode every parameter map gets a fixed RandomSeed (seed + map index), the metrics are computed single threaded so their
+# sums are always reduced in the same order, and the number of threads is pinned. Two runs with the same inputs, seed
+# and number of threads then give the same transform parameters.
+def deterministicParameterMaps(parameter_maps, seed=0, single_threaded_metrics=True):
+    parameter_maps = _parameterMapList(parameter_maps)
+    for index, parameter_map in enumerate(parameter_maps):
+        parameter_map['RandomSeed'] = [str(seed + index)]
+        if single_threaded_metrics:
+            parameter_map['UseMultiThreadingForMetrics'] = ['false']
+    return parameter_maps
+
+
+def deterministicRegistration(fixed_image, moving_image, parameter_maps, seed=0, number_of_threads=1,
+                              output_directory=None, fixed_mask=None, moving_mask=None):
+    with RunDirectory('elastix_') as run_directory:
+        elastix_image_filter = _runElastix(_readImage(fixed_image), _readImage(moving_image),
+                                           deterministicParameterMaps(parameter_maps, seed),
+                                           output_directory or run_directory.path, fixed_mask, moving_mask,
+                                           number_of_threads)
+        return elastix_image_filter.GetResultImage(), \
+            _parameterMapList(elastix_image_filter.GetTransformParameterMap())
+
+
+# RESULT VERIFICATION
+# Check whether two registration results (for example a cached and a freshly computed one) are equivalent within
+# tolerances. Transform parameter maps are compared key by key: numeric values within atol + rtol * |value|, other
+# values exactly. Optionally both transforms are also evaluated on a subsampled reference grid and the largest distance
+# between the mapped points (mm) is compared with displacement_tolerance; numeric differences are then accepted when the
+# mapped points agree, but missing keys and differing non-numeric values (such as the Transform) never are. Images are
+# compared voxel by voxel after a check of their geometry. Every function returns a report with an 'equal' field.
+VERIFICATION_IGNORED_KEYS = ('InitialTransformParametersFileName',)
+
+
+def compareTransformParameterMaps(transform_parameter_maps_1, transform_parameter_maps_2, rtol=1e-6, atol=1e-6,
+                                  reference_image=None, displacement_tolerance=None, stride=4):
+
+    maps_1 = _parameterMapList(transform_parameter_maps_1)
+    maps_2 = _parameterMapList(transform_parameter_maps_2)
+    report = {'equal': len(maps_1) == len(maps_2), 'differences': [], 'max_parameter_difference': 0.0}
+    structural_differences = []
+    for index, (map_1, map_2) in enumerate(zip(maps_1, maps_2)):
+        for key in sorted(set(map_1) | set(map_2)):
+            if key in VERIFICATION_IGNORED_KEYS:
+                continue
+            values_1, values_2 = map_1.get(key), map_2.get(key)
+            if values_1 is None or values_2 is None or len(values_1) != len(values_2):
+                structural_differences.append((index, key))
+                continue
+            try:
+                numbers_1 = np.array(values_1, dtype=float)
+                numbers_2 = np.array(values_2, dtype=float)
+            except ValueError:
+                if values_1 != values_2:
+                    structural_differences.append((index, key))
+                continue
+            if len(numbers_1):
+                difference = float(np.max(np.abs(numbers_1 - numbers_2)))
+                if key == 'TransformParameters':
+                    report['max_parameter_difference'] = max(report['max_parameter_difference'], difference)
+                if not np.allclose(numbers_1, numbers_2, rtol=rtol, atol=atol):
+                    report['differences'].append((index, key))
+
+    report['differences'] = sorted(report['differences'] + structural_differences)
+    report['equal'] = report['equal'] and not structural_differences
+
+    if displacement_tolerance is not None and report['equal']:
+        grid = _gridFromImage(reference_image) if reference_image is not None else \
+            _gridFromParameterMap(maps_1[-1])
+        size, origin, spacing, direction = grid
+        subsampled_size = [int(np.ceil(s / float(stride))) for s in size]
+        points = _gridPoints(subsampled_size, origin, [s * stride for s in spacing], direction)
+        distances = np.linalg.norm(transformPoints(compositeTransform(maps_1), points) -
+                                   transformPoints(compositeTransform(maps_2), points), axis=1)
+        report['max_displacement_difference'] = float(distances.max())
+        report['equal'] = report['max_displacement_difference'] <= displacement_tolerance
+    else:
+        report['equal'] = report['equal'] and not report['differences']
+    return report
+
+
+def compareImages(image_1, image_2, rtol=1e-5, atol=1e-5):
+    image_1, image_2 = _readImage(image_1), _readImage(image_2)
+    report = {'same_geometry': _sameGeometry(image_1, image_2)}
+    if not report['same_geometry']:
+        report['equal'] = False
+        return report
+    array_1 = sitk.GetArrayViewFromImage(image_1).astype(np.float64)
+    array_2 = sitk.GetArrayViewFromImage(image_2).astype(np.float64)
+    difference = np.abs(array_1 - array_2)
+    outside = difference > atol + rtol * np.abs(array_2)
+    report.update(max_difference=float(difference.max()), mean_difference=float(difference.mean()),
+                  fraction_outside_tolerance=float(outside.mean()), equal=not np.any(outside))
+    return report
+
+
+def verifyRegistrationResults(result_image_1, transform_parameter_maps_1, result_image_2, transform_parameter_maps_2,
+                              image_tolerance=1e-5, **kwargs):
+    transform_report = compareTransformParameterMaps(transform_parameter_maps_1, transform_parameter_maps_2, **kwargs)
+    image_report = compareImages(result_image_1, result_image_2, rtol=image_tolerance, atol=image_tolerance)
+    return {'equal': transform_report['equal'] and image_report['equal'], 'transform': transform_report,
+            'image': image_report}
+
+
+# RUN DIRECTORY
+# Isolated scratch directory for one job, so concurrent jobs never write to the same elastix / transformix output
+# directory. The scratch directory is created in /dev/shm (memory backed) when it exists, is writable and has at least
+# minimum_free bytes free, otherwise in the default temporary directory; a scratch_root may be given instead. Requested
+# artifacts are moved to the persist directory with atomic writes, everything else is removed when the job ends. An
+# existing directory may be given as path instead, it is then used as is and neither created nor removed.
+def scratchRoot(minimum_free=2 ** 30):
+    shared_memory_directory = '/dev/shm'
+    if os.path.isdir(shared_memory_directory) and os.access(shared_memory_directory, os.W_OK) and \
+            shutil.disk_usage(shared_memory_directory).free >= minimum_free:
+        return shared_memory_directory
+    return tempfile.gettempdir()
+
+
+class RunDirectory:
+
+    def __init__(self, prefix='run_', persist_directory=None, scratch_root=None, path=None):
+        self.prefix = prefix
+        self.persist_directory = persist_directory
+        self.scratch_root = scratch_root
+        self.keep = path is not None
+        self.path = path
+
+    def __enter__(self):
+        if not self.keep:
+            self.path = tempfile.mkdtemp(prefix=self.prefix, dir=self.scratch_root or scratchRoot())
+        return self
+
+    def __exit__(self, *exception):
+        self.cleanup()
+
+    def cleanup(self):
+        if self.path is not None and not self.keep:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def _destination(self, name):
+        if self.persist_directory is None:
+            raise ValueError("No persist directory was given")
+        os.makedirs(self.persist_directory, exist_ok=True)
+        return os.path.join(self.persist_directory, name)
+
+    # Copy a file of the scratch directory to the persist directory (under another name if given)
+    def persist(self, name, destination_name=None):
+        destination = self._destination(destination_name or name)
+        atomicWrite(destination, lambda temporary_file_name: shutil.copyfile(self.file(name), temporary_file_name))
+        return destination
+
+    def persistImage(self, image, name):
+        destination = self._destination(name)
+        atomicWrite(destination, lambda temporary_file_name: sitk.WriteImage(image, temporary_file_name))
+        return destination
+
+    def persistParameterMaps(self, parameter_maps, name_format="TransformParameters.{0}.txt"):
+        destinations = []
+        for index, parameter_map in enumerate(_parameterMapList(parameter_maps)):
+            destination = self._destination(name_format.format(index))
+            atomicWrite(destination, lambda temporary_file_name: sitk.WriteParameterFile(parameter_map,
+                                                                                        temporary_file_name))
+            destinations.append(destination)
+        return destinations